@@ -24,21 +24,73 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import division
 
 import os
+import io
 import math
+import operator
 import random
 import re
+import time
 import warnings
 import copy
+import errno
+import binascii
+import hashlib
+import socket
+import ssl
+import struct
+import tempfile
+import threading
+import multiprocessing
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from xml.sax.saxutils import escape
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    # Python 2.x
+    from collections import Sequence
 
 try:
     # we're on Python3
-    from urllib.request import urlopen
-    from urllib.parse import quote
+    from urllib.request import urlopen, Request
+    from urllib.parse import quote, unquote, urlsplit
+    from urllib.error import HTTPError
+    import http.client as httplib
 
 except ImportError:
     # we're on Python2.x
-    from urllib2 import urlopen
-    from urllib import quote
+    from urllib2 import urlopen, Request, HTTPError
+    from urllib import quote, unquote
+    from urlparse import urlsplit
+    import httplib
+
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2.x, download_many() isn't available.
+    asyncio = None
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8. ProcessPoolRenderer pickles the series instead.
+    shared_memory = None
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional. Without it, ndarrays can't be passed in and the
+    # pure Python encoders are used.
+    numpy = None
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    # Pillow is optional. PNGRenderer draws in pure Python without it.
+    Image = None
 
 
 # Helper variables and functions
@@ -49,11 +101,95 @@ __author__ = 'Gerald Kaszuba'
 
 reo_colour = re.compile('^([A-Fa-f0-9]{2,2}){3,4}$')
 
+# Colours which _check_colour() has already matched.
+_valid_colours = set()
+
 def _check_colour(colour):
+    if colour in _valid_colours:
+        return
     if not reo_colour.match(colour):
         raise InvalidParametersException('Colours need to be in ' \
             'RRGGBB or RRGGBBAA format. One of your colours has %s' % \
             colour)
+    if len(_valid_colours) >= 1024:
+        _valid_colours.clear()
+    _valid_colours.add(colour)
+
+
+# Cache for _quote(), as the same titles, legends and labels tend to be used
+# by many charts.
+_quoted = {}
+
+def _quote(text):
+    """quote() which remembers its results."""
+    try:
+        return _quoted[text]
+    except KeyError:
+        if len(_quoted) >= 1024:
+            _quoted.clear()
+        quoted = _quoted[text] = quote(text)
+        return quoted
+
+
+def _numpy_series(data):
+    """Returns a (values, missing) pair of arrays if data is a NumPy array or
+    masked array, otherwise None. Masked entries are treated like None."""
+    if numpy is None or not isinstance(data, numpy.ndarray):
+        return None
+    return numpy.ma.getdata(data), numpy.ma.getmaskarray(data)
+
+
+def _sample_series(data, count=64):
+    """Returns about count values spread evenly over a series."""
+    step = max(1, len(data) // count)
+    arrays = _numpy_series(data)
+    if arrays is not None:
+        values, missing = arrays
+        return [None if missing[a] else values[a].item()
+            for a in range(0, len(values), step)]
+    return [data[a] for a in range(0, len(data), step)]
+
+
+def _series_range(data):
+    """Returns the (minimum, maximum) of the values in a series which aren't
+    missing, or None if there are none."""
+    arrays = _numpy_series(data)
+    if arrays is not None:
+        values = numpy.ma.compressed(data)
+        if not values.size:
+            return None
+        return values.min().item(), values.max().item()
+    if isinstance(data, RingSeries):
+        return data.range()
+    if isinstance(data, CompactSeries):
+        data = data.present()
+    try:
+        lower = min(data)
+        upper = max(data)
+    except TypeError:
+        # None values on Python 3
+        lower = None
+    except ValueError:
+        return None
+    if lower is None:
+        data = [a for a in data if a is not None]
+        if not data:
+            return None
+        lower = min(data)
+        upper = max(data)
+    return lower, upper
+
+
+def _range_key(data_range):
+    """Returns a hashable version of an (lower, upper) range."""
+    if data_range is None:
+        return None
+    return tuple(data_range)
+
+
+# Placeholder for the data in get_url_bits() while the URL is being streamed.
+# See Chart.iter_url_chunks().
+_DEFERRED_DATA = object()
 
 
 def _reset_warnings():
@@ -89,6 +225,14 @@ class BadContentTypeException(PyGoogleChartException):
     pass
 
 
+class ResponseTooLargeException(PyGoogleChartException):
+    pass
+
+
+class DownloadCancelledException(PyGoogleChartException):
+    pass
+
+
 class AbstractClassException(PyGoogleChartException):
     pass
 
@@ -103,12 +247,215 @@ class UnknownCountryCodeException(PyGoogleChartException):
 # -----------------------------------------------------------------------------
 
 
+class ClipStats(object):
+    """The values of a series which were clipped because they were outside
+    its scaling range. Has the number of clipped values, their indexes, the
+    smallest and largest of them and the scaling range.
+    """
+
+    def __init__(self, range, clips):
+        self.range = range
+        self.count = len(clips)
+        self.indices = [index for index, value in clips]
+        self.min_value = min([value for index, value in clips])
+        self.max_value = max([value for index, value in clips])
+
+    def __repr__(self):
+        return '<ClipStats %i values from %s to %s outside %s>' % (
+            self.count, self.min_value, self.max_value, self.range)
+
+
 class Data(object):
+    """Abstract class for the data encodings.
+
+    Each series is encoded in a single pass through `codes`, a table built
+    once at import time which maps every encodable value (and None) to its
+    encoded string. Anything the table can't handle falls back to
+    encode_series_slow(), which also produces the error messages.
+
+    If scale_ranges is given, it has a (lower, upper) range for each series
+    and the data is scaled, clipped and encoded in the same loop by
+    scale_encode_series().
+
+    If buffers is given, it is a dict kept between calls where the encoded
+    series are stored, so a series is only encoded again for values appended
+    since the last call. It can be shared by several charts. See
+    buffered_encode_series().
+    """
+
+    # array typecode for scale_compact() output.
+    scaled_typecode = 'H'
+
+    # Put between the encoded values of a series.
+    value_separator = ''
 
-    def __init__(self, data):
+    # Cache of scale_encode_series() tables for integer data, keyed by the
+    # data class and scaling range.
+    scaled_code_tables = {}
+
+    def __init__(self, data, scale_ranges=None, buffers=None):
         if type(self) == Data:
             raise AbstractClassException('This is an abstract class')
         self.data = data
+        self.scale_ranges = scale_ranges
+        self.buffers = buffers
+        # ClipStats of each series clipped while scaling
+        self.clip_stats = {}
+
+    def __repr__(self):
+        return ''.join(self.iter_chunks())
+
+    def iter_chunks(self):
+        """Yields the encoded data one series at a time."""
+        yield 'chd=%s:' % self.type_code
+        for index, data in enumerate(self.data):
+            if index:
+                yield self.series_separator
+            scale_range = None
+            if self.scale_ranges is not None:
+                scale_range = self.scale_ranges[index]
+            clips = []
+            if isinstance(data, RingSeries):
+                yield self.encode_segments(data, scale_range, clips)
+            elif self.buffers is not None:
+                yield self.buffered_encode_series(data, scale_range, clips)
+            elif scale_range is None:
+                yield self.encode_series(data)
+            else:
+                yield self.scale_encode_series(data, scale_range, clips)
+            if clips:
+                self.clip_stats[index] = ClipStats(scale_range, clips)
+
+    def encode_segments(self, data, range, clips):
+        """Encodes each of the segments() of a RingSeries, scaled to range
+        unless it is None, and joins them."""
+        encoded = []
+        offset = 0
+        for segment in data.segments():
+            segment_clips = []
+            if range is None:
+                encoded.append(self.encode_series(segment))
+            else:
+                encoded.append(self.scale_encode_series(segment, range,
+                    segment_clips))
+            clips.extend([(a + offset, value)
+                for a, value in segment_clips])
+            offset += len(segment)
+        return self.value_separator.join([a for a in encoded if a])
+
+    def buffered_encode_series(self, data, range, clips):
+        """Encodes a series like iter_chunks() does and stores the result in
+        self.buffers. If the series has only been appended to since then and
+        its scaling range is the same, just the new values are encoded and
+        added to the stored string.
+        """
+        key = id(data)
+        buffered = self.buffers.get(key)
+        if buffered is None or buffered[0] is not data or \
+                buffered[1] != range or buffered[2] > len(data) or \
+                _numpy_series(data) is not None:
+            buffered = (data, range, 0, '', [])
+        size, encoded, buffered_clips = buffered[2:]
+        if size < len(data):
+            new_clips = []
+            tail = data
+            if size:
+                tail = data[size:]
+            if range is None:
+                tail = self.encode_series(tail)
+            else:
+                tail = self.scale_encode_series(tail, range, new_clips)
+            if encoded and tail:
+                encoded += self.value_separator
+            encoded += tail
+            buffered_clips.extend([(a + size, value)
+                for a, value in new_clips])
+        # The series is kept so its id isn't reused while it is in here.
+        self.buffers[key] = (data, range, len(data), encoded, buffered_clips)
+        clips.extend(buffered_clips)
+        return encoded
+
+    @classmethod
+    def encode_series(cls, data):
+        if _numpy_series(data) is not None:
+            return cls.encode_array(data)
+        try:
+            return ''.join(map(cls.codes.__getitem__, data))
+        except (KeyError, TypeError):
+            # Out of range or non-integral values.
+            return cls.encode_series_slow(data)
+
+    @classmethod
+    def scale_encode_series(cls, data, range, clips=None):
+        """Scales, clips and encodes a series, giving the same result as
+        encoding the scale_value() of each value, in a single loop. Clipped
+        values are recorded in clips, see record_clip().
+
+        Integer data is looked up in a table of the encoded value of every
+        integer in the range, so each value costs one dict lookup.
+        """
+        if _numpy_series(data) is not None:
+            return cls.encode_array(cls.scale_array(data, range, clips))
+        if isinstance(data, CompactSeries) and not data.missing:
+            data = data.values
+        lower, upper = range
+        assert(upper > lower)
+        table = cls.scaled_code_table(lower, upper, len(data))
+        if table is not None:
+            try:
+                return ''.join(map(table.__getitem__, data))
+            except (KeyError, TypeError):
+                # Non-integral or out of range values.
+                pass
+
+        factor = cls.max_value / (upper - lower)
+        max_value = cls.max_value
+        codes = cls.codes
+        missing_code = codes[None]
+        encoded = []
+        append = encoded.append
+        for index, value in enumerate(data):
+            if value is None:
+                append(missing_code)
+                continue
+            scaled = int(round((value - lower) * factor))
+            if scaled < 0 or scaled > max_value:
+                clipped = cls.clip_value(scaled)
+                Data.record_clip(clips, index, value, scaled, clipped)
+                scaled = clipped
+            append(codes[scaled])
+        return ''.join(encoded)
+
+    @classmethod
+    def scaled_code_table(cls, lower, upper, size):
+        """Returns a table of the scaled and encoded value of each integer
+        from lower to upper, or None if the range isn't integral or is
+        wider than the series is long, when building the table would take
+        longer than scaling the series.
+        """
+        if not isinstance(lower, int) or not isinstance(upper, int) or \
+                upper - lower > size:
+            return None
+        key = (cls, lower, upper)
+        table = Data.scaled_code_tables.get(key)
+        if table is None:
+            if len(Data.scaled_code_tables) >= 64:
+                Data.scaled_code_tables.clear()
+            factor = cls.max_value / (upper - lower)
+            codes = cls.codes
+            table = dict([(value, codes[int(round((value - lower) * factor))])
+                for value in range(lower, upper + 1)])
+            table[None] = codes[None]
+            Data.scaled_code_tables[key] = table
+        return table
+
+    @classmethod
+    def build_codes(cls):
+        """Returns the value to code lookup table for this encoding."""
+        codes = dict([(a, cls.encode_value(a))
+            for a in range(cls.max_value + 1)])
+        codes[None] = cls.missing_code
+        return codes
 
     @classmethod
     def float_scale_value(cls, value, range):
@@ -125,9 +472,13 @@ class Data(object):
     def int_scale_value(cls, value, range):
         return int(round(cls.float_scale_value(value, range)))
 
+    @classmethod
+    def unclipped_scale_value(cls, value, range):
+        return cls.int_scale_value(value, range)
+
     @classmethod
     def scale_value(cls, value, range):
-        scaled = cls.int_scale_value(value, range)
+        scaled = cls.unclipped_scale_value(value, range)
         clipped = cls.clip_value(scaled)
         Data.check_clip(scaled, clipped)
         return clipped
@@ -138,54 +489,267 @@ class Data(object):
             warnings.warn('One or more of of your data points has been '
                 'clipped because it is out of range.')
 
+    @staticmethod
+    def record_clip(clips, index, value, scaled, clipped):
+        """Appends the index and value of a clipped value to the clips list.
+        If clips is None, warns straight away instead."""
+        if clips is None:
+            Data.check_clip(scaled, clipped)
+        else:
+            clips.append((index, value))
+
+    @classmethod
+    def float_scale_array(cls, data, range):
+        """NumPy version of float_scale_value() for a whole series. Returns
+        the scaled values and the missing value mask."""
+        values, missing = _numpy_series(data)
+        # In the array's own type, e.g. int8, the arithmetic would overflow
+        # and float32 would round differently from the list path.
+        values = numpy.asarray(values, dtype=numpy.float64)
+        lower, upper = float(range[0]), float(range[1])
+        assert(upper > lower)
+        return (values - lower) * (cls.max_value / (upper - lower)), missing
+
+    @classmethod
+    def clip_array(cls, data, scaled, missing, clips=None):
+        clipped = numpy.clip(scaled, 0, cls.max_value)
+        changed = (scaled != clipped) & ~missing
+        if changed.any():
+            values = numpy.ma.getdata(data)
+            if clips is None:
+                index = numpy.flatnonzero(changed)[0]
+                Data.check_clip(scaled[index], clipped[index])
+            else:
+                indices = numpy.flatnonzero(changed).tolist()
+                clips.extend(zip(indices, values[indices].tolist()))
+        return numpy.ma.array(clipped, mask=missing)
+
+    @classmethod
+    def scale_array(cls, data, range, clips=None):
+        """NumPy version of scale_value() for a whole series. Masked values
+        stay masked. numpy.rint rounds half to even, the same as round()."""
+        values, missing = _numpy_series(data)
+        if values.dtype.kind == 'f' and numpy.isnan(values[~missing]).any():
+            # As int() does for the values of a list
+            raise ValueError('cannot convert float NaN to integer')
+        scaled, missing = cls.float_scale_array(data, range)
+        return cls.clip_array(data, numpy.rint(scaled), missing, clips)
+
+    @classmethod
+    def scale_compact(cls, data, range, out=None, clips=None):
+        """Scales a CompactSeries into out, another CompactSeries which is
+        overwritten instead of building a new list. A new one is made if out
+        isn't given or has the wrong type. Returns the scaled series.
+        """
+        typecode = cls.scaled_typecode
+        if out is None or out.values.typecode != typecode:
+            out = CompactSeries(typecode=typecode)
+        size = len(data)
+        values = out.values
+        if len(values) > size:
+            del values[size:]
+        else:
+            values.extend(array(typecode, [0]) * (size - len(values)))
+        missing = data.missing
+        out.missing = missing and bytearray(missing)
+
+        lower, upper = range
+        assert(upper > lower)
+        factor = cls.max_value / (upper - lower)
+        max_value = cls.max_value
+        integral = typecode != 'd'
+        for index, value in enumerate(data.values):
+            scaled = (value - lower) * factor
+            if integral:
+                scaled = int(round(scaled))
+            if scaled < 0 or scaled > max_value:
+                if missing and missing[index >> 3] & (1 << (index & 7)):
+                    scaled = 0
+                else:
+                    clipped = cls.clip_value(scaled)
+                    Data.record_clip(clips, index, value, scaled, clipped)
+                    scaled = clipped
+            values[index] = scaled
+        return out
+
+    @classmethod
+    def array_table(cls):
+        """Returns a NumPy lookup table of encoded values. The extra entry at
+        the end of the table is the code for a missing value."""
+        if '_array_table' not in cls.__dict__:
+            codes = [cls.codes[a] for a in range(cls.max_value + 1)]
+            codes.append(cls.codes[None])
+            cls._array_table = numpy.array([a.encode('ascii')
+                for a in codes])
+        return cls._array_table
+
+    @classmethod
+    def encode_array(cls, data):
+        """Encodes a NumPy series with a single lookup table index instead of
+        a loop over every value."""
+        values, missing = _numpy_series(data)
+        present = ~missing
+        bad = present & ~((values >= 0) & (values <= cls.max_value))
+        if bad.any():
+            index = int(numpy.flatnonzero(bad)[0])
+            cls.out_of_range(data, index, values[index])
+        indices = numpy.where(missing, 0, values).astype(numpy.intp)
+        indices[missing] = cls.max_value + 1
+        return cls.array_table()[indices].tobytes().decode('ascii')
+
 
 class SimpleData(Data):
 
     max_value = 61
     enc_map = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+    type_code = 's'
+    series_separator = ','
+    missing_code = '_'
 
-    def __repr__(self):
-        encoded_data = []
-        for data in self.data:
-            sub_data = []
-            for value in data:
-                if value is None:
-                    sub_data.append('_')
-                elif value >= 0 and value <= self.max_value:
-                    sub_data.append(SimpleData.enc_map[value])
-                else:
-                    raise DataOutOfRangeException('cannot encode value: %d'
-                                                  % value)
-            encoded_data.append(''.join(sub_data))
-        return 'chd=s:' + ','.join(encoded_data)
+    @classmethod
+    def encode_series_slow(cls, data):
+        sub_data = []
+        for value in data:
+            if value is None:
+                sub_data.append('_')
+            elif value >= 0 and value <= cls.max_value:
+                sub_data.append(SimpleData.enc_map[value])
+            else:
+                cls.out_of_range(data, None, value)
+        return ''.join(sub_data)
+
+    @classmethod
+    def encode_value(cls, value):
+        return cls.enc_map[value]
+
+    @staticmethod
+    def out_of_range(data, index, value):
+        raise DataOutOfRangeException('cannot encode value: %d' % value)
 
 
 class TextData(Data):
 
     max_value = 100
+    type_code = 't'
+    scaled_typecode = 'd'
+    series_separator = '%7c'
+    value_separator = ','
 
-    def __repr__(self):
-        encoded_data = []
-        for data in self.data:
-            sub_data = []
-            for value in data:
-                if value is None:
-                    sub_data.append(-1)
-                elif value >= 0 and value <= self.max_value:
-                    sub_data.append("%.1f" % float(value))
-                else:
-                    raise DataOutOfRangeException()
-            encoded_data.append(','.join(sub_data))
-        return 'chd=t:' + '%7c'.join(encoded_data)
+    @classmethod
+    def encode_series(cls, data):
+        if _numpy_series(data) is not None:
+            return cls.encode_array(data)
+        try:
+            in_range = min(data) >= 0 and max(data) <= cls.max_value
+        except (TypeError, ValueError):
+            # None values on Python 3, or an empty series.
+            in_range = False
+        if in_range:
+            return ','.join(map('%.1f'.__mod__, data))
+        return cls.encode_series_slow(data)
 
     @classmethod
-    def scale_value(cls, value, range):
+    def encode_series_slow(cls, data):
+        sub_data = []
+        for value in data:
+            if value is None:
+                sub_data.append('-1')
+            elif value >= 0 and value <= cls.max_value:
+                sub_data.append("%.1f" % float(value))
+            else:
+                raise DataOutOfRangeException()
+        return ','.join(sub_data)
+
+    @classmethod
+    def unclipped_scale_value(cls, value, range):
         # use float values instead of integers because we don't need an encode
         # map index
-        scaled = cls.float_scale_value(value, range)
-        clipped = cls.clip_value(scaled)
-        Data.check_clip(scaled, clipped)
-        return clipped
+        return cls.float_scale_value(value, range)
+
+    @classmethod
+    def scale_array(cls, data, range, clips=None):
+        scaled, missing = cls.float_scale_array(data, range)
+        return cls.clip_array(data, scaled, missing, clips)
+
+    @classmethod
+    def scale_encode_series(cls, data, range, clips=None):
+        if _numpy_series(data) is not None:
+            return cls.encode_array(cls.scale_array(data, range, clips))
+        if isinstance(data, CompactSeries) and not data.missing:
+            data = data.values
+        lower, upper = range
+        assert(upper > lower)
+        factor = cls.max_value / (upper - lower)
+        max_value = cls.max_value
+        encoded = []
+        append = encoded.append
+        for index, value in enumerate(data):
+            if value is None:
+                append('-1')
+                continue
+            scaled = (value - lower) * factor
+            if scaled < 0 or scaled > max_value:
+                clipped = cls.clip_value(scaled)
+                Data.record_clip(clips, index, value, scaled, clipped)
+                scaled = clipped
+            append('%.1f' % scaled)
+        return ','.join(encoded)
+
+    @classmethod
+    def encode_array(cls, data):
+        # Text values aren't table driven, but the range check is vectorised
+        # and "%.1f" is applied to plain floats from tolist(), so the output
+        # is identical to the pure Python path.
+        values, missing = _numpy_series(data)
+        present = ~missing
+        if (present & ~((values >= 0) & (values <= cls.max_value))).any():
+            raise DataOutOfRangeException()
+        values = numpy.where(missing, 0, values).astype(float).tolist()
+        return ','.join(['-1' if missing_value else '%.1f' % value
+            for value, missing_value in zip(values, missing.tolist())])
+
+
+class ScaledTextData(TextData):
+    """Text encoding of the unscaled data. The scaling range of each series
+    is sent in the chds parameter (see ranges_to_url()) and the server does
+    the scaling.
+
+    ranges is a list of (lower, upper) pairs, one per series. Values are
+    given with up to precision decimal places and trailing zeros are
+    dropped, so 5.0 is sent as 5.
+    """
+
+    def __init__(self, data, ranges, precision=1, buffers=None):
+        TextData.__init__(self, data, buffers=buffers)
+        self.ranges = ranges
+        self.precision = precision
+
+    def ranges_to_url(self):
+        """Returns the chds parameter for the ranges, or None."""
+        ranges = list(self.ranges)
+        # The last range is used for any series after it.
+        while len(ranges) > 1 and ranges[-1] == ranges[-2]:
+            ranges.pop()
+        if ranges:
+            return 'chds=' + ','.join([self.format_value(a)
+                for scale_range in ranges for a in scale_range])
+
+    def format_value(self, value):
+        if value is None:
+            return '_'
+        text = '%.*f' % (self.precision, value)
+        if '.' in text:
+            text = text.rstrip('0').rstrip('.')
+        if text == '-0':
+            text = '0'
+        return text
+
+    def encode_series(self, data):
+        if _numpy_series(data) is not None:
+            values, missing = _numpy_series(data)
+            data = [None if missing_value else value for value, missing_value
+                in zip(values.tolist(), missing.tolist())]
+        return ','.join(map(self.format_value, data))
 
 
 class ExtendedData(Data):
@@ -193,26 +757,446 @@ class ExtendedData(Data):
     max_value = 4095
     enc_map = \
         'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-.'
+    type_code = 'e'
+    series_separator = ','
+    missing_code = '__'
 
-    def __repr__(self):
-        encoded_data = []
+    @classmethod
+    def encode_series_slow(cls, data):
+        sub_data = []
         enc_size = len(ExtendedData.enc_map)
-        for data in self.data:
-            sub_data = []
-            for value in data:
-                if value is None:
-                    sub_data.append('__')
-                elif value >= 0 and value <= self.max_value:
-                    first, second = divmod(int(value), enc_size)
-                    sub_data.append('%s%s' % (
-                        ExtendedData.enc_map[first],
-                        ExtendedData.enc_map[second]))
-                else:
-                    raise DataOutOfRangeException( \
-                        'Item #%i "%s" is out of range' % (data.index(value), \
-                        value))
-            encoded_data.append(''.join(sub_data))
-        return 'chd=e:' + ','.join(encoded_data)
+        for value in data:
+            if value is None:
+                sub_data.append('__')
+            elif value >= 0 and value <= cls.max_value:
+                first, second = divmod(int(value), enc_size)
+                sub_data.append('%s%s' % (
+                    ExtendedData.enc_map[first],
+                    ExtendedData.enc_map[second]))
+            else:
+                cls.out_of_range(data, data.index(value), value)
+        return ''.join(sub_data)
+
+    @classmethod
+    def encode_value(cls, value):
+        first, second = divmod(value, len(cls.enc_map))
+        return cls.enc_map[first] + cls.enc_map[second]
+
+    @staticmethod
+    def out_of_range(data, index, value):
+        raise DataOutOfRangeException( \
+            'Item #%i "%s" is out of range' % (index, value))
+
+
+SimpleData.codes = SimpleData.build_codes()
+ExtendedData.codes = ExtendedData.build_codes()
+
+
+# Series Classes
+# -----------------------------------------------------------------------------
+
+
+class CompactSeries(Sequence):
+    """A series of numbers stored in a typed array. Missing values are kept
+    in a bitmap instead of as None entries, but the series still reads like a
+    list with None in it.
+
+    Non-negative integers below 65536 are stored as unsigned shorts ('H'),
+    anything else as doubles ('d'), unless typecode is given.
+    """
+
+    def __init__(self, values=(), typecode=None):
+        values = list(values)
+        self.missing = None
+        index = -1
+        while True:
+            # list.index() finds the missing values without a Python loop
+            # over all of them.
+            try:
+                index = values.index(None, index + 1)
+            except ValueError:
+                break
+            if self.missing is None:
+                self.missing = bytearray((len(values) + 7) // 8)
+            self.missing[index >> 3] |= 1 << (index & 7)
+            values[index] = 0
+        if typecode is None:
+            try:
+                self.values = array('H', values)
+                return
+            except (TypeError, OverflowError):
+                typecode = 'd'
+        self.values = array(typecode, values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CompactSeries([self[a]
+                for a in range(*index.indices(len(self)))],
+                self.values.typecode)
+        value = self.values[index]
+        if index < 0:
+            index += len(self.values)
+        if self.is_missing(index):
+            return None
+        return value
+
+    def __iter__(self):
+        if not self.missing:
+            return iter(self.values)
+        return self._iter_with_missing()
+
+    def _iter_with_missing(self):
+        missing = self.missing
+        for index, value in enumerate(self.values):
+            if missing[index >> 3] & (1 << (index & 7)):
+                yield None
+            else:
+                yield value
+
+    def __repr__(self):
+        return 'CompactSeries(%r)' % list(self)
+
+    def is_missing(self, index):
+        return bool(self.missing and
+            self.missing[index >> 3] & (1 << (index & 7)))
+
+    def present(self):
+        """Returns the values which aren't missing."""
+        if not self.missing:
+            return self.values
+        return array(self.values.typecode,
+            [a for a in self if a is not None])
+
+    def append(self, value):
+        index = len(self.values)
+        if value is None and self.missing is None:
+            self.missing = bytearray(index // 8 + 1)
+        if self.missing is not None and len(self.missing) <= index >> 3:
+            self.missing.append(0)
+        if value is None:
+            self.missing[index >> 3] |= 1 << (index & 7)
+            value = 0
+        try:
+            self.values.append(value)
+        except (TypeError, OverflowError):
+            # Doesn't fit the current typecode any more.
+            self.values = array('d', self.values)
+            self.values.append(value)
+
+
+class RingSeries(Sequence):
+    """A series of the last capacity values pushed to it, oldest first.
+
+    The values are kept in a fixed size list which wraps around, so push()
+    doesn't move any of them. The minimum and maximum are tracked in
+    monotonic deques, which makes push() and range() O(1) amortised. The
+    encoders encode the one or two contiguous runs of the list given by
+    segments() separately, instead of putting the window in order first.
+    """
+
+    def __init__(self, capacity, values=()):
+        assert(capacity > 0)
+        self.capacity = capacity
+        self.buffer = [None] * capacity
+        self.start = 0
+        self.size = 0
+        # Count of values pushed so far, which numbers them for the deques.
+        self.pushed = 0
+        # (number, value) pairs of the values which can still become the
+        # minimum (or maximum) of the window, with the current one first.
+        self.minimums = deque()
+        self.maximums = deque()
+        for value in values:
+            self.push(value)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[a] for a in range(*index.indices(self.size))]
+        if index < 0:
+            index += self.size
+        if index < 0 or index >= self.size:
+            raise IndexError('RingSeries index out of range')
+        return self.buffer[(self.start + index) % self.capacity]
+
+    def __iter__(self):
+        for segment in self.segments():
+            for value in segment:
+                yield value
+
+    def __repr__(self):
+        return 'RingSeries(%i, %r)' % (self.capacity, list(self))
+
+    def push(self, value):
+        """Adds value to the end of the window, dropping the oldest value if
+        it is full."""
+        self.buffer[(self.start + self.size) % self.capacity] = value
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+        number = self.pushed
+        self.pushed += 1
+        oldest = self.pushed - self.size
+        for queue, keep in ((self.minimums, operator.lt),
+                (self.maximums, operator.gt)):
+            if queue and queue[0][0] < oldest:
+                queue.popleft()
+            if value is None:
+                continue
+            while queue and not keep(queue[-1][1], value):
+                queue.pop()
+            queue.append((number, value))
+
+    # So Chart.append_point() can push values.
+    append = push
+
+    def segments(self):
+        """Returns the window as a list of one or two lists, oldest values
+        first."""
+        end = self.start + self.size
+        if end <= self.capacity:
+            return [self.buffer[self.start:end]]
+        return [self.buffer[self.start:], self.buffer[:end - self.capacity]]
+
+    def range(self):
+        """Returns the (minimum, maximum) of the values in the window which
+        aren't None, or None if there are none."""
+        if not self.minimums:
+            return None
+        return self.minimums[0][1], self.maximums[0][1]
+
+
+# Downsampling
+# -----------------------------------------------------------------------------
+
+
+def _values(series):
+    """Returns series, or a list with None for masked values if it is a
+    NumPy array."""
+    arrays = _numpy_series(series)
+    if arrays is None:
+        return series
+    return [None if missing else value
+        for value, missing in zip(arrays[0].tolist(), arrays[1].tolist())]
+
+
+def downsample_lttb(data, max_points, x_data=None):
+    """Downsamples a series to at most max_points with the Largest Triangle
+    Three Buckets algorithm, which keeps the visual shape of the line.
+
+    x_data has the x values of an XY series, otherwise the index is used.
+    Returns an (x_data, data) pair of lists. The series is returned as it
+    is if it already fits. Otherwise each run between missing values is
+    downsampled on its own. Without x_data the runs and gaps between them
+    get points in proportion to their length, so the line keeps its place
+    across the chart. With x_data a single missing value (None in both
+    lists) is left between runs. A series with very many gaps can give
+    more than max_points.
+    """
+    spaced = x_data is None
+    if spaced:
+        x_data = range(len(data))
+    if len(data) <= max_points or max_points < 3:
+        return list(_values(x_data)), list(_values(data))
+
+    # Runs of (x, y) points, and the lengths of the gaps between them
+    segments = []
+    for x, y in zip(_values(x_data), _values(data)):
+        if x is None or y is None:
+            if segments and not isinstance(segments[-1], list):
+                segments[-1] += 1
+            else:
+                segments.append(1)
+        elif segments and isinstance(segments[-1], list):
+            segments[-1].append((x, y))
+        else:
+            segments.append([(x, y)])
+    if not spaced:
+        # Gaps at the ends aren't drawn, and the others take one point.
+        while segments and not isinstance(segments[0], list):
+            segments.pop(0)
+        while segments and not isinstance(segments[-1], list):
+            segments.pop()
+        segments = [a if isinstance(a, list) else 0 for a in segments]
+    size = sum([a if not isinstance(a, list) else len(a) for a in segments])
+    budget = max_points - segments.count(0)
+    sampled = []
+    for segment in segments:
+        if segment == 0:
+            sampled.append((None, None))
+            continue
+        length = segment if not isinstance(segment, list) else len(segment)
+        # Points are shared by length between what is left.
+        share = max(budget * length // size, 1)
+        if isinstance(segment, list):
+            sampled.extend(_lttb(segment, share))
+        else:
+            sampled.extend([(None, None)] * share)
+        budget -= share
+        size -= length
+    return [x for x, y in sampled], [y for x, y in sampled]
+
+
+def _lttb(points, max_points):
+    """Returns at most max_points of a list of (x, y) points with LTTB."""
+    size = len(points)
+    if max_points >= size:
+        return points
+    if max_points < 3:
+        return [points[0], points[-1]][:max_points]
+
+    # Both ends are always kept, and every other point is chosen from a
+    # bucket as the one making the largest triangle with the previous point
+    # and the average of the next bucket.
+    every = (size - 2) / (max_points - 2)
+    sampled = [points[0]]
+    previous = 0
+    for bucket in range(max_points - 2):
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, size)
+        next_points = points[end:next_end]
+        average_x = sum([x for x, y in next_points]) / len(next_points)
+        average_y = sum([y for x, y in next_points]) / len(next_points)
+
+        previous_x, previous_y = points[previous]
+        max_area = -1
+        for index in range(start, end):
+            x, y = points[index]
+            area = abs((previous_x - average_x) * (y - previous_y) -
+                (previous_x - x) * (average_y - previous_y))
+            if area > max_area:
+                max_area = area
+                chosen = index
+        sampled.append(points[chosen])
+        previous = chosen
+    sampled.append(points[-1])
+    return sampled
+
+
+class _M4Column(object):
+    """The first, last, minimum and maximum points seen in a pixel column,
+    as (index, x, y) tuples."""
+
+    def __init__(self, column):
+        self.column = column
+        self.first = None
+        # Index of the first missing value
+        self.gap = None
+
+    def add(self, point):
+        if self.first is None:
+            self.first = self.last = self.low = self.high = point
+            return
+        self.last = point
+        if point[2] < self.low[2]:
+            self.low = point
+        elif point[2] > self.high[2]:
+            self.high = point
+
+    def points(self):
+        """Returns the distinct points in index order."""
+        if self.first is None:
+            return []
+        points = set([self.first, self.last, self.low, self.high])
+        return sorted(points)
+
+    def slots(self, count=4):
+        """Returns exactly count points, four or five, so every column of an
+        evenly spaced series is the same width. The fifth is a gap where the
+        column has a missing value, and otherwise repeats the last point."""
+        gap = (None, None, None)
+        if self.first is None:
+            return [gap] * count
+        slots = [self.first] + sorted([self.low, self.high]) + [self.last]
+        if count == 5:
+            if self.gap is None:
+                slots.append(self.last)
+            else:
+                before = len([a for a in slots if a[0] < self.gap])
+                slots.insert(before, gap)
+        return slots
+
+
+def downsample_m4(data, columns, x_data=None, x_range=None):
+    """Downsamples a series to the first, last, minimum and maximum values
+    of each of columns pixel columns (M4 aggregation). The line drawn
+    through them covers the same pixels as the full series, so spikes are
+    never lost. Runs in a single pass over the data.
+
+    Without x_data the series is evenly spaced and every column gives four
+    values, so the result stays evenly spaced. If the series has missing
+    values every column gives five, with a gap in the columns having them.
+
+    With x_data, columns are worked out from the x values over x_range
+    (the x data range if not given) and only distinct points are kept.
+    Missing values become a gap in both series.
+
+    Returns an (x_data, data) pair of lists. Without x_data, the x values are
+    the indexes of the chosen values.
+    """
+    size = len(data)
+    if x_data is None and size <= columns * 4:
+        return list(range(size)), list(_values(data))
+    x_out = []
+    y_out = []
+
+    def flush(column):
+        if x_data is None:
+            points = column.slots(count)
+        else:
+            points = column.points()
+        for index, x, y in points:
+            x_out.append(x)
+            y_out.append(y)
+
+    if x_data is None:
+        data = _values(data)
+        count = 5 if None in data else 4
+        column = _M4Column(0)
+        for index, y in enumerate(data):
+            number = index * columns // size
+            if number != column.column:
+                flush(column)
+                column = _M4Column(number)
+            if y is None:
+                if column.gap is None:
+                    column.gap = index
+            else:
+                column.add((index, index, y))
+        flush(column)
+        return x_out, y_out
+
+    x_data = _values(x_data)
+    if x_range is None:
+        present = [x for x in x_data if x is not None]
+        if not present:
+            return [], []
+        x_range = (min(present), max(present))
+    lower, upper = x_range
+    scale = columns / ((upper - lower) or 1)
+    column = _M4Column(None)
+    for index, (x, y) in enumerate(zip(x_data, _values(data))):
+        if x is None or y is None:
+            flush(column)
+            column = _M4Column(None)
+            if y_out and y_out[-1] is not None:
+                x_out.append(None)
+                y_out.append(None)
+            continue
+        number = min(max(int((x - lower) * scale), 0), columns - 1)
+        if number != column.column:
+            flush(column)
+            column = _M4Column(number)
+        column.add((index, x, y))
+    flush(column)
+    return x_out, y_out
 
 
 # Axis Classes
@@ -293,9 +1277,16 @@ class Chart(object):
 
     width are height specify the dimensions of the image. title sets the title
     of the chart. legend requires a list that corresponds to datasets.
+
+    If compact_data is set, lists given to add_data() are stored as
+    CompactSeries, and scaling reuses one typed buffer per series instead of
+    building new lists.
     """
 
     BASE_URL = 'https://chart.googleapis.com/chart'
+    # Draws the image for download() instead of BASE_URL if set, see
+    # ChartRenderer.
+    renderer = None
     BACKGROUND = 'bg'
     CHART = 'c'
     ALPHA = 'a'
@@ -303,10 +1294,17 @@ class Chart(object):
     SOLID = 's'
     LINEAR_GRADIENT = 'lg'
     LINEAR_STRIPES = 'ls'
+    # Methods making the optional URL bits, in URL order. See url_fragment().
+    URL_FRAGMENTS = ('title_to_url', 'title_style_to_url', 'legend_to_url',
+        'legend_position_to_url', 'colours_to_url',
+        'colours_within_series_to_url', 'fill_to_url', 'axis_to_url',
+        'markers_to_url', 'line_styles_to_url', 'grid_to_url')
+    # Encodings considered by shortest_data_class()
+    ENCODING_CANDIDATES = (SimpleData, ExtendedData, TextData, ScaledTextData)
 
     def __init__(self, width, height, title=None, legend=None, colours=None,
             auto_scale=True, x_range=None, y_range=None,
-            colours_within_series=None):
+            colours_within_series=None, compact_data=False):
         if type(self) == Chart:
             raise AbstractClassException('This is an abstract class')
         assert(isinstance(width, int))
@@ -314,6 +1312,19 @@ class Chart(object):
         self.width = width
         self.height = height
         self.data = []
+        # (key, URL) of the last get_url_extension()
+        self._url = None
+        self._url_fragments = {}
+        self.compact_data = compact_data
+        self.clip_stats = {}
+        self._scale_buffers = {}
+        self._data_cache = {}
+        # Encoded series, only kept once append_point() is used.
+        self._encode_buffers = None
+        # Ranges and encoded series shared with other charts, see
+        # render_urls().
+        self._shared_ranges = None
+        self._shared_buffers = None
         self.set_title(title)
         self.set_title_style(None, None)
         self.set_legend(legend)
@@ -345,6 +1356,9 @@ class Chart(object):
         self.grid = None
         self.title_colour = None
         self.title_font_size = None
+        self.text_precision = 1
+        self.shortest_encoding = False
+        self._defer_data = False
 
     # URL generation
     # -------------------------------------------------------------------------
@@ -353,75 +1367,212 @@ class Chart(object):
         return self.BASE_URL + '?' + self.get_url_extension(data_class)
     
     def get_url_extension(self, data_class=None):
-        url_bits = self.get_url_bits(data_class=data_class)
-        return '&'.join(url_bits)
+        """Returns the URL without BASE_URL. It is remembered until a setter
+        or add_data() is called, or invalidate() after changing the chart
+        directly.
+        """
+        key = (data_class, self.auto_scale, _range_key(self.x_range),
+            _range_key(self.y_range), self.width, self.height)
+        if self._url is not None and self._url[0] == key:
+            return self._url[1]
+        url = '&'.join(self.get_url_bits(data_class=data_class))
+        self._url = (key, url)
+        return url
+
+    def iter_url_chunks(self, data_class=None):
+        """Yields the URL in pieces, with the encoded data yielded a series at
+        a time, so the whole URL is never built in memory.
+        """
+        yield self.BASE_URL + '?'
+        for chunk in self.iter_url_extension_chunks(data_class):
+            yield chunk
+
+    def iter_url_extension_chunks(self, data_class=None):
+        """Same as iter_url_chunks() without BASE_URL, e.g. for a POST body."""
+        if not data_class:
+            data_class = self.data_class_detection(self.data)
+        self._defer_data = True
+        try:
+            url_bits = self.get_url_bits(data_class=data_class)
+        finally:
+            self._defer_data = False
+        for index, bit in enumerate(url_bits):
+            if index:
+                yield '&'
+            if bit is _DEFERRED_DATA:
+                for chunk in self.iter_data_chunks(data_class):
+                    yield chunk
+                scaling = self.scaling_to_url(data_class)
+                if scaling:
+                    yield '&' + scaling
+            else:
+                yield bit
+
+    def write_url(self, fp, data_class=None):
+        """Writes the URL to fp, which needs a write() method accepting
+        strings, e.g. io.StringIO or a file opened in text mode. Returns the
+        length of the URL.
+        """
+        length = 0
+        for chunk in self.iter_url_chunks(data_class):
+            fp.write(chunk)
+            length += len(chunk)
+        return length
 
     def get_url_bits(self, data_class=None):
         url_bits = []
         # required arguments
         url_bits.append(self.type_to_url())
         url_bits.append('chs=%ix%i' % (self.width, self.height))
-        url_bits.append(self.data_to_url(data_class=data_class))
+        if self._defer_data:
+            # Stands for the data and its scaling_to_url().
+            url_bits.append(_DEFERRED_DATA)
+        else:
+            if not data_class:
+                data_class = self.data_class_detection(self.data)
+            url_bits.append(self.data_to_url(data_class=data_class))
+            scaling = self.scaling_to_url(data_class)
+            if scaling:
+                url_bits.append(scaling)
         # optional arguments
+        for fragment in Chart.URL_FRAGMENTS:
+            bit = self.url_fragment(fragment)
+            if bit:
+                url_bits.append(bit)
+        return url_bits
+
+    def url_fragment(self, fragment):
+        """Returns the URL bit made by the fragment method, e.g.
+        'title_to_url'. It is remembered until a setter changes it, see
+        changed().
+        """
+        try:
+            return self._url_fragments[fragment]
+        except KeyError:
+            bit = self._url_fragments[fragment] = getattr(self, fragment)()
+            return bit
+
+    def changed(self, fragment=None):
+        """Called by the setters so the remembered URL, and the given
+        fragment of it, are rebuilt on the next get_url()."""
+        self._url = None
+        if fragment is not None:
+            self._url_fragments.pop(fragment, None)
+
+    def title_to_url(self):
         if self.title:
-            url_bits.append('chtt=%s' % self.title)
+            return 'chtt=%s' % self.title
+
+    def title_style_to_url(self):
         if self.title_colour and self.title_font_size:
-            url_bits.append('chts=%s,%s' % (self.title_colour, \
-                self.title_font_size))
+            return 'chts=%s,%s' % (self.title_colour, self.title_font_size)
+
+    def legend_to_url(self):
         if self.legend:
-            url_bits.append('chdl=%s' % '%7c'.join(self.legend))
+            return 'chdl=%s' % '%7c'.join(self.legend)
+
+    def legend_position_to_url(self):
         if self.legend_position:
-            url_bits.append('chdlp=%s' % (self.legend_position))
+            return 'chdlp=%s' % (self.legend_position)
+
+    def colours_to_url(self):
         if self.colours:
-            url_bits.append('chco=%s' % ','.join(self.colours))
+            return 'chco=%s' % ','.join(self.colours)
+
+    def colours_within_series_to_url(self):
         if self.colours_within_series:
-            url_bits.append('chco=%s' % '%7c'.join(self.colours_within_series))
-        ret = self.fill_to_url()
-        if ret:
-            url_bits.append(ret)
-        ret = self.axis_to_url()
-        if ret:
-            url_bits.append(ret)                    
-        if self.markers:
-            url_bits.append(self.markers_to_url())        
-        if self.line_styles:
-            style = []
-            for index in range(max(self.line_styles) + 1):
-                if index in self.line_styles:
-                    values = self.line_styles[index]
-                else:
-                    values = ('1', )
-                style.append(','.join(values))
-            url_bits.append('chls=%s' % '%7c'.join(style))
+            return 'chco=%s' % '%7c'.join(self.colours_within_series)
+
+    def line_styles_to_url(self):
+        if not self.line_styles:
+            return
+        style = []
+        for index in range(max(self.line_styles) + 1):
+            if index in self.line_styles:
+                values = self.line_styles[index]
+            else:
+                values = ('1', )
+            style.append(','.join(values))
+        return 'chls=%s' % '%7c'.join(style)
+
+    def grid_to_url(self):
         if self.grid:
-            url_bits.append('chg=%s' % self.grid)
-        return url_bits
+            return 'chg=%s' % self.grid
 
     # Downloading
     # -------------------------------------------------------------------------
 
-    def download(self, file_name=False, use_post=True):
+    def request(self, use_post=True):
+        """Returns the (url, data) of the request download() makes, where
+        data is the POST body, or None."""
         if use_post:
-            opener = urlopen(self.BASE_URL, self.get_url_extension().encode('utf-8'))
+            return self.BASE_URL, self.get_url_extension().encode('utf-8')
+        return self.get_url(), None
+
+    def download(self, file_name=False, use_post=True, timeout=None,
+            client=None, cache=None, coalesce=None, max_size=None,
+            renderer=None, cancel=None):
+        """Downloads the chart image to file_name, or returns it if no file
+        name is given. The image is streamed to a temporary file renamed to
+        file_name when it's complete. The download fails with socket.timeout
+        if it takes more than timeout seconds, or ResponseTooLargeException
+        if the image is larger than max_size bytes. If cancel is given, a
+        threading.Event, the download stops with DownloadCancelledException
+        once it is set.
+
+        If a ChartClient is given, its connections are used instead of
+        opening a new one. If an ImageCache is given, the image is taken
+        from it when it's there, and put in it when it has to be downloaded.
+        If it has expired, the server is asked for it only if it changed.
+        If a SingleFlight is given as coalesce, a download of the same image
+        already in progress in another thread is waited for instead of
+        being made again. Such a shared download isn't cancelled, as other
+        threads may be waiting for it.
+
+        If a ChartRenderer is given, or set as self.renderer, the image is
+        drawn by it instead and the other arguments aren't used.
+        """
+        renderer = renderer or self.renderer
+        if renderer is not None:
+            image = renderer.render(self)
+            if not file_name:
+                return image
+            _write_file(file_name, lambda fp: fp.write(image))
+            return
+        url, data = self.request(use_post)
+        if cache is None and coalesce is None:
+            return _fetch_image(url, data, timeout, client, file_name,
+                max_size, cancel)
+        key = ImageCache.key(url, data)
+        if coalesce is not None:
+            cancel = None
+        def fetch():
+            if cache is None:
+                return _fetch_image(url, data, timeout, client,
+                    max_size=max_size, cancel=cancel)
+            image = cache.get(key)
+            if image is None:
+                image = _fetch_cached(cache, key, url, data, timeout, client,
+                    max_size, cancel)
+            return image
+        if coalesce is not None:
+            image = coalesce.do(key, fetch)
         else:
-            opener = urlopen(self.get_url())
-
-        if opener.headers['content-type'] != 'image/png':
-            raise BadContentTypeException('Server responded with a ' \
-                'content-type of %s' % opener.headers['content-type'])
+            image = fetch()
         if file_name:
-            open(file_name, 'wb').write(opener.read())
+            _write_file(file_name, lambda fp: fp.write(image))
         else:
-            return opener.read()
+            return image
 
     # Simple settings
     # -------------------------------------------------------------------------
 
     def set_title(self, title):
         if title:
-            self.title = quote(title)
+            self.title = _quote(title)
         else:
             self.title = None
+        self.changed('title_to_url')
 
     def set_title_style(self, colour=None, font_size=None):
         if not colour is None:
@@ -430,15 +1581,23 @@ class Chart(object):
             return
         self.title_colour = colour or '333333'
         self.title_font_size = font_size or 13.5
+        self.changed('title_style_to_url')
 
     def set_legend(self, legend):
         """legend needs to be a list, tuple or None"""
         assert(isinstance(legend, list) or isinstance(legend, tuple) or
             legend is None)
         if legend:
-            self.legend = [quote(a) for a in legend]
+            self.legend = [_quote(a) for a in legend]
         else:
             self.legend = None
+        self.changed('legend_to_url')
+
+    def set_text_precision(self, precision):
+        """Sets the number of decimal places sent with ScaledTextData."""
+        assert(isinstance(precision, int) and precision >= 0)
+        self.text_precision = precision
+        self.changed()
 
     def set_legend_position(self, legend_position):
         """Sets legend position. Default is 'r'.
@@ -451,9 +1610,10 @@ class Chart(object):
         l - To the left of the chart, legend entries in a vertical column.
         """
         if legend_position:
-            self.legend_position = quote(legend_position)
-        else:    
+            self.legend_position = _quote(legend_position)
+        else:
             self.legend_position = None
+        self.changed('legend_position_to_url')
 
     # Chart colours
     # -------------------------------------------------------------------------
@@ -467,6 +1627,7 @@ class Chart(object):
             for col in colours:
                 _check_colour(col)
         self.colours = colours
+        self.changed('colours_to_url')
 
     def set_colours_within_series(self, colours):
         # colours needs to be a list, tuple or None
@@ -476,7 +1637,8 @@ class Chart(object):
         if colours:
             for col in colours:
                 _check_colour(col)
-        self.colours_within_series = colours        
+        self.colours_within_series = colours
+        self.changed('colours_within_series_to_url')
 
     # Background/Chart colours
     # -------------------------------------------------------------------------
@@ -486,6 +1648,7 @@ class Chart(object):
         _check_colour(colour)
         self.fill_area[area] = colour
         self.fill_types[area] = Chart.SOLID
+        self.changed('fill_to_url')
 
     def _check_fill_linear(self, angle, *args):
         assert(isinstance(args, list) or isinstance(args, tuple))
@@ -505,12 +1668,14 @@ class Chart(object):
         args = self._check_fill_linear(angle, *args)
         self.fill_types[area] = Chart.LINEAR_GRADIENT
         self.fill_area[area] = ','.join([str(angle)] + args)
+        self.changed('fill_to_url')
 
     def fill_linear_stripes(self, area, angle, *args):
         assert(area in Chart.VALID_SOLID_FILL_TYPES)
         args = self._check_fill_linear(angle, *args)
         self.fill_types[area] = Chart.LINEAR_STRIPES
         self.fill_area[area] = ','.join([str(angle)] + args)
+        self.changed('fill_to_url')
 
     def fill_to_url(self):
         areas = []
@@ -529,6 +1694,8 @@ class Chart(object):
         resolution (http://code.google.com/apis/chart/#chart_data).
         """
         assert(isinstance(data, list) or isinstance(data, tuple))
+        if self.shortest_encoding and self.auto_scale and data:
+            return self.shortest_data_class()
         if not isinstance(self, (LineChart, BarChart, ScatterChart)):
             # From the link above:
             #   Simple encoding is suitable for all other types of chart
@@ -543,42 +1710,171 @@ class Chart(object):
         else:
             return ExtendedData
 
-    def _filter_none(self, data):
-        return [r for r in data if r is not None]
+    def set_shortest_encoding(self, shortest=True):
+        """If set, data_class_detection() picks whichever encoding gives the
+        shortest URL while still having at least one level per pixel. See
+        shortest_data_class().
+        """
+        self.shortest_encoding = shortest
+        self.changed()
+
+    def required_data_levels(self):
+        """Returns how many distinct encoded values are needed to give one
+        level per pixel, or 0 for charts which aren't plotted on axes.
+        """
+        if not isinstance(self, (LineChart, BarChart, ScatterChart)):
+            return 0
+        levels = 0
+        for type, dataset in self.annotated_data():
+            if type == 'x':
+                levels = max(levels, self.width)
+            else:
+                levels = max(levels, self.height)
+        return levels
+
+    def data_levels(self, data_class, scale_ranges=None):
+        """Returns how many distinct values data_class can encode."""
+        if issubclass(data_class, ScaledTextData):
+            if scale_ranges is None:
+                scale_ranges = self.scale_ranges(self.x_range, self.y_range)
+            step = 10 ** self.text_precision
+            return min([int((upper - lower) * step) + 1
+                for lower, upper in scale_ranges] or [0])
+        if issubclass(data_class, TextData):
+            # One decimal place
+            return data_class.max_value * 10 + 1
+        return data_class.max_value + 1
+
+    def estimate_data_length(self, data_class, scale_ranges=None):
+        """Estimates the length of data_to_url(data_class), and of any
+        scaling_to_url() sent with it, without encoding the data. The length
+        of text encoded values is estimated from a sample of each series.
+        """
+        if scale_ranges is None:
+            scale_ranges = self.scale_ranges(self.x_range, self.y_range)
+        datasets = [dataset for type, dataset in self.annotated_data()]
+        length = len('chd=e:') + len(data_class.series_separator) * \
+            max(len(datasets) - 1, 0)
+        if issubclass(data_class, ScaledTextData):
+            encoder = data_class([], scale_ranges, self.text_precision)
+            length += len('&' + (encoder.ranges_to_url() or ''))
+        for dataset, scale_range in zip(datasets, scale_ranges):
+            size = len(dataset)
+            if not size:
+                continue
+            if not issubclass(data_class, TextData):
+                length += len(data_class.codes[None]) * size
+                continue
+            texts = []
+            for value in _sample_series(dataset):
+                if issubclass(data_class, ScaledTextData):
+                    texts.append(encoder.format_value(value))
+                elif value is None:
+                    texts.append('-1')
+                else:
+                    if self.auto_scale:
+                        value = data_class.clip_value(
+                            data_class.float_scale_value(value, scale_range))
+                    texts.append('%.1f' % value)
+            per_value = sum(map(len, texts)) / len(texts)
+            # Values plus the commas between them
+            length += int(round(per_value * size)) + size - 1
+        return length
+
+    def shortest_data_class(self):
+        """Returns the encoding giving the shortest URL for this chart's data
+        which still has at least required_data_levels() levels. If none have
+        enough, the one with the most levels is returned.
+        """
+        scale_ranges = self.scale_ranges(self.x_range, self.y_range)
+        required = self.required_data_levels()
+        best = None
+        for data_class in self.ENCODING_CANDIDATES:
+            if self.data_levels(data_class, scale_ranges) < required:
+                continue
+            length = self.estimate_data_length(data_class, scale_ranges)
+            if best is None or length < best[0]:
+                best = (length, data_class)
+        if best is None:
+            return max(self.ENCODING_CANDIDATES,
+                key=lambda a: self.data_levels(a, scale_ranges))
+        return best[1]
+
+    def invalidate(self):
+        """Forgets the URL, data ranges and scaled data remembered from
+        earlier calls. The setters and add_data() take care of this, but it
+        needs to be called after changing self.data, one of its series or
+        any other attribute directly.
+        """
+        self._data_cache.clear()
+        self._scale_buffers.clear()
+        if self._encode_buffers is not None:
+            self._encode_buffers.clear()
+        self._url = None
+        self._url_fragments.clear()
+
+    def _bare_copy(self):
+        """Returns a shallow copy of the chart with no data and nothing
+        remembered from earlier calls."""
+        chart = copy.copy(self)
+        chart.data = []
+        chart.clip_stats = {}
+        chart._url = None
+        chart._url_fragments = {}
+        chart._data_cache = {}
+        chart._encode_buffers = None
+        chart._scale_buffers = {}
+        return chart
+
+    def _data_range(self, axis_type):
+        key = ('range', axis_type)
+        if key in self._data_cache:
+            return self._data_cache[key]
+        ranges = [self.series_range(s) for type, s in self.annotated_data()
+            if type == axis_type]
+        ranges = [a for a in ranges if a is not None]
+        data_range = None
+        if ranges:
+            data_range = (min([a[0] for a in ranges]),
+                max([a[1] for a in ranges]))
+        self._data_cache[key] = data_range
+        return data_range
+
+    def series_range(self, series):
+        """Returns the (minimum, maximum) of a series, or None if it has no
+        values. During render_urls() the range of a series is only worked
+        out once for all the charts using it."""
+        shared = self._shared_ranges
+        if shared is None or isinstance(series, RingSeries):
+            return _series_range(series)
+        key = id(series)
+        if key in shared and shared[key][0] is series:
+            return shared[key][1]
+        if len(shared) >= 256:
+            shared.clear()
+        series_range = _series_range(series)
+        # The series is kept so its id isn't reused while it is in here.
+        shared[key] = (series, series_range)
+        return series_range
 
     def data_x_range(self):
         """Return a 2-tuple giving the minimum and maximum x-axis
         data range.
         """
-        try:
-            lower = min([min(self._filter_none(s))
-                         for type, s in self.annotated_data()
-                         if type == 'x'])
-            upper = max([max(self._filter_none(s))
-                         for type, s in self.annotated_data()
-                         if type == 'x'])
-            return (lower, upper)
-        except ValueError:
-            return None     # no x-axis datasets
+        return self._data_range('x')
 
     def data_y_range(self):
         """Return a 2-tuple giving the minimum and maximum y-axis
         data range.
         """
-        try:
-            lower = min([min(self._filter_none(s))
-                         for type, s in self.annotated_data()
-                         if type == 'y'])
-            upper = max([max(self._filter_none(s)) + 1
-                         for type, s in self.annotated_data()
-                         if type == 'y'])
-            return (lower, upper)
-        except ValueError:
-            return None     # no y-axis datasets
+        data_range = self._data_range('y')
+        if data_range is None:
+            return None
+        return (data_range[0], data_range[1] + 1)
 
-    def scaled_data(self, data_class, x_range=None, y_range=None):
-        """Scale `self.data` as appropriate for the given data encoding
-        (data_class) and return it.
+    def scale_ranges(self, x_range=None, y_range=None):
+        """Return the (lower, upper) scaling range of each dataset, in the
+        same order as annotated_data().
 
         An optional `y_range` -- a 2-tuple (lower, upper) -- can be
         given to specify the y-axis bounds. If not given, the range is
@@ -590,8 +1886,6 @@ class Chart(object):
         Ditto for `x_range`. Note that some chart types don't have x-axis
         data.
         """
-        self.scaled_data_class = data_class
-
         # Determine the x-axis range for scaling.
         if x_range is None:
             x_range = self.data_x_range()
@@ -606,38 +1900,171 @@ class Chart(object):
                 y_range = (y_range[0], y_range[1])
         self.scaled_y_range = y_range
 
-        scaled_data = []
+        scale_ranges = []
         for type, dataset in self.annotated_data():
             if type == 'x':
-                scale_range = x_range
+                scale_ranges.append(x_range)
             elif type == 'y':
-                scale_range = y_range
+                scale_ranges.append(y_range)
             elif type == 'marker-size':
-                scale_range = (0, max(dataset))
-            scaled_dataset = []
-            for v in dataset:
-                if v is None:
-                    scaled_dataset.append(None)
-                else:
-                    scaled_dataset.append(
-                        data_class.scale_value(v, scale_range))
+                scale_ranges.append((0, max(dataset)))
+        return scale_ranges
+
+    def scaled_data(self, data_class, x_range=None, y_range=None):
+        """Scale `self.data` as appropriate for the given data encoding
+        (data_class) and return it. See scale_ranges() for how the scaling
+        ranges are worked out.
+
+        The result is remembered until the data changes (see invalidate()),
+        so it shouldn't be modified. A compact series (see compact_data) is
+        scaled into the same buffer each time, so its result only stays the
+        same until scaled_data() is called with another encoding or range.
+        """
+        self.scaled_data_class = data_class
+        key = ('scaled', data_class, _range_key(x_range), _range_key(y_range))
+        if key in self._data_cache:
+            scaled_data, self.scaled_x_range, self.scaled_y_range, \
+                clip_stats = self._data_cache[key]
+            self.report_clipping(clip_stats)
+            return scaled_data
+        scale_ranges = self.scale_ranges(x_range, y_range)
+
+        scaled_data = []
+        clip_stats = {}
+        reused = False
+        for index, (type, dataset) in enumerate(self.annotated_data()):
+            scale_range = scale_ranges[index]
+            clips = []
+            if _numpy_series(dataset) is not None:
+                scaled_dataset = data_class.scale_array(dataset, scale_range,
+                    clips)
+            elif isinstance(dataset, CompactSeries):
+                scaled_dataset = data_class.scale_compact(dataset,
+                    scale_range, self._scale_buffers.get(index), clips)
+                self._scale_buffers[index] = scaled_dataset
+                reused = True
+            else:
+                scaled_dataset = []
+                for i, v in enumerate(dataset):
+                    if v is None:
+                        scaled_dataset.append(None)
+                        continue
+                    scaled = data_class.unclipped_scale_value(v, scale_range)
+                    clipped = data_class.clip_value(scaled)
+                    if clipped != scaled:
+                        clips.append((i, v))
+                    scaled_dataset.append(clipped)
+            if clips:
+                clip_stats[index] = ClipStats(scale_range, clips)
             scaled_data.append(scaled_dataset)
+        if reused:
+            # Other remembered results share the buffers just overwritten.
+            for other in list(self._data_cache):
+                if other[0] == 'scaled' and other[1] is not ChartRenderer:
+                    del self._data_cache[other]
+        self._data_cache[key] = (scaled_data, self.scaled_x_range,
+            self.scaled_y_range, clip_stats)
+        self.report_clipping(clip_stats)
         return scaled_data
 
+    def report_clipping(self, clip_stats):
+        """Keeps clip_stats for clip_report() and gives a single warning if
+        any values were clipped."""
+        self.clip_stats = clip_stats
+        if clip_stats:
+            warnings.warn('%i of your data points have been clipped because '
+                'they are out of range. See clip_report() for details.' %
+                sum([a.count for a in clip_stats.values()]))
+
+    def clip_report(self):
+        """Returns a dict of the ClipStats of each series which had values
+        clipped when the data was last scaled, keyed by series index. It is
+        empty if nothing was clipped.
+        """
+        return self.clip_stats
+
     def add_data(self, data):
+        if self.compact_data and isinstance(data, (list, tuple)):
+            data = CompactSeries(data)
         self.data.append(data)
+        self.invalidate()
         return len(self.data) - 1  # return the "index" of the data set
 
+    def append_point(self, series_index, value):
+        """Appends value to the series at series_index, as returned by
+        add_data().
+
+        Unlike changing the series and calling invalidate(), the remembered
+        data ranges are updated with the new value and the next URL only
+        encodes the values appended since the last one. A series is only
+        encoded in full again if its scaling range changes, e.g. when it is
+        auto scaled and value is outside the current range. The encoded
+        series are only kept from the first call, so the URL after it is
+        encoded in full.
+        """
+        if self._encode_buffers is None:
+            self._encode_buffers = {}
+        series = self.data[series_index]
+        if not hasattr(series, 'append'):
+            # Tuples and NumPy arrays
+            series = self.data[series_index] = list(_values(series))
+        series.append(value)
+        for index, (axis_type, dataset) in enumerate(self.annotated_data()):
+            if index == series_index:
+                break
+        key = ('range', axis_type)
+        if isinstance(series, RingSeries):
+            # Values drop out of the window, so the range can shrink too.
+            self._data_cache.pop(key, None)
+        elif value is not None and key in self._data_cache:
+            data_range = self._data_cache[key]
+            if data_range is not None:
+                value = (min(data_range[0], value), max(data_range[1], value))
+            else:
+                value = (value, value)
+            self._data_cache[key] = value
+        for key in list(self._data_cache):
+            if key[0] == 'scaled':
+                del self._data_cache[key]
+        self._url = None
+
     def data_to_url(self, data_class=None):
+        return ''.join(self.iter_data_chunks(data_class))
+
+    def iter_data_chunks(self, data_class=None):
         if not data_class:
             data_class = self.data_class_detection(self.data)
         if not issubclass(data_class, Data):
             raise UnknownDataTypeException()
-        if self.auto_scale:
-            data = self.scaled_data(data_class, self.x_range, self.y_range)
-        else:
-            data = self.data
-        return repr(data_class(data))
+        buffers = self._encode_buffers
+        if self._shared_buffers is not None:
+            buffers = self._shared_buffers
+        if buffers is not None:
+            buffers = buffers.setdefault(
+                (data_class, self.auto_scale, self.text_precision), {})
+        if issubclass(data_class, ScaledTextData):
+            # The server scales the data.
+            self.scaled_data_class = data_class
+            return data_class(self.data, self.scale_ranges(self.x_range,
+                self.y_range), self.text_precision, buffers).iter_chunks()
+        if not self.auto_scale:
+            return data_class(self.data, buffers=buffers).iter_chunks()
+        # Scaling is done while encoding, so the scaled data isn't stored.
+        self.scaled_data_class = data_class
+        return self._iter_scaled_chunks(data_class(self.data,
+            self.scale_ranges(self.x_range, self.y_range), buffers))
+
+    def _iter_scaled_chunks(self, data):
+        for chunk in data.iter_chunks():
+            yield chunk
+        self.report_clipping(data.clip_stats)
+
+    def scaling_to_url(self, data_class):
+        """Returns the chds parameter sent with the data when data_class is
+        ScaledTextData, so the server scales it, and otherwise None."""
+        if issubclass(data_class, ScaledTextData):
+            return data_class([], self.scale_ranges(self.x_range,
+                self.y_range), self.text_precision).ranges_to_url()
 
     def annotated_data(self):
         for dataset in self.data:
@@ -648,10 +2075,11 @@ class Chart(object):
 
     def set_axis_labels(self, axis_type, values):
         assert(axis_type in Axis.TYPES)
-        values = [quote(str(a)) for a in values]
+        values = [_quote(str(a)) for a in values]
         axis_index = len(self.axis)
         axis = LabelAxis(axis_index, axis_type, values)
         self.axis.append(axis)
+        self.changed('axis_to_url')
         return axis_index
 
     def set_axis_range(self, axis_type, low, high):
@@ -659,6 +2087,7 @@ class Chart(object):
         axis_index = len(self.axis)
         axis = RangeAxis(axis_index, axis_type, low, high)
         self.axis.append(axis)
+        self.changed('axis_to_url')
         return axis_index
 
     def set_axis_positions(self, axis_index, positions):
@@ -667,6 +2096,7 @@ class Chart(object):
         except IndexError:
             raise InvalidParametersException('Axis index %i has not been ' \
                 'created' % axis)
+        self.changed('axis_to_url')
 
     def set_axis_style(self, axis_index, colour, font_size=None, \
             alignment=None):
@@ -675,6 +2105,7 @@ class Chart(object):
         except IndexError:
             raise InvalidParametersException('Axis index %i has not been ' \
                 'created' % axis)
+        self.changed('axis_to_url')
 
     def axis_to_url(self):
         available_axis = []
@@ -710,34 +2141,39 @@ class Chart(object):
     # Markers, Ranges and Fill area (chm)
     # -------------------------------------------------------------------------
 
-    def markers_to_url(self):        
-        return 'chm=%s' % '%7c'.join([','.join(a) for a in self.markers])
+    def markers_to_url(self):
+        if self.markers:
+            return 'chm=%s' % '%7c'.join([','.join(a) for a in self.markers])
+
+    def _add_marker(self, marker):
+        self.markers.append(marker)
+        self.changed('markers_to_url')
 
     def add_marker(self, index, point, marker_type, colour, size, priority=0):
-        self.markers.append((marker_type, colour, str(index), str(point), \
+        self._add_marker((marker_type, colour, str(index), str(point), \
             str(size), str(priority)))
 
     def add_horizontal_range(self, colour, start, stop):
-        self.markers.append(('r', colour, '0', str(start), str(stop)))
+        self._add_marker(('r', colour, '0', str(start), str(stop)))
 
     def add_data_line(self, colour, data_set, size, priority=0):
-        self.markers.append(('D', colour, str(data_set), '0', str(size), \
+        self._add_marker(('D', colour, str(data_set), '0', str(size), \
             str(priority)))
 
     def add_marker_text(self, string, colour, data_set, data_point, size, \
             priority=0):
-        self.markers.append((str(string), colour, str(data_set), \
-            str(data_point), str(size), str(priority)))        
+        self._add_marker((str(string), colour, str(data_set), \
+            str(data_point), str(size), str(priority)))
 
     def add_vertical_range(self, colour, start, stop):
-        self.markers.append(('R', colour, '0', str(start), str(stop)))
+        self._add_marker(('R', colour, '0', str(start), str(stop)))
 
     def add_fill_range(self, colour, index_start, index_end):
-        self.markers.append(('b', colour, str(index_start), str(index_end), \
+        self._add_marker(('b', colour, str(index_start), str(index_end), \
             '1'))
 
     def add_fill_simple(self, colour):
-        self.markers.append(('B', colour, '1', '1', '1'))
+        self._add_marker(('B', colour, '1', '1', '1'))
 
     # Line styles
     # -------------------------------------------------------------------------
@@ -750,6 +2186,7 @@ class Chart(object):
             value.append(str(line_segment))
             value.append(str(blank_segment))
         self.line_styles[index] = value
+        self.changed('line_styles_to_url')
 
     # Grid
     # -------------------------------------------------------------------------
@@ -758,6 +2195,7 @@ class Chart(object):
             blank_segment=0):
         self.grid = '%s,%s,%s,%s' % (x_step, y_step, line_segment, \
             blank_segment)
+        self.changed('grid_to_url')
 
 
 class ScatterChart(Chart):
@@ -776,10 +2214,57 @@ class ScatterChart(Chart):
 
 class LineChart(Chart):
 
+    LTTB = 'lttb'
+    M4 = 'm4'
+
     def __init__(self, *args, **kwargs):
         if type(self) == LineChart:
             raise AbstractClassException('This is an abstract class')
         Chart.__init__(self, *args, **kwargs)
+        self.downsampling = None
+
+    def set_downsampling(self, method):
+        """Downsample data given to add_data() with method, or None to turn
+        it off. Unless add_data() is given max_points, series are reduced to:
+
+        LineChart.LTTB - one point per pixel column (downsample_lttb()).
+        LineChart.M4 - four points per pixel column, the first, last,
+            minimum and maximum (downsample_m4()), or five if an evenly
+            spaced series has missing values.
+        """
+        assert(method in (None, LineChart.LTTB, LineChart.M4))
+        self.downsampling = method
+        self.changed()
+
+    def downsample(self, data, max_points, x_data=None):
+        """Returns an (x_data, data) pair, downsampled to max_points with the
+        set_downsampling() method, or LTTB if there isn't one."""
+        if self.downsampling == LineChart.M4:
+            per_column = 4
+            if x_data is None and None in _values(data):
+                per_column = 5
+            return downsample_m4(data, max(1, max_points // per_column),
+                x_data, self.x_range)
+        return downsample_lttb(data, max_points, x_data)
+
+    def _max_points(self, max_points, data, x_data=None):
+        if max_points is None and self.downsampling == LineChart.M4:
+            # One column per pixel, with room for a gap in each
+            if x_data is None and None in _values(data):
+                return self.width * 5
+            return self.width * 4
+        if max_points is None and self.downsampling:
+            return self.width
+        return max_points
+
+    def add_data(self, data, max_points=None):
+        """Adds a series. It is downsampled if max_points is given, or if
+        set_downsampling() has been called.
+        """
+        max_points = self._max_points(max_points, data)
+        if max_points is not None:
+            data = self.downsample(data, max_points)[1]
+        return Chart.add_data(self, data)
 
 
 class SimpleLineChart(LineChart):
@@ -798,12 +2283,31 @@ class SparkLineChart(SimpleLineChart):
     def type_to_url(self):
         return 'cht=ls'
 
+    def add_window(self, capacity, data=()):
+        """Adds a RingSeries of the last capacity values of data. Values
+        given to append_point() for it push the oldest ones out.
+        """
+        return Chart.add_data(self, RingSeries(capacity, data))
+
 
 class XYLineChart(LineChart):
 
     def type_to_url(self):
         return 'cht=lxy'
 
+    def add_data(self, data, max_points=None):
+        """Adds a series of x values, or of y values for the previous x
+        series. Downsampling is done when the y values are added, so the
+        x and y series stay paired.
+        """
+        if len(self.data) % 2 == 0:
+            return Chart.add_data(self, data)
+        max_points = self._max_points(max_points, data, self.data[-1])
+        if max_points is not None:
+            x_data, data = self.downsample(data, max_points, self.data.pop())
+            Chart.add_data(self, x_data)
+        return Chart.add_data(self, data)
+
     def annotated_data(self):
         # Datasets alternate between x-axis, y-axis.
         for i, dataset in enumerate(self.data):
@@ -824,9 +2328,11 @@ class BarChart(Chart):
 
     def set_bar_width(self, bar_width):
         self.bar_width = bar_width
+        self.changed()
 
     def set_zero_line(self, index, zero_line):
         self.zero_lines[index] = zero_line
+        self.changed()
 
     def get_url_bits(self, data_class=None, skip_chbh=False):
         url_bits = Chart.get_url_bits(self, data_class=data_class)
@@ -871,10 +2377,12 @@ class GroupedBarChart(BarChart):
     def set_bar_spacing(self, spacing):
         """Set spacing between bars in a group."""
         self.bar_spacing = spacing
+        self.changed()
 
     def set_group_spacing(self, spacing):
         """Set spacing between groups of bars."""
         self.group_spacing = spacing
+        self.changed()
 
     def get_url_bits(self, data_class=None):
         # Skip 'BarChart.get_url_bits' and call Chart directly so the parent
@@ -928,7 +2436,8 @@ class PieChart(Chart):
                 (self.__class__.__name__))
 
     def set_pie_labels(self, labels):
-        self.pie_labels = [quote(a) for a in labels]
+        self.pie_labels = [_quote(a) for a in labels]
+        self.changed()
 
     def get_url_bits(self, data_class=None):
         url_bits = Chart.get_url_bits(self, data_class=data_class)
@@ -942,10 +2451,10 @@ class PieChart(Chart):
         for dataset in self.data:
             yield ('x', dataset)
 
-    def scaled_data(self, data_class, x_range=None, y_range=None):
+    def scale_ranges(self, x_range=None, y_range=None):
         if not x_range:
             x_range = [0, sum(self.data[0])]
-        return Chart.scaled_data(self, data_class, x_range, self.y_range)
+        return Chart.scale_ranges(self, x_range, self.y_range)
 
 
 class PieChart2D(PieChart):
@@ -1037,6 +2546,7 @@ class MapChart(Chart):
                 raise UnknownCountryCodeException(cc)
             
         self.codes = codemap
+        self.changed()
 
     def set_geo_area(self, area):
         '''Sets the geo area for the map.
@@ -1052,6 +2562,7 @@ class MapChart(Chart):
         
         if area in self.__areas:
             self.geo_area = area
+            self.changed()
         else:
             raise UnknownChartType('Unknown chart type for maps: %s' %area)
 
@@ -1101,6 +2612,9 @@ class QRChart(Chart):
             raise NoDataGivenException()
         return 'chl=%s' % quote(self.data[0])
 
+    def iter_data_chunks(self, data_class=None):
+        yield self.data_to_url(data_class)
+
     def get_url_bits(self, data_class=None):
         url_bits = Chart.get_url_bits(self, data_class=data_class)
         if self.encoding:
@@ -1111,14 +2625,19 @@ class QRChart(Chart):
 
     def set_encoding(self, encoding):
         self.encoding = encoding
+        self.changed()
 
     def set_ec(self, level, margin):
         self.ec_level = level
         self.margin = margin
+        self.changed()
 
 
 class ChartGrammar(object):
 
+    # Remembered by get_possible_chart_types()
+    chart_types = None
+
     def __init__(self):
         self.grammar = None
         self.chart = None
@@ -1140,9 +2659,12 @@ class ChartGrammar(object):
 
     def parse_data(self, data):
         self.chart.data = data
+        self.chart.invalidate()
 
     @staticmethod
     def get_possible_chart_types():
+        if ChartGrammar.chart_types is not None:
+            return list(ChartGrammar.chart_types)
         possible_charts = []
         for cls_name in list(globals().keys()):
             if not cls_name.endswith('Chart'):
@@ -1156,7 +2678,8 @@ class ChartGrammar(object):
                 continue
             # Strip off "Class"
             possible_charts.append(cls_name[:-5])
-        return possible_charts
+        ChartGrammar.chart_types = possible_charts
+        return list(possible_charts)
 
     def create_chart_instance(self, grammar=None):
         if not grammar:
@@ -1181,3 +2704,1978 @@ class ChartGrammar(object):
     def download(self):
         pass
 
+
+# Batches
+# -----------------------------------------------------------------------------
+
+
+class ChartTemplate(object):
+    """Makes URLs for charts which only differ in their data.
+
+    Everything but the data is taken from chart and turned into the URL text
+    before and after the data once, when the template is made. url_for()
+    then only scales and encodes the data. The chart is copied, so changing
+    it afterwards doesn't change the template.
+    """
+
+    def __init__(self, chart, data_class=None):
+        self.chart = chart._bare_copy()
+        self.data_class = data_class
+        self.chart._defer_data = True
+        try:
+            url_bits = self.chart.get_url_bits(data_class=data_class)
+        finally:
+            self.chart._defer_data = False
+        index = [a is _DEFERRED_DATA for a in url_bits].index(True)
+        self.prefix = self.chart.BASE_URL + '?' + \
+            ''.join([a + '&' for a in url_bits[:index]])
+        self.suffix = ''.join(['&' + a for a in url_bits[index + 1:]])
+
+    def url_for(self, data):
+        """Returns the URL of the chart with the given list of series, which
+        are added with add_data() like the chart's own series would be."""
+        chart = self.chart
+        chart.data = []
+        chart.invalidate()
+        for series in data:
+            chart.add_data(series)
+        data_class = self.data_class
+        if not data_class:
+            data_class = chart.data_class_detection(chart.data)
+        url = self.prefix + chart.data_to_url(data_class)
+        scaling = chart.scaling_to_url(data_class)
+        if scaling:
+            url += '&' + scaling
+        return url + self.suffix
+
+
+def render_urls(charts, data_class=None):
+    """Yields the get_url() of each chart, which can be any iterable so the
+    charts don't all have to be in memory at once.
+
+    Work is shared between the charts: a series used by more than one of
+    them only has its range worked out once (see Chart.series_range()), and
+    is only encoded once for each encoding and scaling range it is used
+    with. Series shouldn't be changed until the batch is finished.
+    """
+    shared_ranges = {}
+    shared_buffers = {}
+    for chart in charts:
+        if sum(map(len, shared_buffers.values())) >= 256:
+            shared_buffers.clear()
+        chart._shared_ranges = shared_ranges
+        chart._shared_buffers = shared_buffers
+        try:
+            url = chart.get_url(data_class)
+        finally:
+            chart._shared_ranges = None
+            chart._shared_buffers = None
+        yield url
+
+
+def render_urls_from_specs(specs, data_class=None):
+    """Same as render_urls() for the charts made by ChartGrammar from each
+    of the specs. Charts are made as they are needed."""
+    grammar = ChartGrammar()
+    return render_urls((grammar.parse(spec) for spec in specs), data_class)
+
+
+
+class _SharedSeries(object):
+    """Stands in for a series copied into a shared memory block by
+    ProcessPoolRenderer when the chart is sent to a worker process."""
+
+    def __init__(self, name, typecode, size, missing):
+        self.name = name
+        self.typecode = typecode
+        self.size = size
+        self.missing = missing
+
+    def attach(self):
+        """Returns the values in the block as an array, or as a list with
+        None for the missing values if there are any."""
+        try:
+            block = shared_memory.SharedMemory(name=self.name, track=False)
+        except TypeError:
+            # Python < 3.13 registers the block to be removed when this
+            # process exits, but it belongs to the parent process.
+            from multiprocessing import resource_tracker
+            block = shared_memory.SharedMemory(name=self.name)
+            resource_tracker.unregister(block._name, 'shared_memory')
+        try:
+            values = array(self.typecode)
+            view = block.buf[:self.size]
+            values.frombytes(view)
+            view.release()
+        finally:
+            block.close()
+        if self.missing is None:
+            return values
+        values = values.tolist()
+        for byte_index, byte in enumerate(bytearray(self.missing)):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte & (1 << bit):
+                    values[byte_index * 8 + bit] = None
+        return values
+
+
+def _render_chunk(data_class, items):
+    """Runs in the worker processes of ProcessPoolRenderer."""
+    grammar = ChartGrammar()
+    # A series used by several charts in the chunk is only read once, so
+    # render_urls() can share its range and encoding.
+    attached = {}
+    def attach(data):
+        series = []
+        for a in data:
+            if isinstance(a, _SharedSeries):
+                if a.name not in attached:
+                    attached[a.name] = a.attach()
+                a = attached[a.name]
+            series.append(a)
+        return series
+    def charts():
+        for item in items:
+            if isinstance(item, dict):
+                if 'data' in item:
+                    item['data'] = attach(item['data'])
+                yield grammar.parse(item)
+            else:
+                item.data = attach(item.data)
+                item.invalidate()
+                yield item
+    return list(render_urls(charts(), data_class))
+
+
+class ProcessPoolRenderer(object):
+    """Renders the URLs of charts, or of ChartGrammar specs, in a pool of
+    worker processes.
+
+    The charts are sent to the workers chunk_size at a time, and render()
+    yields the URLs in the same order as the charts. At most max_pending
+    chunks are sent ahead of the URLs being used. Series of at least
+    shared_size numbers are copied into shared memory blocks, which the
+    workers read directly, instead of being pickled with the chart.
+
+    The charts, chunks, shared_series and seconds attributes add up the
+    work done by render(), see throughput().
+    """
+
+    def __init__(self, processes=None, chunk_size=100, data_class=None,
+            shared_size=10000, max_pending=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.data_class = data_class
+        self.shared_size = shared_size
+        self.max_pending = max_pending or self.processes * 2
+        self.charts = 0
+        self.chunks = 0
+        self.shared_series = 0
+        self.seconds = 0.
+
+    def throughput(self):
+        """Returns how many charts render() has done per second."""
+        if not self.seconds:
+            return 0.
+        return self.charts / self.seconds
+
+    def render(self, items):
+        """Yields the URL of each chart or spec in items."""
+        start = time.time()
+        pool = multiprocessing.Pool(self.processes)
+        pending = deque()
+        try:
+            for chunk in self.iter_chunks(items):
+                blocks = {}
+                chunk = [self.prepare(a, blocks) for a in chunk]
+                pending.append((pool.apply_async(_render_chunk,
+                    (self.data_class, chunk)), blocks))
+                if len(pending) >= self.max_pending:
+                    for url in self.collect(*pending.popleft()):
+                        yield url
+            while pending:
+                for url in self.collect(*pending.popleft()):
+                    yield url
+        finally:
+            pool.terminate()
+            pool.join()
+            for result, blocks in pending:
+                self.release(blocks)
+            self.seconds += time.time() - start
+
+    def iter_chunks(self, items):
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def collect(self, result, blocks):
+        try:
+            urls = result.get()
+        finally:
+            self.release(blocks)
+        self.charts += len(urls)
+        self.chunks += 1
+        return urls
+
+    def release(self, blocks):
+        for series, shared, block in blocks.values():
+            block.close()
+            block.unlink()
+
+    def prepare(self, item, blocks):
+        """Returns a copy of a chart or spec to send to a worker, with large
+        series moved into shared memory blocks. blocks is a dict of the
+        blocks made for the chunk, so a series used by several charts in it
+        is only copied once.
+        """
+        if isinstance(item, dict):
+            item = dict(item)
+            if 'data' in item:
+                item['data'] = [self.share_series(a, blocks)
+                    for a in item['data']]
+            return item
+        chart = item._bare_copy()
+        chart.data = [self.share_series(a, blocks) for a in item.data]
+        return chart
+
+    def share_series(self, series, blocks):
+        if shared_memory is None or len(series) < self.shared_size or \
+                not isinstance(series, (list, tuple, CompactSeries)):
+            return series
+        if id(series) in blocks:
+            return blocks[id(series)][1]
+        compact = series
+        if not isinstance(series, CompactSeries):
+            try:
+                compact = CompactSeries(series)
+            except TypeError:
+                # Not numbers
+                return series
+        values = compact.values
+        size = len(values) * values.itemsize
+        block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        view = block.buf[:size]
+        view[:] = memoryview(values).cast('B')
+        view.release()
+        missing = compact.missing
+        if missing is not None:
+            missing = bytes(missing)
+        shared = _SharedSeries(block.name, values.typecode, size, missing)
+        # The series is kept so its id isn't reused while it is in here.
+        blocks[id(series)] = (series, shared, block)
+        self.shared_series += 1
+        return shared
+
+
+# Local rendering
+# -----------------------------------------------------------------------------
+
+
+def _text_width(text, size):
+    """Rough width of text in pixels, as no font metrics are available."""
+    return len(text) * size * 0.55
+
+
+def _format_tick(value):
+    if value == int(value):
+        return str(int(value))
+    return '%g' % value
+
+
+def _dash(values, index):
+    """Returns the (line, blank) dash lengths in line style values, or
+    None for a solid line."""
+    if len(values) > index + 1 and float(values[index + 1]) > 0:
+        return (float(values[index]), float(values[index + 1]))
+    return None
+
+
+class ChartRenderer(object):
+    """Abstract class for drawing charts locally instead of requesting the
+    image from BASE_URL. Chart.download() uses the renderer it is given, or
+    Chart.renderer if it's set, e.g.:
+
+        chart.renderer = SVGRenderer()
+        chart.download('chart.svg')
+
+    layout() turns a chart into a list of shapes, which subclasses draw in
+    render(chart), returning the image as bytes. Each shape is a tuple
+    starting with its kind:
+
+        ('rect', x, y, width, height, colour)
+        ('line', points, colour, thickness, dash) - dash is a (line, blank)
+            pair of lengths, or None for a solid line
+        ('polygon', points, colour)
+        ('circle', x, y, radius, colour)
+        ('wedge', x, y, radius, start, end, colour) - angles are in radians,
+            clockwise from 3 o'clock
+        ('text', x, y, text, colour, size, anchor) - y is the baseline and
+            anchor is 'start', 'middle' or 'end'
+
+    Colours are RRGGBB or RRGGBBAA strings, as given to the charts. Line,
+    sparkline, XY line, scatter, bar and 2D pie charts can be drawn, and
+    UnknownChartType is raised for the others. The data is scaled the same
+    way as for the URL. Gradient and stripe fills use their first colour.
+    """
+
+    DEFAULT_COLOURS = ('FF9900', '3366CC', 'DC3912', '109618', '990099',
+        '0099C6', 'DD4477', '66AA00')
+    BACKGROUND_COLOUR = 'FFFFFF'
+    TEXT_COLOUR = '333333'
+    AXIS_COLOUR = '666666'
+    GRID_COLOUR = 'CCCCCC'
+    FONT_SIZE = 11
+    TITLE_FONT_SIZE = 13.5
+    MARGIN = 6
+    POINT_RADIUS = 4
+
+    def __init__(self):
+        if type(self) == ChartRenderer:
+            raise AbstractClassException('This is an abstract class')
+
+    def layout(self, chart):
+        """Returns the shapes making up the image of chart, in drawing
+        order."""
+        layout_data = self.data_layout(chart)
+        shapes = [('rect', 0, 0, chart.width, chart.height,
+            self.fill_colour(chart, Chart.BACKGROUND) or
+            self.BACKGROUND_COLOUR)]
+        # left, top, right, bottom of the space left for the plot
+        box = [self.MARGIN, self.MARGIN, chart.width - self.MARGIN,
+            chart.height - self.MARGIN]
+        self.layout_title(chart, box, shapes)
+        self.layout_legend(chart, box, shapes)
+        axes = self.place_axes(chart, box)
+        plot = (box[0], box[1], max(box[2] - box[0], 1),
+            max(box[3] - box[1], 1))
+        colour = self.fill_colour(chart, Chart.CHART)
+        if colour:
+            shapes.append(('rect',) + plot + (colour,))
+        self.layout_grid(chart, plot, shapes)
+        self.layout_ranges(chart, plot, shapes)
+        data_shapes = []
+        positions = layout_data(chart, plot, data_shapes)
+        self.layout_fills(chart, plot, positions, shapes)
+        shapes.extend(data_shapes)
+        self.layout_markers(chart, positions, shapes)
+        self.layout_axes(axes, plot, shapes)
+        return shapes
+
+    def data_layout(self, chart):
+        """Returns the method laying out the data of chart."""
+        if isinstance(chart, XYLineChart):
+            return self.layout_xy_lines
+        if isinstance(chart, SimpleLineChart):
+            return self.layout_lines
+        if isinstance(chart, ScatterChart):
+            return self.layout_scatter
+        if isinstance(chart, BarChart):
+            return self.layout_bars
+        if isinstance(chart, PieChart2D):
+            return self.layout_pie
+        raise UnknownChartType('%s can\'t be rendered locally' %
+            chart.__class__.__name__)
+
+    # Helpers
+
+    def unit_data(self, chart):
+        """Returns the data of chart scaled to 0..1, in annotated_data()
+        order, with None for missing values. It is remembered with the
+        scaled data, so it shouldn't be modified."""
+        key = ('scaled', ChartRenderer, _range_key(chart.x_range),
+            _range_key(chart.y_range), chart.auto_scale)
+        if key in chart._data_cache:
+            return chart._data_cache[key]
+        if chart.auto_scale:
+            # Already clipped to 0..4095
+            data = chart.scaled_data(ExtendedData, chart.x_range,
+                chart.y_range)
+            scale = 1. / ExtendedData.max_value
+            data = [[None if a is None else a * scale
+                for a in _values(series)] for series in data]
+        else:
+            top = float(chart.data_class_detection(chart.data).max_value)
+            data = [[None if a is None else min(max(a / top, 0.), 1.)
+                for a in _values(series)] for series in chart.data]
+        chart._data_cache[key] = data
+        return data
+
+    def fill_colour(self, chart, area):
+        if chart.fill_types[area] == Chart.SOLID:
+            return chart.fill_area[area]
+        if chart.fill_types[area]:
+            # angle,colour,offset,... for gradients and stripes
+            return chart.fill_area[area].split(',')[1]
+        return None
+
+    def series_colour(self, chart, index):
+        colours = chart.colours or self.DEFAULT_COLOURS
+        return colours[index % len(colours)]
+
+    def value_colour(self, chart, series, index):
+        """Colour of one bar, slice or point, from colours_within_series
+        when it's set."""
+        if chart.colours_within_series:
+            colours = chart.colours_within_series
+            return colours[index % len(colours)]
+        return self.series_colour(chart, series)
+
+    def line_style(self, chart, index):
+        """Returns the (thickness, dash) of line index."""
+        values = chart.line_styles.get(index)
+        if not values:
+            return 2., None
+        return float(values[0]), _dash(values, 1)
+
+    # Title, legend and axes
+
+    def layout_title(self, chart, box, shapes):
+        if not chart.title:
+            return
+        size = float(chart.title_font_size or self.TITLE_FONT_SIZE)
+        colour = chart.title_colour or self.TEXT_COLOUR
+        for line in unquote(chart.title).split('|'):
+            box[1] += size
+            shapes.append(('text', chart.width / 2., box[1], line, colour,
+                size, 'middle'))
+            box[1] += size * 0.25
+        box[1] += self.MARGIN
+
+    def layout_legend(self, chart, box, shapes):
+        if not chart.legend:
+            return
+        size = self.FONT_SIZE
+        entries = [unquote(a) for a in chart.legend]
+        position = unquote(chart.legend_position or 'r')
+        step = size + 4
+        if position in ('r', 'l'):
+            width = size * 1.5 + max([_text_width(a, size)
+                for a in entries])
+            if position == 'r':
+                x = box[2] - width
+                box[2] = x - self.MARGIN
+            else:
+                x = box[0]
+                box[0] += width + self.MARGIN
+            y = (box[1] + box[3] - step * len(entries)) / 2.
+            places = [(x, y + step * a) for a in range(len(entries))]
+        else:
+            if position.startswith('t'):
+                y = box[1]
+                box[1] += step + self.MARGIN
+            else:
+                y = box[3] - step
+                box[3] = y - self.MARGIN
+            places = []
+            x = box[0]
+            for entry in entries:
+                places.append((x, y))
+                x += size * 2.5 + _text_width(entry, size)
+        for index, (entry, (x, y)) in enumerate(zip(entries, places)):
+            shapes.append(('rect', x, y, size, size,
+                self.series_colour(chart, index)))
+            shapes.append(('text', x + size * 1.5, y + size * 0.9, entry,
+                self.TEXT_COLOUR, size, 'start'))
+
+    def axis_labels(self, axis):
+        """Returns the (fraction along the axis, label) of each label."""
+        if isinstance(axis, RangeAxis):
+            low, high = float(axis.low), float(axis.high)
+            if axis.positions:
+                values = [float(a) for a in axis.positions]
+            else:
+                values = [low + (high - low) * a / 4. for a in range(5)]
+            span = (high - low) or 1.
+            return [((a - low) / span, _format_tick(a)) for a in values]
+        labels = [unquote(a) for a in axis.values]
+        if axis.positions:
+            places = [float(a) / 100. for a in axis.positions]
+        elif len(labels) == 1:
+            places = [0.5]
+        else:
+            places = [a / float(len(labels) - 1) for a in
+                range(len(labels))]
+        return list(zip(places, labels))
+
+    def place_axes(self, chart, box):
+        """Makes room in box for the axes of chart and returns (axis,
+        offset from the plot, labels) for each one."""
+        axes = []
+        offsets = {}
+        size = self.FONT_SIZE
+        for axis in chart.axis:
+            labels = self.axis_labels(axis)
+            if axis.axis_type in (Axis.BOTTOM, Axis.TOP):
+                room = size + 6
+            else:
+                room = max([_text_width(a[1], size) for a in labels] +
+                    [0]) + 6
+            offset = offsets.get(axis.axis_type, 0)
+            offsets[axis.axis_type] = offset + room
+            axes.append((axis, offset, labels))
+        box[0] += offsets.get(Axis.LEFT, 0)
+        box[1] += offsets.get(Axis.TOP, 0)
+        box[2] -= offsets.get(Axis.RIGHT, 0)
+        box[3] -= offsets.get(Axis.BOTTOM, 0)
+        return axes
+
+    def layout_axes(self, axes, plot, shapes):
+        x, y, width, height = plot
+        size = self.FONT_SIZE
+        for axis, offset, labels in axes:
+            colour = self.AXIS_COLOUR
+            if axis.has_style:
+                colour = axis.colour
+            side = axis.axis_type
+            if side == Axis.BOTTOM:
+                edge = y + height
+                shapes.append(('line', ((x, edge), (x + width, edge)),
+                    colour, 1., None))
+                for place, label in labels:
+                    shapes.append(('text', x + width * place,
+                        edge + offset + size + 2, label, colour, size,
+                        'middle'))
+            elif side == Axis.TOP:
+                shapes.append(('line', ((x, y), (x + width, y)), colour,
+                    1., None))
+                for place, label in labels:
+                    shapes.append(('text', x + width * place,
+                        y - offset - 4, label, colour, size, 'middle'))
+            elif side == Axis.LEFT:
+                shapes.append(('line', ((x, y), (x, y + height)), colour,
+                    1., None))
+                for place, label in labels:
+                    shapes.append(('text', x - offset - 3,
+                        y + height * (1 - place) + size * 0.35, label,
+                        colour, size, 'end'))
+            else:
+                edge = x + width
+                shapes.append(('line', ((edge, y), (edge, y + height)),
+                    colour, 1., None))
+                for place, label in labels:
+                    shapes.append(('text', edge + offset + 3,
+                        y + height * (1 - place) + size * 0.35, label,
+                        colour, size, 'start'))
+
+    def layout_grid(self, chart, plot, shapes):
+        if not chart.grid:
+            return
+        x, y, width, height = plot
+        values = chart.grid.split(',')
+        dash = _dash(values, 2)
+        x_step, y_step = float(values[0]), float(values[1])
+        if x_step > 0:
+            place = x_step
+            while place < 100:
+                left = x + width * place / 100.
+                shapes.append(('line', ((left, y), (left, y + height)),
+                    self.GRID_COLOUR, 1., dash))
+                place += x_step
+        if y_step > 0:
+            place = y_step
+            while place < 100:
+                top = y + height * (1 - place / 100.)
+                shapes.append(('line', ((x, top), (x + width, top)),
+                    self.GRID_COLOUR, 1., dash))
+                place += y_step
+
+    # Markers
+
+    def layout_ranges(self, chart, plot, shapes):
+        """Adds the range markers, which go behind the data."""
+        x, y, width, height = plot
+        for marker in chart.markers:
+            kind, colour = marker[0], marker[1]
+            if kind == 'r':
+                start, stop = float(marker[3]), float(marker[4])
+                shapes.append(('rect', x, y + height * (1 - stop), width,
+                    height * (stop - start), colour))
+            elif kind == 'R':
+                start, stop = float(marker[3]), float(marker[4])
+                shapes.append(('rect', x + width * start, y,
+                    width * (stop - start), height, colour))
+
+    def layout_fills(self, chart, plot, positions, shapes):
+        """Adds the fills under and between lines."""
+        bottom = plot[1] + plot[3]
+        for marker in chart.markers:
+            kind, colour = marker[0], marker[1]
+            if kind == 'B' and positions and positions[0]:
+                points = positions[0]
+                shapes.append(('polygon', [(points[0][0], bottom)] +
+                    points + [(points[-1][0], bottom)], colour))
+            elif kind == 'b':
+                start, end = int(marker[2]), int(marker[3])
+                if max(start, end) < len(positions):
+                    shapes.append(('polygon', positions[start] +
+                        positions[end][::-1], colour))
+
+    def layout_markers(self, chart, positions, shapes):
+        """Adds the shape, text and line markers. positions has the points
+        of each line, or of the points or bars, where the markers go."""
+        for marker in chart.markers:
+            kind, colour = marker[0], marker[1]
+            if kind in ('r', 'R', 'B', 'b'):
+                continue
+            series = int(marker[2])
+            if series >= len(positions):
+                continue
+            points = positions[series]
+            if kind == 'D':
+                shapes.append(('line', points, colour, float(marker[4]),
+                    None))
+                continue
+            point = int(float(marker[3]))
+            if point >= 0:
+                points = points[point:point + 1]
+            size = float(marker[4])
+            for x, y in points:
+                shapes.append(self.marker_shape(kind, colour, x, y, size))
+
+    def marker_shape(self, kind, colour, x, y, size):
+        half = size / 2.
+        if kind.startswith('t') and len(kind) > 1:
+            return ('text', x, y - half, unquote(kind[1:]), colour, size,
+                'middle')
+        if kind == 's':
+            return ('rect', x - half, y - half, size, size, colour)
+        if kind == 'd':
+            return ('polygon', [(x, y - half), (x + half, y),
+                (x, y + half), (x - half, y)], colour)
+        return ('circle', x, y, half, colour)
+
+    # Data
+
+    def line_points(self, plot, xs, ys):
+        """Returns the runs of (x, y) points between missing values."""
+        x, y, width, height = plot
+        runs = [[]]
+        for fx, fy in zip(xs, ys):
+            if fx is None or fy is None:
+                if runs[-1]:
+                    runs.append([])
+                continue
+            runs[-1].append((x + width * fx, y + height * (1 - fy)))
+        return [a for a in runs if a]
+
+    def add_lines(self, chart, index, runs, shapes):
+        thickness, dash = self.line_style(chart, index)
+        colour = self.series_colour(chart, index)
+        for run in runs:
+            shapes.append(('line', run, colour, thickness, dash))
+        return sum(runs, [])
+
+    def layout_lines(self, chart, plot, shapes):
+        positions = []
+        for index, ys in enumerate(self.unit_data(chart)):
+            last = float(max(len(ys) - 1, 1))
+            xs = [a / last for a in range(len(ys))]
+            if len(ys) == 1:
+                xs = [0.5]
+            positions.append(self.add_lines(chart, index,
+                self.line_points(plot, xs, ys), shapes))
+        return positions
+
+    def layout_xy_lines(self, chart, plot, shapes):
+        data = self.unit_data(chart)
+        positions = []
+        for index in range(len(data) // 2):
+            xs, ys = data[index * 2], data[index * 2 + 1]
+            positions.append(self.add_lines(chart, index,
+                self.line_points(plot, xs, ys), shapes))
+        return positions
+
+    def layout_scatter(self, chart, plot, shapes):
+        data = self.unit_data(chart)
+        sizes = data[2] if len(data) > 2 else None
+        points = []
+        for index, (fx, fy) in enumerate(zip(data[0], data[1])):
+            if fx is None or fy is None:
+                continue
+            x = plot[0] + plot[2] * fx
+            y = plot[1] + plot[3] * (1 - fy)
+            radius = self.POINT_RADIUS
+            if sizes is not None and index < len(sizes) and \
+                    sizes[index] is not None:
+                radius = 1 + self.POINT_RADIUS * 2 * sizes[index]
+            shapes.append(('circle', x, y, radius,
+                self.value_colour(chart, 0, index)))
+            points.append((x, y))
+        return [points]
+
+    def layout_bars(self, chart, plot, shapes):
+        x, y, width, height = plot
+        data = self.unit_data(chart)
+        vertical = isinstance(chart, (StackedVerticalBarChart,
+            GroupedVerticalBarChart))
+        grouped = isinstance(chart, GroupedBarChart)
+        groups = max([len(a) for a in data] + [1])
+        per_group = len(data) if grouped else 1
+        length = width if vertical else height
+        spacing = getattr(chart, 'bar_spacing', None)
+        if spacing is None:
+            spacing = 4
+        group_spacing = getattr(chart, 'group_spacing', None)
+        if group_spacing is None:
+            group_spacing = 8 if grouped else spacing
+        bar = chart.bar_width
+        if not bar:
+            bar = (length / float(groups) - group_spacing -
+                spacing * (per_group - 1)) / per_group
+            bar = max(bar, 1.)
+        group_size = bar * per_group + spacing * (per_group - 1) + \
+            group_spacing
+        positions = [[] for a in data]
+        for group in range(groups):
+            start = group_spacing / 2. + group_size * group
+            base = 0.
+            for index, series in enumerate(data):
+                if group >= len(series) or series[group] is None:
+                    continue
+                value = series[group]
+                offset = start
+                if grouped:
+                    offset += (bar + spacing) * index
+                    lower = 0.
+                else:
+                    lower = base
+                    base += value
+                upper = min(lower + value, 1.)
+                colour = self.series_colour(chart, index)
+                if len(data) == 1:
+                    colour = self.value_colour(chart, index, group)
+                if vertical:
+                    rect = (x + offset, y + height * (1 - upper), bar,
+                        height * (upper - lower))
+                    positions[index].append((rect[0] + bar / 2., rect[1]))
+                else:
+                    rect = (x + width * lower, y + offset,
+                        width * (upper - lower), bar)
+                    positions[index].append((rect[0] + rect[2],
+                        rect[1] + bar / 2.))
+                shapes.append(('rect',) + rect + (colour,))
+        return positions
+
+    def layout_pie(self, chart, plot, shapes):
+        x, y, width, height = plot
+        values = [a for a in _values(chart.data[0]) if a is not None] \
+            if chart.data else []
+        total = float(sum([a for a in values if a > 0]))
+        labels = [unquote(a) for a in chart.pie_labels]
+        size = self.FONT_SIZE
+        room = 0
+        if labels:
+            room = max([_text_width(a, size) for a in labels]) + 8
+        radius = max(min(width - room * 2, height - size * 2) / 2., 1)
+        cx, cy = x + width / 2., y + height / 2.
+        start = 0.
+        for index, value in enumerate(values):
+            if value <= 0 or not total:
+                continue
+            end = start + math.pi * 2 * value / total
+            shapes.append(('wedge', cx, cy, radius, start, end,
+                self.value_colour(chart, index, index)))
+            if index < len(labels):
+                middle = (start + end) / 2.
+                cos, sin = math.cos(middle), math.sin(middle)
+                shapes.append(('text', cx + cos * (radius + 4),
+                    cy + sin * (radius + 4) + size * 0.35, labels[index],
+                    self.TEXT_COLOUR, size, 'start' if cos >= 0 else 'end'))
+            start = end
+        return []
+
+
+class SVGRenderer(ChartRenderer):
+    """Renders charts as SVG documents, see ChartRenderer."""
+
+    def __init__(self):
+        ChartRenderer.__init__(self)
+        self._paints = {}
+
+    def render(self, chart):
+        return self.svg(chart).encode('utf-8')
+
+    def svg(self, chart):
+        """Returns the SVG document of chart as a string."""
+        parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="%i" '
+            'height="%i" viewBox="0 0 %i %i" font-family="Arial,sans-serif">'
+            % (chart.width, chart.height, chart.width, chart.height)]
+        append = parts.append
+        for shape in self.layout(chart):
+            kind = shape[0]
+            if kind == 'line':
+                points, colour, thickness, dash = shape[1:]
+                dash = dash and ' stroke-dasharray="%g,%g"' % dash or ''
+                append('<polyline points="%s" fill="none" %s '
+                    'stroke-width="%g" stroke-linejoin="round"%s/>' % (
+                    self.points(points), self.paint('stroke', colour),
+                    thickness, dash))
+            elif kind == 'rect':
+                append('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" '
+                    '%s/>' % (shape[1:5] + (self.paint('fill', shape[5]),)))
+            elif kind == 'circle':
+                append('<circle cx="%.1f" cy="%.1f" r="%.1f" %s/>' % (
+                    shape[1:4] + (self.paint('fill', shape[4]),)))
+            elif kind == 'polygon':
+                append('<polygon points="%s" %s/>' % (
+                    self.points(shape[1]), self.paint('fill', shape[2])))
+            elif kind == 'wedge':
+                append(self.wedge(*shape[1:]))
+            elif kind == 'text':
+                x, y, text, colour, size, anchor = shape[1:]
+                append('<text x="%.1f" y="%.1f" font-size="%g" %s '
+                    'text-anchor="%s">%s</text>' % (x, y, size,
+                    self.paint('fill', colour), anchor, escape(text)))
+        append('</svg>')
+        return ''.join(parts)
+
+    @staticmethod
+    def points(points):
+        return ' '.join(['%.1f,%.1f' % a for a in points])
+
+    def paint(self, attribute, colour):
+        """Returns the attributes to fill or stroke with colour."""
+        key = (attribute, colour)
+        if key not in self._paints:
+            paint = '%s="#%s"' % (attribute, colour[:6])
+            if len(colour) == 8:
+                paint += ' %s-opacity="%.3g"' % (attribute,
+                    int(colour[6:], 16) / 255.)
+            self._paints[key] = paint
+        return self._paints[key]
+
+    def wedge(self, x, y, radius, start, end, colour):
+        fill = self.paint('fill', colour)
+        if end - start >= math.pi * 2 - 1e-9:
+            return '<circle cx="%.1f" cy="%.1f" r="%.1f" %s/>' % (x, y,
+                radius, fill)
+        return '<path d="M%.1f,%.1fL%.1f,%.1fA%.1f,%.1f 0 %i,1 %.1f,%.1fZ" ' \
+            '%s/>' % (x, y, x + radius * math.cos(start),
+            y + radius * math.sin(start), radius, radius,
+            end - start > math.pi, x + radius * math.cos(end),
+            y + radius * math.sin(end), fill)
+
+
+class PNGRenderer(ChartRenderer):
+    """Renders charts as PNG images, see ChartRenderer.
+
+    The images are drawn with Pillow if it's installed, unless use_pillow
+    is False, and otherwise in pure Python with a built in 5x7 pixel font.
+    Shapes aren't anti-aliased, so a chart always gives the same image with
+    the same backend, though the two backends differ slightly.
+    """
+
+    def __init__(self, use_pillow=None):
+        ChartRenderer.__init__(self)
+        if use_pillow is None:
+            use_pillow = Image is not None
+        elif use_pillow and Image is None:
+            raise ImportError('use_pillow requires Pillow')
+        self.use_pillow = use_pillow
+
+    def render(self, chart):
+        shapes = self.layout(chart)
+        if self.use_pillow:
+            canvas = _PillowCanvas(chart.width, chart.height)
+        else:
+            canvas = _Raster(chart.width, chart.height)
+        for shape in shapes:
+            getattr(canvas, shape[0])(*shape[1:])
+        return canvas.png()
+
+
+def _rgba(colour):
+    """Returns the (r, g, b, alpha) of an RRGGBB or RRGGBBAA colour."""
+    alpha = 255
+    if len(colour) == 8:
+        alpha = int(colour[6:], 16)
+    return (int(colour[0:2], 16), int(colour[2:4], 16),
+        int(colour[4:6], 16), alpha)
+
+
+def _cover(start, end):
+    """Returns the range of pixels whose centres are from start to end."""
+    return int(math.ceil(start - 0.5)), int(math.ceil(end - 0.5))
+
+
+def _dash_runs(points, line, blank):
+    """Splits a line into the runs of points drawn with the dash pattern."""
+    runs = []
+    run = [points[0]]
+    # Length left of the current dash or gap
+    left = line
+    drawing = True
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        length = math.hypot(x1 - x0, y1 - y0)
+        done = 0.
+        while length - done > left:
+            done += left
+            point = (x0 + (x1 - x0) * done / length,
+                y0 + (y1 - y0) * done / length)
+            if drawing:
+                run.append(point)
+                runs.append(run)
+            else:
+                run = [point]
+            drawing = not drawing
+            left = line if drawing else blank
+        left -= length - done
+        if drawing:
+            run.append((x1, y1))
+    if drawing and len(run) > 1:
+        runs.append(run)
+    return runs
+
+
+def _segment_quad(x0, y0, x1, y1, thickness):
+    """Returns the corners of a line segment drawn thickness wide."""
+    length = math.hypot(x1 - x0, y1 - y0) or 1.
+    dx = (y0 - y1) / length * thickness / 2.
+    dy = (x1 - x0) / length * thickness / 2.
+    return [(x0 + dx, y0 + dy), (x1 + dx, y1 + dy), (x1 - dx, y1 - dy),
+        (x0 - dx, y0 - dy)]
+
+
+def _arc(x, y, radius, start, end):
+    """Returns a wedge as a polygon."""
+    steps = max(2, int(math.ceil((end - start) * radius / 3.)))
+    return [(x, y)] + [(x + radius * math.cos(start + (end - start) * a /
+        steps), y + radius * math.sin(start + (end - start) * a / steps))
+        for a in range(steps + 1)]
+
+
+# 5x7 pixel font for ASCII 32 to 126. Each character is five columns, and
+# each column a byte whose bits are its rows from the top. The last row is
+# below the baseline.
+_FONT = bytearray(binascii.unhexlify(
+    '000000000000005f00000007000700147f147f14242a7f2a1223130864623649'
+    '5620500000070000001c2241000041221c002a1c7f1c2a08083e080800503000'
+    '000808080808006060000020100804023e5149453e00427f4000724949494622'
+    '414949361814127f1027454545393c4a49493001710905033649494936064949'
+    '291e003636000000563600000814224100141414141400412214080201510906'
+    '3e415d594e7c1211127c7f494949363e414141227f4141221c7f494949417f09'
+    '0909013e4149497a7f0808087f00417f41002040413f017f081422417f404040'
+    '407f020c027f7f0408107f3e4141413e7f090909063e4151215e7f0919294646'
+    '4949493101017f01013f4040403f1f2040201f3f4038403f6314081463070870'
+    '08076151494543007f41410002040810200041417f0004020102044040404040'
+    '000102040020545454787f484444383844444420384444487f3854545418087e'
+    '09010218a4a4a47c7f0804047800447d40004080847d007f1028440000417f40'
+    '007c041804787c080404783844444438fc2424241818242424fc7c0804040848'
+    '54545420043f4440203c4040207c1c2040201c3c4030403c44281028441ca0a0'
+    'a07c4464544c44000836410000007f000000413608000804081008'))
+
+# Tables for blending a channel value with alpha over the existing values,
+# see _Raster.span().
+_blend_tables = {}
+
+
+def _blend_table(value, alpha):
+    key = (value, alpha)
+    if key not in _blend_tables:
+        if len(_blend_tables) >= 1024:
+            _blend_tables.clear()
+        _blend_tables[key] = bytes(bytearray([(value * alpha + a *
+            (255 - alpha) + 127) // 255 for a in range(256)]))
+    return _blend_tables[key]
+
+
+class _Raster(object):
+    """RGB image drawn in pure Python for PNGRenderer. The methods draw the
+    ChartRenderer shapes of the same names. Shapes cover the pixels whose
+    centres are inside them."""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(b'\xff' * (width * height * 3))
+
+    def span(self, y, left, right, colour):
+        """Fills the pixels from left up to right in row y."""
+        left = max(left, 0)
+        right = min(right, self.width)
+        if left >= right or y < 0 or y >= self.height:
+            return
+        start = (y * self.width + left) * 3
+        end = start + (right - left) * 3
+        red, green, blue, alpha = colour
+        if alpha == 255:
+            self.pixels[start:end] = bytearray((red, green, blue)) * \
+                (right - left)
+            return
+        pixels = self.pixels
+        for offset, value in enumerate((red, green, blue)):
+            pixels[start + offset:end:3] = pixels[start + offset:end:3] \
+                .translate(_blend_table(value, alpha))
+
+    def rect(self, x, y, width, height, colour):
+        colour = _rgba(colour)
+        left, right = _cover(x, x + width)
+        top, bottom = _cover(y, y + height)
+        for row in range(max(top, 0), min(bottom, self.height)):
+            self.span(row, left, right, colour)
+
+    def polygon(self, points, colour):
+        colour = _rgba(colour)
+        edges = list(zip(points, points[1:] + points[:1]))
+        top, bottom = _cover(min([a[1] for a in points]),
+            max([a[1] for a in points]))
+        for row in range(max(top, 0), min(bottom, self.height)):
+            centre = row + 0.5
+            crossings = []
+            for (x0, y0), (x1, y1) in edges:
+                if (y0 <= centre) != (y1 <= centre):
+                    crossings.append(x0 + (centre - y0) * (x1 - x0) /
+                        (y1 - y0))
+            crossings.sort()
+            for index in range(0, len(crossings) - 1, 2):
+                left, right = _cover(crossings[index],
+                    crossings[index + 1])
+                self.span(row, left, right, colour)
+
+    def circle(self, x, y, radius, colour):
+        colour = _rgba(colour)
+        top, bottom = _cover(y - radius, y + radius)
+        for row in range(max(top, 0), min(bottom, self.height)):
+            offset = row + 0.5 - y
+            half = math.sqrt(max(radius * radius - offset * offset, 0))
+            left, right = _cover(x - half, x + half)
+            self.span(row, left, right, colour)
+
+    def wedge(self, x, y, radius, start, end, colour):
+        if end - start >= math.pi * 2 - 1e-9:
+            self.circle(x, y, radius, colour)
+        else:
+            self.polygon(_arc(x, y, radius, start, end), colour)
+
+    def line(self, points, colour, thickness, dash):
+        runs = [points]
+        if dash:
+            runs = _dash_runs(points, *dash)
+        for run in runs:
+            for (x0, y0), (x1, y1) in zip(run, run[1:]):
+                self.polygon(_segment_quad(x0, y0, x1, y1, thickness),
+                    colour)
+            if thickness >= 2:
+                # Round joins
+                for x, y in run[1:-1]:
+                    self.circle(x, y, thickness / 2., colour)
+
+    def text(self, x, y, text, colour, size, anchor):
+        colour = _rgba(colour)
+        scale = max(int(size / 10. + 0.5), 1)
+        width = (len(text) * 6 - 1) * scale
+        if anchor == 'middle':
+            x -= width / 2.
+        elif anchor == 'end':
+            x -= width
+        left = _cover(x, x)[0]
+        top = _cover(y, y)[0] - 7 * scale
+        for character in text:
+            code = ord(character)
+            if not 32 <= code <= 126:
+                code = ord('?')
+            glyph = _FONT[(code - 32) * 5:(code - 31) * 5]
+            for column, bits in enumerate(glyph):
+                for row in range(8):
+                    if bits >> row & 1:
+                        for line in range(scale):
+                            self.span(top + row * scale + line,
+                                left + column * scale,
+                                left + (column + 1) * scale, colour)
+            left += 6 * scale
+
+    def png(self):
+        """Returns the image as a PNG file."""
+        size = self.width * 3
+        pixels = self.pixels
+        # Each row starts with its filter type, 0 for none.
+        rows = b''.join([b'\0' + bytes(pixels[a:a + size])
+            for a in range(0, len(pixels), size)])
+        header = struct.pack('!IIBBBBB', self.width, self.height, 8, 2, 0,
+            0, 0)
+        return b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header) + \
+            _png_chunk(b'IDAT', zlib.compress(rows, 6)) + \
+            _png_chunk(b'IEND', b'')
+
+
+def _png_chunk(kind, data):
+    return struct.pack('!I', len(data)) + kind + data + \
+        struct.pack('!I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+class _PillowCanvas(object):
+    """Draws the ChartRenderer shapes with Pillow for PNGRenderer."""
+
+    def __init__(self, width, height):
+        self.image = Image.new('RGB', (width, height), (255, 255, 255))
+        # Blends colours with alpha
+        self.draw = ImageDraw.Draw(self.image, 'RGBA')
+        self.fonts = {}
+
+    def rect(self, x, y, width, height, colour):
+        left, right = _cover(x, x + width)
+        top, bottom = _cover(y, y + height)
+        if left < right and top < bottom:
+            self.draw.rectangle((left, top, right - 1, bottom - 1),
+                fill=_rgba(colour))
+
+    def polygon(self, points, colour):
+        self.draw.polygon(points, fill=_rgba(colour))
+
+    def circle(self, x, y, radius, colour):
+        self.draw.ellipse((x - radius, y - radius, x + radius, y + radius),
+            fill=_rgba(colour))
+
+    def wedge(self, x, y, radius, start, end, colour):
+        if end - start >= math.pi * 2 - 1e-9:
+            self.circle(x, y, radius, colour)
+        else:
+            self.draw.pieslice((x - radius, y - radius, x + radius,
+                y + radius), math.degrees(start), math.degrees(end),
+                fill=_rgba(colour))
+
+    def line(self, points, colour, thickness, dash):
+        runs = [points]
+        if dash:
+            runs = _dash_runs(points, *dash)
+        width = max(int(thickness + 0.5), 1)
+        for run in runs:
+            self.draw.line(run, fill=_rgba(colour), width=width,
+                joint='curve')
+
+    def font(self, size):
+        size = int(size + 0.5)
+        if size not in self.fonts:
+            try:
+                self.fonts[size] = ImageFont.load_default(size)
+            except TypeError:
+                # Pillow < 10.1 has one size
+                self.fonts[size] = ImageFont.load_default()
+        return self.fonts[size]
+
+    def text(self, x, y, text, colour, size, anchor):
+        font = self.font(size)
+        left, top, right, bottom = self.draw.textbbox((0, 0), text,
+            font=font)
+        if anchor == 'middle':
+            x -= right / 2.
+        elif anchor == 'end':
+            x -= right
+        # Bottom of the text on the baseline, as it has no descender metric.
+        self.draw.text((x, y - size), text, fill=_rgba(colour), font=font)
+
+    def png(self):
+        output = io.BytesIO()
+        self.image.save(output, 'PNG')
+        return output.getvalue()
+
+
+# Downloads
+# -----------------------------------------------------------------------------
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    """HTTPSConnection which resumes the TLS session in `session`."""
+
+    session = None
+    tunnel_host = None
+
+    def __init__(self, host, port=None, context=None, **kwargs):
+        # Kept here rather than relying on HTTPSConnection's private
+        # attributes.
+        if context is None:
+            context = ssl.create_default_context()
+        httplib.HTTPSConnection.__init__(self, host, port, context=context,
+            **kwargs)
+        self.ssl_context = context
+
+    def set_tunnel(self, host, port=None, headers=None):
+        httplib.HTTPSConnection.set_tunnel(self, host, port, headers)
+        self.tunnel_host = host
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock = self.ssl_context.wrap_socket(self.sock,
+            server_hostname=self.tunnel_host or self.host,
+            session=self.session)
+
+
+class _PooledConnection(object):
+    """A connection in a ChartClient pool, and how often it was used."""
+
+    def __init__(self, key, connection):
+        self.key = key
+        self.connection = connection
+        self.requests = 0
+        self.last_used = time.time()
+
+
+class _PooledResponse(object):
+    """Response from ChartClient.open(). Closing it gives the connection
+    back to the pool if the whole response was read."""
+
+    def __init__(self, client, pooled, response):
+        self.client = client
+        self.pooled = pooled
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+
+    def read(self, size=None):
+        return self.response.read(size)
+
+    def readinto(self, buffer):
+        return self.response.readinto(buffer)
+
+    def settimeout(self, timeout):
+        """Sets the timeout of the socket reads still to come."""
+        sock = self.pooled and self.pooled.connection.sock
+        if sock is not None:
+            sock.settimeout(timeout)
+
+    def close(self):
+        if self.pooled is None:
+            return
+        pooled, self.pooled = self.pooled, None
+        reusable = self.response.isclosed() and not self.response.will_close
+        self.response.close()
+        self.client.release(pooled, reusable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ChartClient(object):
+    """Keeps HTTP connections open between downloads, to be passed to
+    Chart.download(), download_many() or used through open().
+
+    Up to pool_size idle connections are kept for each host, for up to
+    idle_timeout seconds. It is safe to use from several threads; each
+    request has a connection to itself and more are opened when they are
+    all in use. HTTPS connections resume the TLS session of the previous
+    connection to the same host. If a kept connection turns out to have
+    been closed by the server, the request is retried on a new one.
+
+    opened, reused and retried count connections opened, requests sent
+    on an already used connection, and requests retried. stats() gives
+    the number of requests sent on each open connection.
+    """
+
+    def __init__(self, pool_size=4, idle_timeout=60, ssl_context=None):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        # One context, as TLS sessions can only be resumed with the context
+        # they were made with.
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self.opened = 0
+        self.reused = 0
+        self.retried = 0
+        self._lock = threading.Lock()
+        # Idle _PooledConnections and TLS sessions, by (scheme, host, port)
+        self._idle = {}
+        self._sessions = {}
+        # Open _PooledConnections, idle or not
+        self._connections = set()
+
+    def open(self, url, data=None, timeout=None, headers=None):
+        """Sends a GET request for url, or a POST of data, with any extra
+        headers and returns the response, much like urlopen(). HTTPError is
+        raised for error responses and redirects aren't followed. The
+        response should be closed once read.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers or {})
+        if data is None:
+            method = 'GET'
+        else:
+            method = 'POST'
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        while True:
+            pooled = self.acquire(key, timeout)
+            try:
+                pooled.connection.request(method, path, data, headers)
+                response = pooled.connection.getresponse()
+            except socket.timeout:
+                self.release(pooled, False)
+                raise
+            except (httplib.BadStatusLine, socket.error):
+                # Also raised by a connection closed while it was idle, so
+                # a used connection is retried on a new one.
+                self.release(pooled, False)
+                if pooled.requests <= 1:
+                    raise
+                with self._lock:
+                    self.retried += 1
+                continue
+            except Exception:
+                self.release(pooled, False)
+                raise
+            response = _PooledResponse(self, pooled, response)
+            if response.status >= 400:
+                # Read so the connection can be used again.
+                response.read()
+                response.close()
+                raise HTTPError(url, response.status, response.reason,
+                    response.headers, None)
+            return response
+
+    def acquire(self, key, timeout=None):
+        """Returns an idle connection to key, or a new one."""
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                pooled = idle.pop()
+                if now - pooled.last_used <= self.idle_timeout:
+                    self.reused += 1
+                    break
+                self._connections.discard(pooled)
+                pooled.connection.close()
+            else:
+                pooled = None
+            session = self._sessions.get(key)
+        if pooled is None:
+            pooled = _PooledConnection(key, self.connect(key, session,
+                timeout))
+            with self._lock:
+                self.opened += 1
+                self._connections.add(pooled)
+        if timeout is not None:
+            pooled.connection.timeout = timeout
+            if pooled.connection.sock is not None:
+                pooled.connection.sock.settimeout(timeout)
+        pooled.requests += 1
+        return pooled
+
+    def connect(self, key, session=None, timeout=None):
+        scheme, host, port = key
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        if scheme == 'https':
+            connection = _HTTPSConnection(host, port,
+                context=self.ssl_context, **kwargs)
+            connection.session = session
+            return connection
+        return httplib.HTTPConnection(host, port, **kwargs)
+
+    def release(self, pooled, reusable=True):
+        """Gives a connection back to the pool, or closes it."""
+        pooled.last_used = time.time()
+        sock = pooled.connection.sock
+        with self._lock:
+            if reusable and getattr(sock, 'session', None) is not None:
+                self._sessions[pooled.key] = sock.session
+            idle = self._idle.setdefault(pooled.key, [])
+            if reusable and len(idle) < self.pool_size:
+                idle.append(pooled)
+                return
+            self._connections.discard(pooled)
+        pooled.connection.close()
+
+    def stats(self):
+        """Returns a list of ((scheme, host, port), requests) for each open
+        connection."""
+        with self._lock:
+            return [(a.key, a.requests) for a in self._connections]
+
+    def close(self):
+        """Closes the idle connections."""
+        with self._lock:
+            idle = [a for connections in self._idle.values()
+                for a in connections]
+            self._idle.clear()
+            self._connections.difference_update(idle)
+        for pooled in idle:
+            pooled.connection.close()
+
+
+class ImageCache(object):
+    """Cache of chart images for Chart.download() and download_many(), keyed
+    by a hash of the URL and POST data (see key()).
+
+    Images are kept in memory, up to memory_size bytes, and in directory if
+    one is given, up to disk_size bytes. Both drop the least recently used
+    images when they are full, and images older than ttl seconds aren't
+    used. Files are written to a temporary file which is then renamed, so
+    several processes can share the directory.
+
+    The ETag and Last-Modified headers of an image are kept with it, and
+    images which have them are kept after they expire, so Chart.download()
+    can ask the server whether they changed (see stale() and refresh()).
+
+    Hits, misses and evictions are counted in memory_hits, disk_hits,
+    misses, memory_evictions, disk_evictions and expired, and expired
+    images found to be unchanged in refreshed.
+    """
+
+    # Start of each cache file, followed by the time it was stored and the
+    # lengths of the ETag and Last-Modified which come before the image.
+    MAGIC = b'PGC2'
+    HEADER = struct.Struct('!4sdHH')
+
+    def __init__(self, directory=None, memory_size=16 * 1024 * 1024,
+            disk_size=256 * 1024 * 1024, ttl=None):
+        self.directory = directory
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.ttl = ttl
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+        self.expired = 0
+        self.refreshed = 0
+        self._lock = threading.Lock()
+        # key: (image, time stored, etag, last modified), least recently
+        # used first
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # Estimate of the size of directory, worked out when first needed.
+        self._disk_bytes = None
+        if directory is not None and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Made by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+
+    @staticmethod
+    def key(url, data=None):
+        """Returns the cache key of a request for url with POST data."""
+        digest = hashlib.sha256(url.encode('utf-8'))
+        if data is not None:
+            digest.update(b'\0')
+            digest.update(data)
+        return digest.hexdigest()
+
+    def is_expired(self, stored, now):
+        return self.ttl is not None and now - stored > self.ttl
+
+    @staticmethod
+    def has_validators(entry):
+        return entry[2] is not None or entry[3] is not None
+
+    def get(self, key):
+        """Returns the cached image, or None."""
+        now = time.time()
+        # Counted once, even if both tiers have the expired image
+        expired = False
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                if not self.is_expired(entry[1], now):
+                    self._memory[key] = entry
+                    self.memory_hits += 1
+                    return entry[0]
+                if self.has_validators(entry):
+                    self._memory[key] = entry
+                else:
+                    self._memory_bytes -= len(entry[0])
+                expired = True
+        if self.directory is not None:
+            entry = self.read_file(key)
+            if entry is not None and not self.is_expired(entry[1], now):
+                with self._lock:
+                    self.disk_hits += 1
+                    self.remember(key, entry)
+                return entry[0]
+            if entry is not None:
+                if not self.has_validators(entry):
+                    self.remove_file(self.path(key))
+                expired = True
+        with self._lock:
+            self.misses += 1
+            if expired:
+                self.expired += 1
+        return None
+
+    def stale(self, key):
+        """Returns (image, etag, last modified) of the image, expired or
+        not, or None if it isn't cached or has neither validator."""
+        with self._lock:
+            entry = self._memory.get(key)
+        if entry is None and self.directory is not None:
+            entry = self.read_file(key)
+        if entry is None or not self.has_validators(entry):
+            return None
+        return entry[0], entry[2], entry[3]
+
+    def set(self, key, image, etag=None, last_modified=None):
+        """Caches image, with the ETag and Last-Modified headers it was
+        sent with if there were any."""
+        now = time.time()
+        entry = (image, now, etag, last_modified)
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old[0])
+            self.remember(key, entry)
+        if self.directory is not None:
+            self.write_file(key, entry)
+
+    def refresh(self, key, image, etag=None, last_modified=None):
+        """Caches image again as the server said it's unchanged."""
+        with self._lock:
+            self.refreshed += 1
+        self.set(key, image, etag, last_modified)
+
+    def remember(self, key, entry):
+        """Adds to the memory tier. The lock must be held."""
+        if len(entry[0]) > self.memory_size:
+            return
+        self._memory[key] = entry
+        self._memory_bytes += len(entry[0])
+        while self._memory_bytes > self.memory_size:
+            image = self._memory.popitem(last=False)[1][0]
+            self._memory_bytes -= len(image)
+            self.memory_evictions += 1
+
+    def path(self, key):
+        # Not '.png', as the file starts with HEADER.
+        return os.path.join(self.directory, key + '.cache')
+
+    def read_file(self, key):
+        """Returns (image, time stored, etag, last modified) from the disk
+        tier, or None."""
+        path = self.path(key)
+        try:
+            fp = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            header = fp.read(self.HEADER.size)
+            if len(header) != self.HEADER.size:
+                return None
+            magic, stored, etag_size, modified_size = \
+                self.HEADER.unpack(header)
+            if magic != self.MAGIC:
+                return None
+            etag = fp.read(etag_size).decode('latin-1') or None
+            last_modified = fp.read(modified_size).decode('latin-1') or None
+            image = fp.read()
+        finally:
+            fp.close()
+        try:
+            # The modification time orders the files for eviction.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return image, stored, etag, last_modified
+
+    def write_file(self, key, entry):
+        image, stored, etag, last_modified = entry
+        etag = (etag or '').encode('latin-1')
+        last_modified = (last_modified or '').encode('latin-1')
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.',
+            suffix='.tmp')
+        try:
+            fp = os.fdopen(fd, 'wb')
+            try:
+                fp.write(self.HEADER.pack(self.MAGIC, stored, len(etag),
+                    len(last_modified)))
+                fp.write(etag)
+                fp.write(last_modified)
+                fp.write(image)
+            finally:
+                fp.close()
+            _replace(temp_path, self.path(key))
+        except Exception:
+            self.remove_file(temp_path)
+            raise
+        size = self.HEADER.size + len(etag) + len(last_modified) + len(image)
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += size
+            if self._disk_bytes is not None and \
+                    self._disk_bytes <= self.disk_size:
+                return
+        self.evict_files()
+
+    def evict_files(self):
+        """Removes the least recently used files until the directory is
+        within disk_size. Other processes may have added or removed files,
+        so the sizes are read from the directory."""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum([a[1] for a in files])
+        evicted = 0
+        for mtime, size, path in files:
+            if total <= self.disk_size:
+                break
+            self.remove_file(path)
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._disk_bytes = total
+            self.disk_evictions += evicted
+
+    @staticmethod
+    def remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            # Already removed, e.g. by another process.
+            pass
+
+    def clear(self):
+        """Empties the memory tier."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+
+class _Flight(object):
+    """A call in progress in SingleFlight."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces calls made with the same key while one is in progress.
+    Chart.download() and download_many() use it with the same key as
+    ImageCache, to make one request for an image however many threads or
+    tasks want it at the same time.
+
+    The first caller for a key makes the call. Callers with the same key
+    until it finishes wait for it and get its result, or its exception,
+    e.g. BadContentTypeException. calls counts the calls made and
+    coalesced the callers which waited for another's call instead.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, function, *args):
+        """Returns function(*args), or the result of the call in progress
+        for key."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function(*args)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+
+def _fetch_image(url, data=None, timeout=None, client=None, file_name=None,
+        max_size=None, cancel=None):
+    """Requests a chart image and returns it, or streams it to file_name.
+    The whole download has to take less than timeout seconds and the image
+    can't be larger than max_size bytes. It stops once the event cancel is
+    set."""
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    opener = _open_image(url, data, timeout, client)
+    try:
+        return _read_image(opener, file_name, max_size, deadline, cancel)
+    finally:
+        opener.close()
+
+
+def _fetch_cached(cache, key, url, data=None, timeout=None, client=None,
+        max_size=None, cancel=None):
+    """Requests a chart image for cache, with If-None-Match and
+    If-Modified-Since headers if an expired one is cached with validators,
+    and returns it. A 304 Not Modified response refreshes the cached one.
+    """
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    stale = cache.stale(key)
+    headers = {}
+    if stale is not None:
+        if stale[1] is not None:
+            headers['If-None-Match'] = stale[1]
+        if stale[2] is not None:
+            headers['If-Modified-Since'] = stale[2]
+    opener = _open_image(url, data, timeout, client, headers)
+    try:
+        etag = opener.headers['etag']
+        last_modified = opener.headers['last-modified']
+        if _status(opener) == 304 and stale is not None:
+            # Read so the connection can be used again.
+            opener.read()
+            image = stale[0]
+            cache.refresh(key, image, etag or stale[1],
+                last_modified or stale[2])
+            return image
+        image = _read_image(opener, None, max_size, deadline, cancel)
+    finally:
+        opener.close()
+    cache.set(key, image, etag, last_modified)
+    return image
+
+
+def _status(opener):
+    """Returns the status of a response from urlopen() or a ChartClient."""
+    if hasattr(opener, 'status'):
+        return opener.status
+    return opener.getcode()
+
+
+def _open_image(url, data=None, timeout=None, client=None, headers=None):
+    """Requests a chart image, returning the response once its headers are
+    read. A 304 Not Modified response is returned rather than raised."""
+    kwargs = {}
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+    try:
+        if client is not None:
+            opener = client.open(url, data, headers=headers, **kwargs)
+        elif headers:
+            opener = urlopen(Request(url, data, headers), **kwargs)
+        else:
+            opener = urlopen(url, data, **kwargs)
+    except HTTPError as error:
+        if error.code != 304:
+            raise
+        opener = error
+    if _status(opener) != 304 and \
+            opener.headers['content-type'] != 'image/png':
+        opener.close()
+        raise BadContentTypeException('Server responded with a ' \
+            'content-type of %s' % opener.headers['content-type'])
+    return opener
+
+
+def _read_image(opener, file_name=None, max_size=None, deadline=None,
+        cancel=None):
+    """Returns the image in the response opener, or streams it to
+    file_name."""
+    length = opener.headers['content-length']
+    if max_size is not None and length and int(length) > max_size:
+        raise ResponseTooLargeException('Server responded with %s ' \
+            'bytes, more than %i' % (length, max_size))
+    if file_name:
+        _write_file(file_name, lambda fp: _copy_response(opener, fp,
+            max_size, deadline, cancel))
+    else:
+        chunks = []
+        _copy_response(opener, chunks, max_size, deadline, cancel)
+        return b''.join(chunks)
+
+
+def _copy_response(opener, destination, max_size=None, deadline=None,
+        cancel=None, chunk_size=64 * 1024):
+    """Copies the response opener to the file destination, or appends it
+    to the list destination, chunk_size bytes at a time. Raises
+    ResponseTooLargeException after max_size bytes, socket.timeout when
+    it's still copying at the time deadline and DownloadCancelledException
+    once the event cancel is set. A ChartClient response only waits for
+    each chunk until deadline."""
+    if isinstance(destination, list):
+        write = lambda chunk: destination.append(bytes(chunk))
+    else:
+        write = destination.write
+    if hasattr(opener, 'readinto'):
+        # One buffer for the whole response
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        read = lambda: view[:opener.readinto(buffer)]
+    else:
+        read = lambda: opener.read(chunk_size)
+    size = 0
+    while True:
+        if cancel is not None and cancel.is_set():
+            raise DownloadCancelledException('Download was cancelled')
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('Download took too long')
+            if hasattr(opener, 'settimeout'):
+                opener.settimeout(remaining)
+        chunk = read()
+        if not len(chunk):
+            return size
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise ResponseTooLargeException('Server responded with more ' \
+                'than %i bytes' % max_size)
+        write(chunk)
+
+
+def _write_file(file_name, write):
+    """Calls write() with a temporary file, which is then renamed to
+    file_name, so file_name is never left partly written."""
+    directory = os.path.dirname(os.path.abspath(file_name))
+    # Unlike mkstemp(), which makes files only the user can read, this
+    # leaves the mode to the umask as for any other new file.
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+    while True:
+        temp_path = os.path.join(directory, '.%s.tmp' %
+            binascii.hexlify(os.urandom(6)).decode('ascii'))
+        try:
+            fd = os.open(temp_path, flags, 0o666)
+            break
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+    try:
+        fp = os.fdopen(fd, 'wb')
+        try:
+            write(fp)
+        finally:
+            fp.close()
+        _replace(temp_path, file_name)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _replace(source, destination):
+    """Renames source to destination, replacing it if it exists."""
+    try:
+        os.replace(source, destination)
+    except AttributeError:
+        # Python 2.x, where rename() replaces on POSIX.
+        os.rename(source, destination)
+
+
+def download_many(charts, concurrency=4, file_names=None, timeout=None,
+        use_post=True, return_exceptions=False, loop=None, client=None,
+        cache=None, coalesce=None, max_size=None):
+    """Downloads the images of charts, up to concurrency at a time, and
+    returns an asyncio future of the results in the same order as the
+    charts, e.g.:
+
+        images = await download_many(charts)
+
+    Each result is the image data, or the file name it was written to if
+    file_names (one per chart) is given. Each download has timeout seconds
+    from when it starts before it fails with asyncio.TimeoutError, and its
+    file isn't written after that. It fails with ResponseTooLargeException
+    if the image is larger than max_size bytes.
+    Errors, including BadContentTypeException, are raised from the future
+    unless return_exceptions is set, see asyncio.gather(). Cancelling the
+    future cancels the downloads which haven't finished, and timed out or
+    cancelled downloads in progress stop at their next chunk.
+
+    The downloads are done by Chart.download() in a thread pool, using
+    client's connections if a ChartClient is given and images from cache
+    if an ImageCache is given. If a SingleFlight is given as coalesce,
+    charts with the same image are downloaded once. loop is the event loop
+    to use if there isn't a running one.
+    """
+    if asyncio is None:
+        raise ImportError('download_many() requires asyncio')
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    charts = list(charts)
+    if file_names is None:
+        file_names = [None] * len(charts)
+    executor = ThreadPoolExecutor(concurrency)
+    futures = [_download_future(loop, executor, chart, file_name, timeout,
+        use_post, client, cache, coalesce, max_size)
+        for chart, file_name in zip(charts, file_names)]
+    results = asyncio.gather(*futures, return_exceptions=return_exceptions)
+    executor.shutdown(wait=False)
+    return results
+
+
+def _download_future(loop, executor, chart, file_name, timeout, use_post,
+        client, cache, coalesce, max_size):
+    """Returns a future of one download for download_many(). The timeout
+    starts when a worker thread takes the download, which stops between
+    chunks once the future is done, e.g. timed out or cancelled, and
+    file_name isn't written after that."""
+    future = loop.create_future()
+    stopped = threading.Event()
+    future.add_done_callback(lambda future: stopped.set())
+
+    def start_timer():
+        if future.done():
+            return
+        def timed_out():
+            if not future.done():
+                future.set_exception(asyncio.TimeoutError(
+                    'Download took more than %s seconds' % timeout))
+        timer = loop.call_later(timeout, timed_out)
+        future.add_done_callback(lambda future: timer.cancel())
+
+    def write(fp, image):
+        fp.write(image)
+        if stopped.is_set():
+            raise asyncio.CancelledError()
+
+    def download():
+        if timeout is not None:
+            loop.call_soon_threadsafe(start_timer)
+        image = chart.download(False, use_post, timeout, client, cache,
+            coalesce, max_size, cancel=stopped)
+        if not file_name:
+            return image
+        if not stopped.is_set():
+            _write_file(file_name, lambda fp: write(fp, image))
+        return file_name
+
+    task = loop.run_in_executor(executor, download)
+    def finished(task):
+        if task.cancelled():
+            if not future.done():
+                future.cancel()
+            return
+        error = task.exception()
+        if future.done():
+            # Timed out or cancelled
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(task.result())
+    task.add_done_callback(finished)
+    # Stops the download if it hasn't started, e.g. when cancelled.
+    future.add_done_callback(lambda future: task.cancel())
+    return future
@@ -0,0 +1,556 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import sys
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from test.test_base import TestBase
+import pygooglechart as gc
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'chart' * 100
+
+
+class ChartHandler(BaseHTTPRequestHandler):
+    """Stands in for the chart server. The path picks the response:
+    /slow waits before answering, /html answers with the wrong content type,
+    /missing is not found, /close closes the connection afterwards, /stream
+    sends the response in five parts a tenth of a second apart with no
+    length, /etag sends server.etag as the ETag and answers 304 Not Modified
+    when it is sent back and anything else gets PNG followed by the request
+    body or query."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(self.path.partition('?')[2].encode('utf-8'))
+
+    def do_POST(self):
+        self.respond(self.rfile.read(int(self.headers['content-length'])))
+
+    def respond(self, query):
+        self.server.requests.append(self.path)
+        if self.connection not in self.server.connections:
+            self.server.connections.append(self.connection)
+        if self.path.startswith('/slow'):
+            time.sleep(1)
+        if self.path.startswith('/etag'):
+            self.server.validators.append((self.headers['if-none-match'],
+                self.headers['if-modified-since']))
+            if self.headers['if-none-match'] == self.server.etag:
+                self.send_response(304)
+                self.send_header('ETag', self.server.etag)
+                self.end_headers()
+                return
+        body = PNG + query
+        if self.path.startswith('/missing'):
+            self.send_response(404)
+        else:
+            self.send_response(200)
+        if self.path.startswith('/close') or self.path.startswith('/stream'):
+            self.send_header('Connection', 'close')
+        if self.path.startswith('/etag'):
+            self.send_header('ETag', self.server.etag)
+            self.send_header('Last-Modified', 'Sun, 18 Oct 2026 10:00:00 GMT')
+        if self.path.startswith('/html'):
+            self.send_header('Content-Type', 'text/html')
+        else:
+            self.send_header('Content-Type', 'image/png')
+        if self.path.startswith('/stream'):
+            self.end_headers()
+            part = len(body) // 5 + 1
+            for start in range(0, len(body), part):
+                self.wfile.write(body[start:start + part])
+                self.wfile.flush()
+                time.sleep(0.1)
+            self.close_connection = True
+            return
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ChartServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing connections early on purpose
+        pass
+
+
+def read_file(file_name):
+    fp = open(file_name, 'rb')
+    try:
+        return fp.read()
+    finally:
+        fp.close()
+
+
+class ServerTestBase(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.server = ChartServer(('127.0.0.1', 0), ChartHandler)
+        self.server.requests = []
+        self.server.connections = []
+        self.server.validators = []
+        self.server.etag = '"1"'
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%i/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        TestBase.tearDown(self)
+
+    def chart(self, path='chart', value=1):
+        chart = gc.SimpleLineChart(100, 100)
+        chart.add_data([value, 2, 3])
+        chart.BASE_URL = self.url + path
+        return chart
+
+
+@unittest.skipIf(gc.asyncio is None, 'asyncio is not available')
+class TestDownloadMany(ServerTestBase):
+
+    def setUp(self):
+        ServerTestBase.setUp(self)
+        self.loop = gc.asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        ServerTestBase.tearDown(self)
+
+    def run_loop(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_bytes(self):
+        charts = [self.chart(value=a) for a in range(6)]
+        images = self.run_loop(gc.download_many(charts, concurrency=3,
+            loop=self.loop))
+        self.assertEqual(images, [PNG + chart.get_url_extension().encode(
+            'utf-8') for chart in charts])
+        self.assertEqual(len(self.server.requests), 6)
+
+    def test_files(self):
+        charts = [self.chart(value=a) for a in range(2)]
+        names = [self.temp_image, self.temp_image + '2']
+        try:
+            self.assertEqual(self.run_loop(gc.download_many(charts,
+                file_names=names, use_post=False, loop=self.loop)), names)
+            for chart, name in zip(charts, names):
+                self.assertEqual(read_file(name),
+                    PNG + chart.get_url_extension().encode('utf-8'))
+        finally:
+            os.unlink(names[1])
+
+    def test_content_type(self):
+        charts = [self.chart(), self.chart('html')]
+        self.assertRaises(gc.BadContentTypeException, self.run_loop,
+            gc.download_many(charts, loop=self.loop))
+        results = self.run_loop(gc.download_many(charts,
+            return_exceptions=True, loop=self.loop))
+        self.assertTrue(results[0].startswith(PNG))
+        self.assertTrue(isinstance(results[1], gc.BadContentTypeException))
+
+    def test_timeout(self):
+        start = time.time()
+        results = self.run_loop(gc.download_many([self.chart('slow'),
+            self.chart()], timeout=0.2, return_exceptions=True,
+            loop=self.loop))
+        self.assertTrue(time.time() - start < 0.9)
+        self.assertTrue(isinstance(results[0], gc.asyncio.TimeoutError))
+        self.assertTrue(results[1].startswith(PNG))
+
+    def test_queued_timeout(self):
+        # Each download takes about half a second, but waits for others.
+        charts = [self.chart('stream', value=a) for a in range(6)]
+        results = self.run_loop(gc.download_many(charts, concurrency=2,
+            timeout=1.2, return_exceptions=True, loop=self.loop))
+        self.assertEqual(results, [PNG + chart.get_url_extension().encode(
+            'utf-8') for chart in charts])
+
+    def test_cancel(self):
+        charts = [self.chart('slow') for a in range(4)]
+        future = gc.download_many(charts, concurrency=1,
+            file_names=[self.temp_image] * 4, loop=self.loop)
+        self.loop.call_later(0.2, future.cancel)
+        self.assertRaises(gc.asyncio.CancelledError, self.run_loop, future)
+        time.sleep(1.2)
+        # Only the download which had started was made, and its file wasn't
+        # written.
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertFalse(os.path.exists(self.temp_image))
+
+    def test_cancel_stream(self):
+        cache = gc.ImageCache()
+        chart = self.chart('stream')
+        future = gc.download_many([chart], loop=self.loop, cache=cache)
+        self.loop.call_later(0.15, future.cancel)
+        self.assertRaises(gc.asyncio.CancelledError, self.run_loop, future)
+        time.sleep(0.6)
+        # The download stopped instead of finishing in the background.
+        url, data = chart.request()
+        self.assertEqual(cache.get(gc.ImageCache.key(url, data)), None)
+
+    def test_coalesce(self):
+        coalesce = gc.SingleFlight()
+        charts = [self.chart('slow', value=a % 2) for a in range(6)]
+        images = self.run_loop(gc.download_many(charts, concurrency=6,
+            loop=self.loop, coalesce=coalesce))
+        self.assertEqual(images, [PNG + chart.get_url_extension().encode(
+            'utf-8') for chart in charts])
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual((coalesce.calls, coalesce.coalesced), (2, 4))
+
+
+class TestChartClient(ServerTestBase):
+
+    def setUp(self):
+        ServerTestBase.setUp(self)
+        self.client = gc.ChartClient(pool_size=2)
+
+    def tearDown(self):
+        self.client.close()
+        ServerTestBase.tearDown(self)
+
+    def test_reuse(self):
+        for a in range(5):
+            chart = self.chart(value=a)
+            self.assertEqual(chart.download(client=self.client),
+                PNG + chart.get_url_extension().encode('utf-8'))
+        chart.download(self.temp_image, use_post=False, client=self.client)
+        self.assertEqual(self.client.opened, 1)
+        self.assertEqual(self.client.reused, 5)
+        self.assertEqual(len(self.server.connections), 1)
+        key = ('http', '127.0.0.1', self.server.server_port)
+        self.assertEqual(self.client.stats(), [(key, 6)])
+
+    def test_stale(self):
+        self.chart().download(client=self.client)
+        self.server.connections[0].shutdown(socket.SHUT_RDWR)
+        time.sleep(0.1)
+        self.assertTrue(self.chart().download(
+            client=self.client).startswith(PNG))
+        self.assertEqual(self.client.retried, 1)
+        self.assertEqual(self.client.opened, 2)
+
+    def test_not_kept(self):
+        self.chart('close').download(client=self.client)
+        self.chart().download(client=self.client)
+        self.assertEqual(self.client.opened, 2)
+        self.assertRaises(gc.HTTPError, self.chart('missing').download,
+            client=self.client)
+        self.assertRaises(gc.BadContentTypeException,
+            self.chart('html').download, client=self.client)
+        self.client.idle_timeout = 0
+        time.sleep(0.01)
+        self.chart().download(client=self.client)
+        self.assertEqual(self.client.opened, 3)
+
+    def test_threads(self):
+        charts = [self.chart('slow', a) for a in range(3)]
+        threads = [threading.Thread(target=chart.download,
+            kwargs={'client': self.client}) for chart in charts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.client.opened, 3)
+        # Only pool_size connections are kept.
+        self.assertEqual(len(self.client.stats()), 2)
+
+    def test_https_connection(self):
+        connection = self.client.connect(('https', 'example.com', 443))
+        self.assertTrue(connection.ssl_context is self.client.ssl_context)
+        self.assertEqual(connection.tunnel_host, None)
+        connection.set_tunnel('proxied.example.com')
+        self.assertEqual(connection.tunnel_host, 'proxied.example.com')
+
+
+class TestImageCache(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        TestBase.tearDown(self)
+
+    def test_key(self):
+        key = gc.ImageCache.key('http://a/', b'cht=lc')
+        self.assertEqual(len(key), 64)
+        self.assertNotEqual(key, gc.ImageCache.key('http://a/'))
+        self.assertNotEqual(key, gc.ImageCache.key('http://a/', b'cht=p'))
+
+    def test_memory(self):
+        cache = gc.ImageCache(memory_size=25)
+        for key in 'abc':
+            cache.set(key, key.encode('ascii') * 10)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), b'b' * 10)
+        cache.set('d', b'd' * 10)
+        self.assertEqual(cache.get('c'), None)
+        self.assertEqual(cache.get('b'), b'b' * 10)
+        cache.set('e', b'e' * 30)
+        self.assertEqual(cache.get('e'), None)
+        self.assertEqual((cache.memory_hits, cache.misses,
+            cache.memory_evictions), (2, 3, 2))
+
+    def test_disk(self):
+        cache = gc.ImageCache(self.directory, memory_size=0, disk_size=100)
+        for key in 'abc':
+            cache.set(key, key.encode('ascii') * 30)
+            time.sleep(0.01)
+        self.assertEqual(os.listdir(self.directory).count('a.cache'), 0)
+        self.assertEqual(cache.disk_evictions, 1)
+        # A second cache sharing the directory, e.g. in another process
+        other = gc.ImageCache(self.directory)
+        self.assertEqual(other.get('b'), b'b' * 30)
+        self.assertEqual(other.get('b'), b'b' * 30)
+        self.assertEqual((other.disk_hits, other.memory_hits), (1, 1))
+        # 'b' was used last, so 'c' goes next.
+        cache.set('d', b'd' * 30)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+            ['b.cache', 'd.cache'])
+
+    def test_ttl(self):
+        cache = gc.ImageCache(self.directory, ttl=0.05)
+        cache.set('a', b'image')
+        self.assertEqual(cache.get('a'), b'image')
+        time.sleep(0.1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.expired, 1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_stale(self):
+        cache = gc.ImageCache(self.directory, ttl=0.05)
+        cache.set('a', b'image', '"1"', 'Sun, 18 Oct 2026 10:00:00 GMT')
+        cache.set('b', b'image')
+        self.assertEqual(cache.stale('b'), None)
+        time.sleep(0.1)
+        self.assertEqual(cache.get('a'), None)
+        stale = (b'image', '"1"', 'Sun, 18 Oct 2026 10:00:00 GMT')
+        self.assertEqual(cache.stale('a'), stale)
+        # Kept on disk for other processes too
+        self.assertEqual(gc.ImageCache(self.directory).stale('a'), stale)
+        cache.refresh('a', b'image', '"1"')
+        self.assertEqual(cache.get('a'), b'image')
+        self.assertEqual(cache.refreshed, 1)
+
+
+class TestCachedDownload(ServerTestBase):
+
+    def test_download(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = gc.ImageCache(directory)
+            chart = self.chart()
+            image = chart.download(cache=cache)
+            self.assertEqual(chart.download(cache=cache), image)
+            chart.download(self.temp_image, cache=cache)
+            self.assertEqual(read_file(self.temp_image), image)
+            self.assertEqual(len(self.server.requests), 1)
+            self.chart().download(use_post=False, cache=cache)
+            self.assertEqual(len(self.server.requests), 2)
+            self.assertEqual((cache.memory_hits, cache.misses), (2, 2))
+            self.assertEqual(gc.ImageCache(directory).get(gc.ImageCache.key(
+                chart.BASE_URL, chart.get_url_extension().encode('utf-8'))),
+                image)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestRevalidation(ServerTestBase):
+
+    def download(self, chart, cache, **kwargs):
+        time.sleep(0.1)
+        return chart.download(cache=cache, **kwargs)
+
+    def test_revalidate(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = gc.ImageCache(directory, ttl=0.05)
+            chart = self.chart('etag')
+            image = chart.download(cache=cache)
+            self.assertEqual(self.download(chart, cache), image)
+            self.assertEqual(self.server.validators, [(None, None),
+                ('"1"', 'Sun, 18 Oct 2026 10:00:00 GMT')])
+            self.assertEqual(cache.refreshed, 1)
+            # Refreshed, so not requested until it expires again
+            self.assertEqual(chart.download(cache=cache), image)
+            self.assertEqual(len(self.server.requests), 2)
+            # A new process sharing the directory
+            other = gc.ImageCache(directory, ttl=0.05)
+            self.assertEqual(self.download(chart, other), image)
+            self.assertEqual(other.refreshed, 1)
+            # Changed
+            self.server.etag = '"2"'
+            self.assertEqual(self.download(chart, cache), image)
+            self.assertEqual(self.server.validators[-1][0], '"1"')
+            self.assertEqual(cache.refreshed, 1)
+            self.assertEqual(cache.stale(gc.ImageCache.key(
+                *chart.request()))[1], '"2"')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_client(self):
+        client = gc.ChartClient()
+        try:
+            cache = gc.ImageCache(ttl=0.05)
+            chart = self.chart('etag')
+            image = chart.download(cache=cache, client=client)
+            for a in range(2):
+                self.assertEqual(self.download(chart, cache, client=client),
+                    image)
+            self.assertEqual(cache.refreshed, 2)
+            self.assertEqual((client.opened, client.reused), (1, 2))
+        finally:
+            client.close()
+
+
+class TestSingleFlight(ServerTestBase):
+
+    def download_all(self, chart, count=4, **kwargs):
+        coalesce = gc.SingleFlight()
+        results = [None] * count
+        def download(index):
+            try:
+                results[index] = chart.download(coalesce=coalesce, **kwargs)
+            except Exception as error:
+                results[index] = error
+        threads = [threading.Thread(target=download, args=(a,))
+            for a in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return coalesce, results
+
+    def test_download(self):
+        coalesce, images = self.download_all(self.chart('slow'))
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual((coalesce.calls, coalesce.coalesced), (1, 3))
+        self.assertTrue(images[0].startswith(PNG))
+        self.assertEqual(images, images[:1] * 4)
+        # Nothing in flight, so it's downloaded again
+        coalesce, images = self.download_all(self.chart('slow'), count=1)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_cache(self):
+        cache = gc.ImageCache()
+        chart = self.chart('slow')
+        coalesce, images = self.download_all(chart, cache=cache)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(chart.download(cache=cache), images[0])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_error(self):
+        coalesce, errors = self.download_all(self.chart('html'), count=3)
+        for error in errors:
+            self.assertTrue(isinstance(error, gc.BadContentTypeException))
+        self.assertEqual(coalesce.calls + coalesce.coalesced, 3)
+        self.assertEqual(len(self.server.requests), coalesce.calls)
+
+
+class TestDownload(ServerTestBase):
+
+    def test_download(self):
+        chart = self.chart()
+        self.assertTrue(chart.download(timeout=5).startswith(PNG))
+        chart.download(self.temp_image, use_post=False)
+        self.assertTrue(read_file(self.temp_image).startswith(PNG))
+        self.assertRaises(gc.BadContentTypeException,
+            self.chart('html').download)
+
+    def test_stream(self):
+        chart = self.chart('stream')
+        image = PNG + chart.get_url_extension().encode('utf-8')
+        self.assertEqual(chart.download(), image)
+        chart.download(self.temp_image)
+        self.assertEqual(read_file(self.temp_image), image)
+
+    def test_max_size(self):
+        directory = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(directory, 'chart.png')
+            for path in ('chart', 'stream'):
+                chart = self.chart(path)
+                self.assertRaises(gc.ResponseTooLargeException,
+                    chart.download, max_size=len(PNG))
+                self.assertRaises(gc.ResponseTooLargeException,
+                    chart.download, file_name, max_size=len(PNG))
+                # No partly written file is left behind
+                self.assertEqual(os.listdir(directory), [])
+            chart.download(file_name, max_size=len(PNG) * 2)
+            self.assertEqual(os.listdir(directory), ['chart.png'])
+            # The mode is the same as for any other new file.
+            other_name = os.path.join(directory, 'other.png')
+            open(other_name, 'wb').close()
+            self.assertEqual(os.stat(file_name).st_mode,
+                os.stat(other_name).st_mode)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_timeout(self):
+        # Each read is quick, but the whole download isn't.
+        chart = self.chart('stream')
+        self.assertRaises(socket.timeout, chart.download, timeout=0.25)
+        self.assertRaises(socket.timeout, chart.download, self.temp_image,
+            timeout=0.25)
+        self.assertFalse(os.path.exists(self.temp_image))
+        client = gc.ChartClient()
+        try:
+            self.assertRaises(socket.timeout, chart.download, timeout=0.25,
+                client=client)
+        finally:
+            client.close()
+
+    def test_cancel(self):
+        chart = self.chart('stream')
+        cancel = threading.Event()
+        cancel.set()
+        self.assertRaises(gc.DownloadCancelledException, chart.download,
+            cancel=cancel)
+        self.assertRaises(gc.DownloadCancelledException, chart.download,
+            self.temp_image, cancel=cancel)
+        self.assertFalse(os.path.exists(self.temp_image))
+        self.assertTrue(chart.download(cancel=threading.Event()).startswith(
+            PNG))
+
+    def test_client(self):
+        client = gc.ChartClient()
+        try:
+            chart = self.chart()
+            self.assertRaises(gc.ResponseTooLargeException,
+                self.chart('stream').download, client=client,
+                max_size=len(PNG))
+            self.assertEqual(chart.download(client=client, max_size=10000),
+                PNG + chart.get_url_extension().encode('utf-8'))
+        finally:
+            client.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
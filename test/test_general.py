@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import unittest
 import sys
 import os
+import random
 import warnings
 
 try:
@@ -35,6 +37,156 @@ class TestDataTypes(TestBase):
         self.assertEqual(repr(s), 'chd=e:AAAB..')
 
 
+@unittest.skipIf(gc.numpy is None, 'NumPy is not installed')
+class TestNumPyData(TestBase):
+
+    def test_simple_data(self):
+        s = gc.SimpleData([gc.numpy.arange(62),
+            gc.numpy.array([0, 1, 60, 61])])
+        self.assertEqual(repr(s),
+            'chd=s:ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+            'abcdefghijklmnopqrstuvwxyz0123456789,AB89')
+
+    def test_masked_data(self):
+        data = gc.numpy.ma.array([0, 1, 4095, 7], mask=[0, 0, 0, 1])
+        self.assertEqual(repr(gc.ExtendedData([data])), 'chd=e:AAAB..__')
+        data = gc.numpy.ma.array([0, 1, 99.9], mask=[0, 1, 0])
+        self.assertEqual(repr(gc.TextData([data])), 'chd=t:0.0,-1,99.9')
+
+    def test_out_of_range(self):
+        s = gc.ExtendedData([gc.numpy.array([0, 4096])])
+        self.assertRaises(gc.DataOutOfRangeException, repr, s)
+        s = gc.SimpleData([gc.numpy.array([-1])])
+        self.assertRaises(gc.DataOutOfRangeException, repr, s)
+
+    def test_same_url_as_lists(self):
+        data = [(a * 7919) % 1000 - 300 for a in range(500)]
+        for data_class in (gc.SimpleData, gc.TextData, gc.ExtendedData):
+            chart = gc.SimpleLineChart(300, 100)
+            chart.add_data(data)
+            array_chart = gc.SimpleLineChart(300, 100)
+            array_chart.add_data(gc.numpy.array(data))
+            self.assertEqual(chart.get_url(data_class),
+                array_chart.get_url(data_class))
+
+    def assertSameURL(self, array, y_range=None):
+        chart = gc.SimpleLineChart(300, 100, y_range=y_range)
+        chart.add_data(array.tolist())
+        array_chart = gc.SimpleLineChart(300, 100, y_range=y_range)
+        array_chart.add_data(array)
+        for data_class in (gc.SimpleData, gc.TextData, gc.ExtendedData):
+            self.assertEqual(array_chart.get_url(data_class),
+                chart.get_url(data_class))
+
+    def test_array_types(self):
+        numpy = gc.numpy
+        # Scaled without overflowing the array's type
+        data = numpy.array([100, -100, 5], dtype=numpy.int8)
+        self.assertSameURL(data)
+        self.assertSameURL(data, (-100, 100))
+        self.assertSameURL(numpy.array([0, 200, 255], dtype=numpy.uint8),
+            (-10, 256))
+        self.assertSameURL(numpy.array([(a * 7919) % 1000 / 7.
+            for a in range(2000)], dtype=numpy.float32))
+
+    def test_nan(self):
+        for y_range in (None, (0, 10)):
+            chart = gc.SimpleLineChart(300, 100, y_range=y_range)
+            chart.add_data(gc.numpy.array([1, float('nan'), 3]))
+            self.assertRaises(ValueError, chart.get_url, gc.ExtendedData)
+
+
+class TestCompactSeries(TestBase):
+
+    def test_series(self):
+        series = gc.CompactSeries([1, None, 3])
+        self.assertEqual(series.values.typecode, 'H')
+        self.assertEqual(list(series), [1, None, 3])
+        series.append(None)
+        series.append(-1.5)
+        self.assertEqual(series.values.typecode, 'd')
+        self.assertEqual(list(series), [1, None, 3, None, -1.5])
+        self.assertEqual(list(series.present()), [1, 3, -1.5])
+
+    def test_same_url_as_lists(self):
+        data = [(a * 7919) % 1000 - 300 for a in range(500)]
+        data[10] = None
+        for data_class in (gc.SimpleData, gc.TextData, gc.ExtendedData):
+            chart = gc.SimpleLineChart(300, 100)
+            chart.add_data(data)
+            compact_chart = gc.SimpleLineChart(300, 100, compact_data=True)
+            compact_chart.add_data(data)
+            self.assertEqual(chart.get_url(data_class),
+                compact_chart.get_url(data_class))
+
+    def test_scale_buffer_reused(self):
+        chart = gc.SimpleLineChart(300, 100, compact_data=True)
+        chart.add_data([1, 2, 3])
+        first = chart.scaled_data(gc.ExtendedData)[0]
+        second = chart.scaled_data(gc.ExtendedData)[0]
+        self.assertTrue(first is second)
+        self.assertEqual(list(second), [0, 1365, 2730])
+
+
+class TestScaledTextData(TestBase):
+
+    def test_precision(self):
+        s = gc.ScaledTextData([[0, 1.25, 99.96, None]], [(0, 100)])
+        self.assertEqual(repr(s), 'chd=t:0,1.2,100,_')
+        self.assertEqual(s.ranges_to_url(), 'chds=0,100')
+        s = gc.ScaledTextData([[0.5, -3]], [(-3, 1.5)], precision=2)
+        self.assertEqual(repr(s), 'chd=t:0.5,-3')
+        self.assertEqual(s.ranges_to_url(), 'chds=-3,1.5')
+
+    def test_chart(self):
+        chart = gc.SimpleLineChart(300, 100)
+        chart.add_data([1, 2, 3, None, 50])
+        chart.add_data([4, 5, 6, 7, 8])
+        self.assertChartURL(chart.get_url(gc.ScaledTextData),
+            '&chd=t:1,2,3,_,50%7c4,5,6,7,8&chds=1,51')
+        self.assertEqual(chart.scaled_y_range, (1, 51))
+        self.assertEqual(chart.data_to_url(gc.ScaledTextData),
+            'chd=t:1,2,3,_,50%7c4,5,6,7,8')
+        self.assertEqual(''.join(chart.iter_url_chunks(gc.ScaledTextData)),
+            chart.get_url(gc.ScaledTextData))
+        template = gc.ChartTemplate(chart, gc.ScaledTextData)
+        self.assertChartURL(template.url_for([[0, 10]]),
+            '&chd=t:0,10&chds=0,11')
+
+        chart = gc.XYLineChart(300, 100, y_range=(0, 10))
+        chart.add_data([0, 4])
+        chart.add_data([2, 3])
+        chart.set_text_precision(0)
+        self.assertChartURL(chart.get_url(gc.ScaledTextData),
+            '&chd=t:0,4%7c2,3&chds=0,4,0,10')
+
+
+class TestShortestEncoding(TestBase):
+
+    def make_chart(self, height, data):
+        chart = gc.SimpleLineChart(300, height)
+        chart.add_data(data)
+        chart.set_shortest_encoding()
+        return chart
+
+    def test_estimates(self):
+        chart = self.make_chart(200, [(a * 37) % 1000 for a in range(300)])
+        for data_class in chart.ENCODING_CANDIDATES:
+            estimate = chart.estimate_data_length(data_class)
+            actual = len(chart.data_to_url(data_class))
+            if chart.scaling_to_url(data_class):
+                actual += len('&' + chart.scaling_to_url(data_class))
+            self.assertTrue(abs(estimate - actual) <= actual * 0.05)
+
+    def test_selection(self):
+        data = [(a * 37) % 1000 for a in range(300)]
+        self.assertTrue('&chd=s:' in self.make_chart(50, data).get_url())
+        self.assertTrue('&chd=e:' in self.make_chart(200, data).get_url())
+        # Too many pixels for any encoding but text with chds
+        chart = self.make_chart(5000, [a * 1000 for a in range(20)])
+        self.assertEqual(chart.shortest_data_class(), gc.ScaledTextData)
+
+
 class TestScaling(TestBase):
 
     def test_simple_scale(self):
@@ -89,6 +241,417 @@ class TestScaling(TestBase):
         self.assertRaises(UserWarning, sv, 30, [0, 1])
 
 
+class TestFusedScaling(TestBase):
+
+    def test_same_as_scaled_data(self):
+        self.raise_warnings(False)
+        data = [(a * 7919) % 1000 - 300 for a in range(300)]
+        data[5] = None
+        float_data = [a / 3. if a is not None else None for a in data]
+        for y_range in (None, (0, 500)):
+            for series in (data, float_data):
+                chart = gc.XYLineChart(300, 100, y_range=y_range)
+                chart.add_data(series)
+                chart.add_data(series[::-1])
+                for data_class in (gc.SimpleData, gc.TextData,
+                        gc.ExtendedData):
+                    scaled = chart.scaled_data(data_class, None, y_range)
+                    self.assertEqual(chart.data_to_url(data_class),
+                        repr(data_class(scaled)))
+
+    def test_code_table(self):
+        # Only built when the range isn't wider than the series is long
+        self.assertEqual(gc.ExtendedData.scaled_code_table(0, 4000, 100),
+            None)
+        table = gc.ExtendedData.scaled_code_table(-50, 50, 1000)
+        self.assertEqual((table[-50], table[50]), ('AA', '..'))
+        data = [a % 101 - 50 for a in range(1000)]
+        data[3] = None
+        chart = gc.SimpleLineChart(300, 100, y_range=(-50, 50))
+        chart.add_data(data)
+        for data_class in (gc.SimpleData, gc.ExtendedData):
+            scaled = chart.scaled_data(data_class, None, (-50, 50))
+            self.assertEqual(chart.data_to_url(data_class),
+                repr(data_class(scaled)))
+
+    def test_ranges(self):
+        chart = gc.XYLineChart(300, 100)
+        chart.add_data([None, 3, 1])
+        chart.add_data([None, None])
+        chart.add_data([5, None, 2])
+        chart.add_data([-1, 4])
+        self.assertEqual(chart.data_x_range(), (1, 5))
+        self.assertEqual(chart.data_y_range(), (-1, 5))
+
+
+class TestDataCache(TestBase):
+
+    def test_invalidation(self):
+        chart = gc.SimpleLineChart(300, 100)
+        chart.add_data([1, 2, 3])
+        scaled = chart.scaled_data(gc.SimpleData)
+        self.assertTrue(chart.scaled_data(gc.SimpleData) is scaled)
+        self.assertEqual(chart.data_y_range(), (1, 4))
+        self.assertFalse(chart.scaled_data(gc.SimpleData, y_range=(0, 10))
+            is scaled)
+
+        chart.add_data([10])
+        self.assertEqual(chart.data_y_range(), (1, 11))
+        chart.data[1].append(20)
+        self.assertEqual(chart.data_y_range(), (1, 11))
+        chart.invalidate()
+        self.assertEqual(chart.data_y_range(), (1, 21))
+
+    def test_compact_encodings(self):
+        chart = gc.SimpleLineChart(300, 100, compact_data=True)
+        chart.add_data([0, 1, 2, 3, 4])
+        other = gc.SimpleLineChart(300, 100)
+        other.add_data([0, 1, 2, 3, 4])
+        calls = [(gc.ExtendedData, None), (gc.SimpleData, None),
+            (gc.ExtendedData, None), (gc.ExtendedData, (0, 8)),
+            (gc.ExtendedData, None), (gc.SimpleData, None)]
+        for data_class, y_range in calls:
+            result = chart.scaled_data(data_class, y_range=y_range)
+            self.assertEqual([list(a) for a in result],
+                other.scaled_data(data_class, y_range=y_range))
+        # One buffer per series, whatever the encodings and ranges
+        self.assertEqual(list(chart._scale_buffers), [0])
+        buffer = chart._scale_buffers[0]
+        chart.append_point(0, 5)
+        chart.scaled_data(gc.SimpleData)
+        self.assertTrue(chart._scale_buffers[0] is buffer)
+        chart.invalidate()
+        self.assertEqual(chart._scale_buffers, {})
+
+    def test_grammar(self):
+        grammar = gc.ChartGrammar()
+        chart = grammar.parse({'type': 'SimpleLine', 'w': 100, 'h': 100,
+            'data': [[1, 2]]})
+        self.assertEqual(chart.data_y_range(), (1, 3))
+        grammar.parse_data([[5, 6]])
+        self.assertEqual(chart.data_y_range(), (5, 7))
+
+
+class TestAppendPoint(TestBase):
+
+    def encoded_sizes(self, chart, data_class=gc.ExtendedData):
+        # ExtendedData uses Data.scale_encode_series()
+        sizes = []
+        original = data_class.scale_encode_series
+        def scale_encode_series(data, range, clips=None):
+            sizes.append(len(data))
+            return original(data, range, clips)
+        data_class.scale_encode_series = staticmethod(scale_encode_series)
+        try:
+            chart.get_url(data_class)
+        finally:
+            del data_class.scale_encode_series
+        return sizes
+
+    def fresh_url(self, chart, data_class=gc.ExtendedData):
+        other = gc.SimpleLineChart(300, 100, y_range=chart.y_range)
+        for series in chart.data:
+            other.add_data(list(series))
+        return other.get_url(data_class)
+
+    def test_fixed_range(self):
+        chart = gc.SimpleLineChart(300, 100, y_range=(0, 100))
+        chart.add_data(list(range(49)))
+        chart.add_data(list(range(50, 100)))
+        self.assertEqual(self.encoded_sizes(chart), [49, 50])
+        # Encoded series are kept from the first append_point()
+        chart.append_point(0, 49)
+        self.assertEqual(self.encoded_sizes(chart), [50, 50])
+        chart.append_point(0, 60)
+        chart.append_point(0, None)
+        self.assertEqual(self.encoded_sizes(chart), [2])
+        self.assertEqual(chart.get_url(gc.ExtendedData),
+            self.fresh_url(chart))
+        self.assertEqual(self.encoded_sizes(chart), [])
+
+    def test_growing_range(self):
+        chart = gc.SimpleLineChart(300, 100)
+        chart.add_data(list(range(50)))
+        chart.add_data(list(range(9)))
+        chart.append_point(1, 9)
+        self.encoded_sizes(chart)
+        chart.append_point(1, 20)
+        self.assertEqual(self.encoded_sizes(chart), [1])
+        chart.append_point(1, 200)
+        self.assertEqual(chart.data_y_range(), (0, 201))
+        self.assertEqual(self.encoded_sizes(chart), [50, 12])
+        self.assertEqual(chart.get_url(gc.ExtendedData),
+            self.fresh_url(chart))
+
+    def test_memory(self):
+        chart = gc.SimpleLineChart(300, 100, y_range=(0, 100))
+        chart.add_data(list(range(100)))
+        fp = io.StringIO()
+        chart.write_url(fp)
+        # Neither the encoded series nor the URL are kept.
+        self.assertEqual(chart._encode_buffers, None)
+        self.assertEqual(chart._url, None)
+        for a in range(1, 5):
+            chart.y_range = (0, 100 * a)
+            chart.get_url()
+        # Only the last URL is kept.
+        self.assertEqual(chart._url[1], chart.get_url_extension())
+
+    def test_text(self):
+        chart = gc.SimpleLineChart(300, 100, y_range=(0, 10))
+        chart.add_data((1, 2, 30))
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            chart.get_url(gc.TextData)
+            chart.append_point(0, 4)
+            self.assertEqual(chart.get_url(gc.TextData),
+                self.fresh_url(chart, gc.TextData))
+        self.assertEqual(chart.clip_report()[0].indices, [2])
+        chart.set_text_precision(2)
+        chart.get_url(gc.ScaledTextData)
+        chart.append_point(0, 5.25)
+        self.assertTrue('chd=t:1,2,30,4,5.25' in
+            chart.get_url(gc.ScaledTextData))
+
+
+class TestRingSeries(TestBase):
+
+    def test_window(self):
+        rnd = random.Random(14)
+        series = gc.RingSeries(7)
+        values = []
+        self.assertEqual(series.range(), None)
+        for a in range(100):
+            value = rnd.choice([None, rnd.randint(-50, 50)])
+            series.push(value)
+            values.append(value)
+            window = values[-7:]
+            self.assertEqual(list(series), window)
+            self.assertEqual(series[-1], value)
+            present = [b for b in window if b is not None]
+            if present:
+                self.assertEqual(series.range(), (min(present),
+                    max(present)))
+            else:
+                self.assertEqual(series.range(), None)
+        self.assertEqual(sum(map(len, series.segments())), 7)
+
+    def test_spark_line(self):
+        chart = gc.SparkLineChart(100, 30, y_range=(0, 20))
+        index = chart.add_window(5, range(8))
+        self.assertEqual(len(chart.data[index].segments()), 2)
+        chart.append_point(index, 30)
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            for data_class in (gc.SimpleData, gc.ExtendedData, gc.TextData,
+                    gc.ScaledTextData):
+                other = gc.SparkLineChart(100, 30, y_range=(0, 20))
+                other.add_data([4, 5, 6, 7, 30])
+                self.assertEqual(chart.get_url(data_class),
+                    other.get_url(data_class))
+        self.assertEqual(chart.clip_report()[0].indices, [4])
+
+    def test_auto_scale(self):
+        chart = gc.SparkLineChart(100, 30)
+        chart.add_window(3, [100, 1, 2])
+        self.assertEqual(chart.data_y_range(), (1, 101))
+        chart.append_point(0, 3)
+        self.assertEqual(chart.data_y_range(), (1, 4))
+        self.assertEqual(chart.get_url(gc.SimpleData),
+            'https://chart.googleapis.com/chart?cht=ls&chs=100x30&chd=s:AUp')
+
+
+class TestBatch(TestBase):
+
+    def specs(self):
+        shared = [[1, 2, 3, 40], [5, 6, None, 8]]
+        return [
+            {'type': 'SimpleLine', 'w': 300, 'h': 100, 'auto_scale': True,
+                'data': shared},
+            {'type': 'GroupedVerticalBar', 'w': 200, 'h': 50,
+                'auto_scale': True, 'data': shared},
+            {'type': 'SimpleLine', 'w': 300, 'h': 100, 'auto_scale': True,
+                'y_range': (0, 10), 'data': shared},
+            {'type': 'Venn', 'w': 300, 'h': 100, 'auto_scale': True,
+                'data': [[1, 2, 3]]},
+        ]
+
+    def test_same_urls(self):
+        batch = gc.render_urls_from_specs(self.specs())
+        self.assertFalse(isinstance(batch, list))
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            urls = [gc.ChartGrammar().parse(spec).get_url()
+                for spec in self.specs()]
+            self.assertEqual(list(batch), urls)
+
+    def test_shared_ranges(self):
+        calls = []
+        original = gc._series_range
+        def series_range(data):
+            calls.append(data)
+            return original(data)
+        gc._series_range = series_range
+        try:
+            with warnings.catch_warnings(record=True):
+                warnings.simplefilter('always')
+                list(gc.render_urls_from_specs(self.specs()))
+        finally:
+            gc._series_range = original
+        self.assertEqual(len(calls), 3)
+
+    def test_charts(self):
+        charts = []
+        for a in range(3):
+            chart = gc.SimpleLineChart(100, 100, title='Hello World')
+            chart.add_data([a, 10])
+            charts.append(chart)
+        self.assertEqual(list(gc.render_urls(charts, gc.SimpleData)),
+            [chart.get_url(gc.SimpleData) for chart in charts])
+        self.assertEqual(charts[0]._shared_ranges, None)
+
+
+class TestChartTemplate(TestBase):
+
+    def make_chart(self):
+        chart = gc.SimpleLineChart(300, 100, title='Hello World',
+            colours=['ff0000', '00ff00'])
+        chart.set_axis_labels(gc.Axis.LEFT, ['a', 'b'])
+        chart.set_grid(10, 20)
+        chart.fill_solid(gc.Chart.BACKGROUND, 'eeeeee')
+        return chart
+
+    def test_url_for(self):
+        template = gc.ChartTemplate(self.make_chart())
+        for data in ([[1, 2, 3]], [[4, 5], [6, None, 7]], []):
+            chart = self.make_chart()
+            for series in data:
+                chart.add_data(series)
+            self.assertEqual(template.url_for(data), chart.get_url())
+
+    def test_frozen(self):
+        chart = self.make_chart()
+        chart.add_data([100, 200])
+        template = gc.ChartTemplate(chart, gc.SimpleData)
+        chart.set_title('Changed')
+        url = template.url_for([[1, 2]])
+        self.assertTrue(url.startswith(template.prefix))
+        self.assertTrue('chtt=Hello+World' in url or
+            'chtt=Hello%20World' in url)
+        self.assertTrue('&chd=s:Ae&' in url)
+        self.assertEqual(chart.data, [[100, 200]])
+
+
+class TestProcessPoolRenderer(TestBase):
+
+    def items(self):
+        big = [(a * 7919) % 1000 for a in range(500)]
+        big[10] = None
+        items = []
+        for a in range(7):
+            chart = gc.SimpleLineChart(300, 100)
+            chart.add_data(big if a % 2 else [a, a + 1, a + 2])
+            chart.add_data([a / 3. for a in range(100)])
+            items.append(chart)
+            items.append({'type': 'SimpleLine', 'w': 100, 'h': 100,
+                'auto_scale': True, 'data': [big, [a] * 50]})
+        return items
+
+    def test_render(self):
+        items = self.items()
+        urls = []
+        for item in items:
+            if isinstance(item, dict):
+                item = gc.ChartGrammar().parse(dict(item))
+            urls.append(item.get_url())
+        renderer = gc.ProcessPoolRenderer(processes=2, chunk_size=3,
+            shared_size=50, max_pending=2)
+        self.assertEqual(list(renderer.render(self.items())), urls)
+        self.assertEqual(renderer.charts, 14)
+        self.assertEqual(renderer.chunks, 5)
+        if gc.shared_memory is not None:
+            self.assertEqual(renderer.shared_series, 19)
+        self.assertTrue(renderer.throughput() > 0)
+
+    def test_stop(self):
+        renderer = gc.ProcessPoolRenderer(processes=2, chunk_size=1,
+            shared_size=50)
+        urls = renderer.render(self.items())
+        self.assertTrue(next(urls).startswith(gc.Chart.BASE_URL))
+        urls.close()
+        self.assertEqual(renderer.charts, 1)
+
+
+class TestURLCache(TestBase):
+
+    def test_memoized(self):
+        chart = gc.SimpleLineChart(300, 100, title='Hello')
+        chart.add_data([1, 2, 3])
+        url = chart.get_url()
+        self.assertTrue(chart.get_url_extension() is
+            chart.get_url_extension())
+        self.assertEqual(chart.get_url(), url)
+
+    def test_setters(self):
+        chart = gc.SimpleLineChart(300, 100, title='Hello')
+        chart.add_data([1, 2, 3])
+        chart.get_url()
+        chart.set_title('World')
+        self.assertTrue('chtt=World' in chart.get_url())
+        chart.set_colours(['ff0000'])
+        self.assertTrue('chco=ff0000' in chart.get_url())
+        chart.set_axis_labels(gc.Axis.LEFT, ['a', 'b'])
+        self.assertTrue('chxt=y' in chart.get_url())
+        chart.add_marker(0, 1, 'o', '000000', 5)
+        self.assertTrue('chm=o,000000,0,1,5,0' in chart.get_url())
+        chart.set_grid(10, 10)
+        self.assertTrue('chg=10,10' in chart.get_url())
+        chart.add_data([4])
+        self.assertTrue('chd=e:AAQAgA,v.' in chart.get_url())
+
+    def test_invalidate(self):
+        chart = gc.SimpleLineChart(300, 100, title='Hello')
+        chart.add_data([1, 2, 3])
+        chart.get_url()
+        chart.title = 'World'
+        self.assertTrue('chtt=Hello' in chart.get_url())
+        chart.invalidate()
+        self.assertTrue('chtt=World' in chart.get_url())
+
+    def test_ranges(self):
+        chart = gc.SimpleLineChart(300, 100)
+        chart.add_data([1, 2, 3])
+        url = chart.get_url()
+        chart.y_range = (0, 100)
+        self.assertNotEqual(chart.get_url(), url)
+
+
+class TestClipReport(TestBase):
+
+    def test_single_warning(self):
+        chart = gc.SimpleLineChart(300, 100, y_range=(0, 10))
+        chart.add_data([1, 50, None, -3] + [100] * 100)
+        chart.add_data([1, 2])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            chart.get_url()
+            chart.scaled_data(gc.TextData, y_range=(0, 10))
+        self.assertEqual(len(caught), 2)
+        report = chart.clip_report()
+        self.assertEqual(list(report.keys()), [0])
+        self.assertEqual(report[0].count, 102)
+        self.assertEqual(report[0].indices[:3], [1, 3, 4])
+        self.assertEqual((report[0].min_value, report[0].max_value),
+            (-3, 100))
+        self.assertEqual(report[0].range, (0, 10))
+
+    def test_no_clipping(self):
+        chart = gc.SimpleLineChart(300, 100)
+        chart.add_data([1, 50, None, -3])
+        chart.get_url()
+        self.assertEqual(chart.clip_report(), {})
+
+
 class TestTitleStyle(TestBase):
 
     def test_title_style(self):
@@ -124,6 +687,143 @@ class TestLineChart(TestBase):
             '?cht=lc&chs=300x100&chd=e:AAMzZm__zM')
 
 
+class TestDownsampling(TestBase):
+
+    def test_lttb(self):
+        data = [0] * 1000
+        data[500] = 100
+        data[10] = None
+        x_data, sampled = gc.downsample_lttb(data, 20)
+        self.assertEqual(len(sampled), 20)
+        self.assertEqual(x_data[0], 0)
+        self.assertEqual(x_data[-1], 999)
+        # The spike and the gap are kept
+        self.assertTrue(500 in x_data)
+        self.assertEqual(sampled.count(None), 1)
+        self.assertEqual(x_data.count(None), 1)
+        self.assertEqual(gc.downsample_lttb([1, None, 3], 20), ([0, 1, 2],
+            [1, None, 3]))
+
+    def test_lttb_gaps(self):
+        chart = gc.SimpleLineChart(300, 100)
+        chart.set_downsampling(gc.LineChart.LTTB)
+        chart.add_data([10, None, None, 90, 20])
+        self.assertEqual(chart.data[0], [10, None, None, 90, 20])
+        self.assertChartURL(chart.get_url(),
+            '?cht=lc&chs=300x100&chd=e:AA____.MH6')
+        data = list(range(100)) + [None] * 10 + list(range(100))
+        x_data, sampled = gc.downsample_lttb(data, 20)
+        self.assertEqual(len(sampled), 20)
+        self.assertEqual(sampled[8:11], [99, None, 0])
+        self.assertEqual(x_data[8:11], [99, None, 110])
+        # Gaps keep their share of the width
+        chart = gc.SimpleLineChart(300, 100)
+        chart.set_downsampling(gc.LineChart.LTTB)
+        chart.add_data([1] * 1000 + [None] * 8000 + [2] * 1000)
+        sampled = chart.data[0]
+        self.assertEqual(len(sampled), 300)
+        self.assertEqual(sampled[:30], [1] * 30)
+        self.assertEqual(sampled[30:270], [None] * 240)
+        self.assertEqual(sampled[270:], [2] * 30)
+        # XY series have a single gap between runs
+        x_data, sampled = gc.downsample_lttb([None] + data + [None], 20,
+            list(range(212)))
+        self.assertEqual(len(sampled), 20)
+        self.assertEqual(sampled.count(None), 1)
+        self.assertEqual((x_data[0], x_data[-1]), (1, 210))
+
+    def test_m4(self):
+        data = [0] * 1000
+        data[501] = 100
+        data[502] = -100
+        data[10] = None
+        x_data, sampled = gc.downsample_m4(data, 10)
+        self.assertEqual(len(sampled), 50)
+        # The column with the missing value has a gap
+        self.assertEqual(sampled[:5], [0, 0, 0, None, 0])
+        self.assertEqual(sampled[25:30], [0, 100, -100, 0, 0])
+        self.assertEqual(x_data[25:30], [500, 501, 502, 599, 599])
+        self.assertEqual(len(gc.downsample_m4(list(range(1000)), 10)[1]),
+            40)
+
+    def test_m4_gaps(self):
+        data = [0.] * 4000
+        data[10] = 1000
+        data[12] = None
+        x_data, sampled = gc.downsample_m4(data, 100)
+        # The spike is kept next to the gap
+        self.assertEqual(max([a for a in sampled if a is not None]), 1000)
+        self.assertEqual(sampled[:5], [0, 0, 1000, None, 0])
+        self.assertEqual(x_data[:5], [0, 0, 10, None, 39])
+        chart = gc.SimpleLineChart(100, 100)
+        chart.set_downsampling(gc.LineChart.M4)
+        chart.add_data(data)
+        # Still one column per pixel
+        self.assertEqual(chart.data[0], gc.downsample_m4(data, 100)[1])
+        self.assertEqual(len(chart.data[0]), 500)
+
+    def test_m4_xy(self):
+        x_data = list(range(1000))
+        data = [a % 7 for a in x_data]
+        data[500] = None
+        x_out, sampled = gc.downsample_m4(data, 10, x_data)
+        self.assertEqual(len(x_out), len(sampled))
+        self.assertEqual(sampled.count(None), 1)
+        self.assertEqual(x_out[0], 0)
+        self.assertEqual(x_out[-1], 999)
+        present = [a for a in sampled if a is not None]
+        self.assertEqual((min(present), max(present)), (0, 6))
+
+    def test_line_charts(self):
+        data = [a % 100 for a in range(5000)]
+        chart = gc.SimpleLineChart(300, 100)
+        chart.add_data(data, max_points=50)
+        self.assertEqual(len(chart.data[0]), 50)
+        chart = gc.SparkLineChart(300, 100)
+        chart.set_downsampling(gc.LineChart.LTTB)
+        chart.add_data(data)
+        self.assertEqual(len(chart.data[0]), 300)
+        chart = gc.SimpleLineChart(300, 100)
+        chart.set_downsampling(gc.LineChart.M4)
+        chart.add_data(data)
+        self.assertEqual(len(chart.data[0]), 1200)
+
+    def test_xy_line_chart(self):
+        chart = gc.XYLineChart(300, 100)
+        chart.set_downsampling(gc.LineChart.LTTB)
+        chart.add_data([a * 2 for a in range(5000)])
+        chart.add_data([a % 100 for a in range(5000)])
+        self.assertEqual([len(a) for a in chart.data], [300, 300])
+        self.assertEqual(chart.data[0][-1], 9998)
+
+
+class TestStreaming(TestBase):
+
+    def assertStreamedURL(self, chart):
+        fp = io.StringIO()
+        length = chart.write_url(fp)
+        self.assertEqual(fp.getvalue(), chart.get_url())
+        self.assertEqual(length, len(chart.get_url()))
+
+    def test_line_chart(self):
+        chart = gc.SimpleLineChart(300, 100, title='Streaming')
+        chart.add_data([1, 2, 3, None, 5])
+        chart.add_data([5, 4, 3, 2, 1])
+        chart.set_axis_labels(gc.Axis.LEFT, ['a', 'b'])
+        self.assertStreamedURL(chart)
+        self.assertEqual(''.join(chart.iter_url_extension_chunks()),
+            chart.get_url_extension())
+
+    def test_bar_and_qr_charts(self):
+        chart = gc.GroupedVerticalBarChart(300, 100)
+        chart.add_data([1, 2, 3])
+        chart.set_bar_width(10)
+        self.assertStreamedURL(chart)
+        chart = gc.QRChart(100, 100)
+        chart.add_data('Hello World')
+        self.assertStreamedURL(chart)
+
+
 class TestQRChart(TestBase):
 
     def assertQRImage(self, chart, text):
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import sys
+import os
+import timeit
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from test.test_base import TestBase
+import pygooglechart as gc
+
+# Timings depend too much on the machine to be checked by default.
+BENCHMARK = os.environ.get('PYGOOGLECHART_BENCH')
+
+
+class BenchmarkTestBase(TestBase):
+    """The outputs are always compared, but nothing is timed unless the
+    PYGOOGLECHART_BENCH environment variable is set."""
+
+    def time(self, function, number=1):
+        """Returns the seconds one call of function takes, averaged over
+        number calls, or skips the test when not benchmarking."""
+        if not BENCHMARK:
+            self.skipTest('set PYGOOGLECHART_BENCH to check timings')
+        return timeit.timeit(function, number=number) / number
+
+    def assertFaster(self, seconds, other_seconds):
+        self.assertTrue(seconds < other_seconds, '%.3fms is not faster '
+            'than %.3fms' % (seconds * 1000, other_seconds * 1000))
+
+
+class TestEncodingSpeed(BenchmarkTestBase):
+    """Compares the table driven encoders against the per-value loops they
+    replaced."""
+
+    def benchmark(self, data_class, data, number=5):
+        self.assertEqual(data_class.encode_series(data),
+            data_class.encode_series_slow(data))
+        fast = self.time(lambda: data_class.encode_series(data), number)
+        slow = self.time(lambda: data_class.encode_series_slow(data),
+            number)
+        self.assertFaster(fast, slow)
+
+    def test_simple(self):
+        self.benchmark(gc.SimpleData, [a % 62 for a in range(50000)])
+
+    def test_extended(self):
+        data = [a % 4096 for a in range(50000)]
+        data[100] = None
+        self.benchmark(gc.ExtendedData, data)
+
+    def test_text(self):
+        # Formatting dominates here, so only the output is compared.
+        data = [(a % 1001) / 10. for a in range(50000)]
+        self.assertEqual(gc.TextData.encode_series(data),
+            gc.TextData.encode_series_slow(data))
+
+
+class TestScalingSpeed(BenchmarkTestBase):
+    """Compares scaling while encoding against scaled_data() followed by
+    encoding, which is how the data used to be encoded."""
+
+    def benchmark(self, data, number=3):
+        chart = gc.SimpleLineChart(300, 100)
+        chart.add_data(data)
+        data_class = gc.ExtendedData
+        self.assertEqual(chart.data_to_url(data_class),
+            repr(data_class(chart.scaled_data(data_class))))
+        # invalidate() so the ranges and scaled data aren't remembered.
+        fused = self.time(lambda: chart.invalidate() or
+            chart.data_to_url(data_class), number)
+        separate = self.time(lambda: chart.invalidate() or repr(
+            data_class(chart.scaled_data(data_class))), number)
+        self.assertFaster(fused, separate)
+
+    def test_integers(self):
+        self.benchmark([(a * 7919) % 1000 for a in range(50000)])
+
+    def test_floats(self):
+        self.benchmark([(a * 7919) % 1000 / 7. for a in range(50000)])
+
+
+class TestBatchSpeed(BenchmarkTestBase):
+    """Compares render_urls_from_specs() against making and rendering each
+    chart on its own. The charts share ten datasets."""
+
+    def test_specs(self):
+        datasets = [[[(a * 7919 + b) % 1000 for a in range(2000)]]
+            for b in range(10)]
+        specs = [{'type': 'SimpleLine', 'w': 300, 'h': 150,
+            'auto_scale': True, 'data': datasets[a % 10]}
+            for a in range(1000)]
+        single = lambda: [gc.ChartGrammar().parse(spec).get_url()
+            for spec in specs[:100]]
+        batch = lambda: list(gc.render_urls_from_specs(specs[:100]))
+        self.assertEqual(batch(), single())
+        single = lambda: [gc.ChartGrammar().parse(spec).get_url()
+            for spec in specs]
+        batch = lambda: list(gc.render_urls_from_specs(specs))
+        self.assertFaster(self.time(batch), self.time(single))
+
+
+class TestRenderSpeed(BenchmarkTestBase):
+    """Times SVGRenderer on a small line chart, which should take well
+    under a millisecond."""
+
+    def test_svg(self):
+        chart = gc.SimpleLineChart(300, 150, title='Sales',
+            legend=['a', 'b', 'c'])
+        for a in range(3):
+            chart.add_data([(b * 7919 + a) % 100 for b in range(50)])
+        chart.set_axis_range(gc.Axis.LEFT, 0, 100)
+        renderer = gc.SVGRenderer()
+        self.assertTrue(renderer.render(chart).startswith(b'<svg '))
+        # invalidate() so the scaled data isn't remembered.
+        seconds = self.time(lambda: chart.invalidate() or
+            renderer.render(chart), 500)
+        self.assertFaster(seconds, 0.001)
+
+
+if __name__ == "__main__":
+    unittest.main()
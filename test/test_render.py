@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import sys
+import os
+import io
+import struct
+import zlib
+import xml.etree.ElementTree as ET
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from test.test_base import TestBase
+import pygooglechart as gc
+
+SVG = '{http://www.w3.org/2000/svg}'
+
+
+class TestLayout(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.renderer = gc.SVGRenderer()
+
+    def shapes(self, chart, kind):
+        return [a for a in self.renderer.layout(chart) if a[0] == kind]
+
+    def test_abstract(self):
+        self.assertRaises(gc.AbstractClassException, gc.ChartRenderer)
+
+    def test_unknown(self):
+        for chart in (gc.PieChart3D(100, 100), gc.VennChart(100, 100)):
+            chart.add_data([1, 2, 3])
+            self.assertRaises(gc.UnknownChartType, self.renderer.layout,
+                chart)
+
+    def test_lines(self):
+        chart = gc.SimpleLineChart(100, 100)
+        chart.add_data([0, 1, 2, None, 3, 4])
+        lines = self.shapes(chart, 'line')
+        # Broken at the missing value
+        self.assertEqual([len(a[1]) for a in lines], [3, 2])
+        plot = 6, 6, 88, 88
+        self.assertEqual(lines[0][1][0], (plot[0], plot[1] + plot[3]))
+        x, y = lines[1][1][1]
+        self.assertAlmostEqual(x, plot[0] + plot[2])
+        # Scaled as for the URL, to 4 of 0..5
+        self.assertAlmostEqual(y, plot[1] + plot[3] * (1 - 3276 / 4095.))
+
+    def test_changes(self):
+        chart = gc.SimpleLineChart(100, 100)
+        chart.add_data([0, 1, 2])
+        self.assertEqual(len(self.shapes(chart, 'line')[0][1]), 3)
+        chart.append_point(0, 3)
+        self.assertEqual(len(self.shapes(chart, 'line')[0][1]), 4)
+        chart.data[0].append(4)
+        chart.invalidate()
+        self.assertEqual(len(self.shapes(chart, 'line')[0][1]), 5)
+
+    def test_xy_lines(self):
+        chart = gc.XYLineChart(100, 100)
+        chart.add_data([0, 10])
+        chart.add_data([5, 0])
+        chart.set_line_style(0, 3, 4, 2)
+        line, = self.shapes(chart, 'line')
+        self.assertEqual(line[3:], (3., (4., 2.)))
+        self.assertEqual(line[1][0][0], 6)
+        self.assertAlmostEqual(line[1][1][0], 94)
+
+    def test_bars(self):
+        for cls, stacked in ((gc.StackedVerticalBarChart, True),
+                (gc.GroupedVerticalBarChart, False)):
+            chart = cls(100, 100, y_range=(0, 4))
+            chart.add_data([1, 2])
+            chart.add_data([1, 2])
+            rects = self.shapes(chart, 'rect')[1:]
+            self.assertEqual(len(rects), 4)
+            heights = [round(a[4] / 88. * 4) for a in rects]
+            self.assertEqual(heights, [1, 1, 2, 2])
+            # Stacked bars share their x
+            self.assertEqual(rects[0][1] == rects[1][1], stacked)
+
+    def test_bar_width(self):
+        chart = gc.GroupedHorizontalBarChart(100, 100, colours=['FF0000'])
+        chart.add_data([1, 2, 3])
+        chart.set_bar_width(10)
+        chart.set_colours_within_series(['00FF00', '0000FF'])
+        rects = self.shapes(chart, 'rect')[1:]
+        self.assertEqual([a[4] for a in rects], [10] * 3)
+        self.assertEqual([a[5] for a in rects], ['00FF00', '0000FF',
+            '00FF00'])
+
+    def test_scatter(self):
+        chart = gc.ScatterChart(100, 100)
+        chart.add_data([0, 1, 2])
+        chart.add_data([2, 1, None])
+        chart.add_data([1, 2, 4])
+        circles = self.shapes(chart, 'circle')
+        self.assertEqual(len(circles), 2)
+        self.assertTrue(circles[0][3] < circles[1][3])
+
+    def test_pie(self):
+        chart = gc.PieChart2D(200, 100)
+        chart.add_data([1, 3])
+        chart.set_pie_labels(['One', 'Three'])
+        wedges = self.shapes(chart, 'wedge')
+        self.assertEqual([a[5] - a[4] for a in wedges],
+            [gc.math.pi / 2, gc.math.pi * 3 / 2])
+        self.assertEqual([a[3] for a in self.shapes(chart, 'text')],
+            ['One', 'Three'])
+
+    def test_pie_colours(self):
+        # Slices take the series colours in turn, as chco does for pies.
+        chart = gc.PieChart2D(200, 100, colours=['FF0000', '00FF00'])
+        chart.add_data([1, 2, 3])
+        self.assertEqual([a[6] for a in self.shapes(chart, 'wedge')],
+            ['FF0000', '00FF00', 'FF0000'])
+
+    def test_text(self):
+        chart = gc.SimpleLineChart(200, 100, title='Up|Down',
+            legend=['a & b'])
+        chart.add_data([1, 2])
+        chart.set_axis_labels(gc.Axis.BOTTOM, ['Mon', 'Tue'])
+        chart.set_axis_range(gc.Axis.LEFT, 0, 10)
+        texts = [a[3] for a in self.shapes(chart, 'text')]
+        self.assertEqual(texts, ['Up', 'Down', 'a & b', 'Mon', 'Tue', '0',
+            '2.5', '5', '7.5', '10'])
+
+    def test_markers(self):
+        chart = gc.SimpleLineChart(100, 100)
+        chart.add_data([1, 2, 3])
+        chart.add_data([0, 0, 0])
+        chart.add_marker(0, -1, 's', 'FF0000', 6)
+        chart.add_marker(1, 2, 'o', '00FF00', 4)
+        chart.add_fill_range('0000FF', 0, 1)
+        chart.add_horizontal_range('EEEEEE', 0.2, 0.4)
+        kinds = [a[0] for a in self.renderer.layout(chart)]
+        self.assertEqual(kinds, ['rect', 'rect', 'polygon', 'line', 'line',
+            'rect', 'rect', 'rect', 'circle'])
+
+
+class TestSVGRenderer(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.renderer = gc.SVGRenderer()
+
+    def parse(self, chart):
+        return ET.fromstring(self.renderer.render(chart))
+
+    def test_charts(self):
+        charts = [gc.SimpleLineChart(300, 150), gc.SparkLineChart(100, 30),
+            gc.StackedVerticalBarChart(200, 100),
+            gc.StackedHorizontalBarChart(200, 100),
+            gc.GroupedVerticalBarChart(200, 100),
+            gc.GroupedHorizontalBarChart(200, 100),
+            gc.PieChart2D(250, 100)]
+        for chart in charts:
+            chart.add_data([1, 4, 2])
+            chart.set_title('<Title>')
+            root = self.parse(chart)
+            self.assertEqual((root.get('width'), root.get('height')),
+                (str(chart.width), str(chart.height)))
+            self.assertEqual(root.find(SVG + 'text').text, '<Title>')
+
+    def test_colours(self):
+        chart = gc.PieChart2D(100, 100, colours=['FF000080'])
+        chart.add_data([5])
+        chart.fill_linear_gradient(gc.Chart.BACKGROUND, 20, '76A4FB', 1,
+            'FFFFFF', 0)
+        root = self.parse(chart)
+        self.assertEqual(root.find(SVG + 'rect').get('fill'), '#76A4FB')
+        # A single slice is a whole circle
+        circle = root.find(SVG + 'circle')
+        self.assertEqual(circle.get('fill'), '#FF0000')
+        self.assertEqual(circle.get('fill-opacity'), '0.502')
+
+    def test_download(self):
+        chart = gc.SimpleLineChart(100, 100)
+        chart.add_data([1, 2, 3])
+        # Nothing is requested
+        chart.BASE_URL = 'http://127.0.0.1:1/'
+        image = chart.download(renderer=self.renderer)
+        self.assertTrue(image.startswith(b'<svg '))
+        chart.renderer = self.renderer
+        chart.download(self.temp_image)
+        fp = open(self.temp_image, 'rb')
+        try:
+            self.assertEqual(fp.read(), image)
+        finally:
+            fp.close()
+
+
+def read_png(image):
+    """Returns the width, height and rows of RGB pixels of a PNG made by
+    PNGRenderer without Pillow, which doesn't filter the rows."""
+    assert image[:8] == b'\x89PNG\r\n\x1a\n'
+    width, height = struct.unpack('!II', image[16:24])
+    start = image.index(b'IDAT') + 4
+    size = struct.unpack('!I', image[start - 8:start - 4])[0]
+    data = bytearray(zlib.decompress(image[start:start + size]))
+    stride = width * 3 + 1
+    rows = []
+    for y in range(height):
+        assert data[y * stride] == 0
+        row = data[y * stride + 1:(y + 1) * stride]
+        rows.append([tuple(row[a:a + 3]) for a in range(0, width * 3, 3)])
+    return width, height, rows
+
+
+class TestPNGRenderer(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.renderer = gc.PNGRenderer(use_pillow=False)
+
+    def chart(self):
+        chart = gc.StackedVerticalBarChart(100, 80, colours=['FF0000'],
+            y_range=(0, 1))
+        chart.fill_solid(gc.Chart.BACKGROUND, '00FF00')
+        chart.add_data([1])
+        return chart
+
+    def test_pixels(self):
+        width, height, rows = read_png(self.renderer.render(self.chart()))
+        self.assertEqual((width, height), (100, 80))
+        self.assertEqual(rows[0][0], (0, 255, 0))
+        self.assertEqual(rows[40][50], (255, 0, 0))
+
+    def test_alpha(self):
+        chart = self.chart()
+        chart.set_colours(['FF000080'])
+        width, height, rows = read_png(self.renderer.render(chart))
+        self.assertEqual(rows[40][50], (128, 127, 0))
+
+    def test_text(self):
+        chart = self.chart()
+        blank = read_png(self.renderer.render(chart))[2]
+        chart.set_title('Title')
+        rows = read_png(self.renderer.render(chart))[2]
+        self.assertNotEqual(rows[:20], blank[:20])
+        self.assertTrue((51, 51, 51) in sum(rows[:20], []))
+
+    def test_deterministic(self):
+        chart = gc.SimpleLineChart(200, 100, title='Lines',
+            legend=['One', 'Two'])
+        chart.add_data([1, 5, 2, None, 4])
+        chart.add_data([3, 2, 4, 1, 0])
+        chart.set_line_style(1, 2, 4, 2)
+        chart.add_marker(0, -1, 'o', '0000FF80', 5)
+        chart.set_axis_labels(gc.Axis.BOTTOM, ['A', 'B', 'C'])
+        image = self.renderer.render(chart)
+        self.assertEqual(gc.PNGRenderer(use_pillow=False).render(chart),
+            image)
+
+    def test_dashes(self):
+        self.assertEqual(gc._dash_runs([(0, 0), (4, 0), (10, 0)], 2, 3),
+            [[(0, 0), (2., 0.)], [(5., 0.), (7., 0.)]])
+
+    def test_download(self):
+        chart = self.chart()
+        chart.renderer = self.renderer
+        chart.download(self.temp_image)
+        fp = open(self.temp_image, 'rb')
+        try:
+            self.assertEqual(read_png(fp.read())[2][40][50], (255, 0, 0))
+        finally:
+            fp.close()
+
+    @unittest.skipIf(gc.Image is not None, 'Pillow is installed')
+    def test_no_pillow(self):
+        self.assertFalse(gc.PNGRenderer().use_pillow)
+        self.assertRaises(ImportError, gc.PNGRenderer, True)
+
+    @unittest.skipIf(gc.Image is None, 'Pillow is not installed')
+    def test_pillow(self):
+        renderer = gc.PNGRenderer()
+        self.assertTrue(renderer.use_pillow)
+        chart = self.chart()
+        chart.set_title('Title')
+        image = renderer.render(chart)
+        self.assertEqual(renderer.render(chart), image)
+        image = gc.Image.open(io.BytesIO(image))
+        self.assertEqual(image.size, (100, 80))
+        self.assertEqual(image.getpixel((0, 0)), (0, 255, 0))
+        self.assertEqual(image.getpixel((50, 60)), (255, 0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()